@@ -1,6 +1,42 @@
 #include "lisp_parser.h"
 
-int main() {
+// read_program
+// Reads a whole file and wraps its top-level forms in a do block, the way
+// the Python front end treats a program.
+static char *read_program(const char *path) {
+    FILE *f = fopen(path, "rb");
+    if (!f) {
+        perror(path);
+        exit(EXIT_FAILURE);
+    }
+    fseek(f, 0, SEEK_END);
+    long size = ftell(f);
+    fseek(f, 0, SEEK_SET);
+    char *buf = malloc(size + 6);
+    if (!buf) {
+        perror("malloc failed");
+        exit(EXIT_FAILURE);
+    }
+    memcpy(buf, "(do\n", 4);
+    size_t n = fread(buf + 4, 1, size, f);
+    fclose(f);
+    memcpy(buf + 4 + n, ")", 2);
+    return buf;
+}
+
+// Usage: lisp_parser [--parse] [FILE]
+// Without FILE a built-in sample program is used. With --parse the
+// program is only parsed, which is what the benchmark harness times.
+int main(int argc, char **argv) {
+    bool parse_only = false;
+    const char *path = NULL;
+    for (int i = 1; i < argc; i++) {
+        if (strcmp(argv[i], "--parse") == 0)
+            parse_only = true;
+        else
+            path = argv[i];
+    }
+
     // Create the root environment for our program
     Environment *root_env = create_environment(NULL);
 
@@ -17,7 +53,8 @@ int main() {
         // End the do block
         ")";
 
-    const char *p = input;
+    char *buf = path ? read_program(path) : NULL;
+    const char *p = buf ? buf : input;
 
     // Parse the program
     Node *expr = parse_expr(&p);
@@ -26,6 +63,12 @@ int main() {
         return 1;
     }
 
+    if (parse_only) {
+        free_node(expr);
+        free(buf);
+        return 0;
+    }
+
     // Print the parsed expression
     printf("Parsed: ");
     print_node(expr);
@@ -41,7 +84,8 @@ int main() {
 
     // Clean up the expression tree
     free_node(expr);
+    free(buf);
 
     // TODO: Clean up the environment
     return 0;
-} 
\ No newline at end of file
+}
@@ -0,0 +1,356 @@
+import os
+import subprocess
+import tempfile
+from func import Func
+
+# Emits GNU as x86_64 (AT&T syntax) straight from the IR, for Linux. Every
+# function gets an %rbp frame: the static link, which is the %rbp of the
+# enclosing function's frame, sits at -8(%rbp) and slot i at -8*(i+2).
+# Arguments are pushed on the stack right to left, the static link is
+# passed in %r10 and the result comes back in %rax. The program starts
+# at _start, prints main's result with the write syscall and exits.
+# Pointers are plain addresses; alloc takes 8-byte aligned blocks from
+# zeroed chunks that pl_alloc maps in and never gives back.
+
+RUNTIME = '''\
+    .section .rodata
+pl_result:
+    .ascii "Result: "
+pl_div_zero:
+    .ascii "Runtime error: division by zero\\n"
+pl_no_memory:
+    .ascii "Runtime error: bad allocation\\n"
+
+    .bss
+    .balign 8
+pl_heap_top:
+    .zero 8
+pl_heap_end:
+    .zero 8
+
+    .text
+    .globl _start
+_start:
+    xor %r10d, %r10d
+    call func0
+    mov %rax, %rdi
+    call pl_print
+    mov $60, %eax
+    xor %edi, %edi
+    syscall
+
+# Writes "Result: <rdi>\\n" to stdout.
+pl_print:
+    push %rbp
+    mov %rsp, %rbp
+    sub $32, %rsp
+    mov %rdi, %r8
+    mov $1, %eax
+    mov $1, %edi
+    lea pl_result(%rip), %rsi
+    mov $8, %edx
+    syscall
+    lea -1(%rbp), %rsi
+    movb $10, (%rsi)
+    mov %r8, %rax
+    test %rax, %rax
+    jns 1f
+    neg %rax
+1:
+    mov $10, %ecx
+2:
+    xor %edx, %edx
+    div %rcx
+    add $48, %dl
+    dec %rsi
+    mov %dl, (%rsi)
+    test %rax, %rax
+    jnz 2b
+    test %r8, %r8
+    jns 3f
+    dec %rsi
+    movb $45, (%rsi)
+3:
+    mov %rbp, %rdx
+    sub %rsi, %rdx
+    mov $1, %eax
+    mov $1, %edi
+    syscall
+    leave
+    ret
+
+pl_div_error:
+    mov $1, %eax
+    mov $2, %edi
+    lea pl_div_zero(%rip), %rsi
+    mov $32, %edx
+    syscall
+    mov $60, %eax
+    mov $1, %edi
+    syscall
+
+# Returns %rdi zeroed bytes at %rax, taking a new chunk of at least
+# 1 MB from mmap when the current one runs out.
+pl_alloc:
+    test %rdi, %rdi
+    js pl_alloc_error
+    add $7, %rdi
+    and $-8, %rdi
+    mov pl_heap_top(%rip), %rax
+    lea (%rax,%rdi), %rdx
+    cmp pl_heap_end(%rip), %rdx
+    jbe 2f
+    mov $0x100000, %esi
+    cmp %rsi, %rdi
+    jbe 1f
+    mov %rdi, %rsi
+1:
+    push %rdi
+    push %rsi
+    mov $9, %eax
+    xor %edi, %edi
+    mov $3, %edx
+    mov $0x22, %r10d
+    mov $-1, %r8
+    xor %r9d, %r9d
+    syscall
+    pop %rsi
+    pop %rdi
+    cmp $-4096, %rax
+    ja pl_alloc_error
+    lea (%rax,%rsi), %rdx
+    mov %rdx, pl_heap_end(%rip)
+    lea (%rax,%rdi), %rdx
+2:
+    mov %rdx, pl_heap_top(%rip)
+    ret
+
+pl_alloc_error:
+    mov $1, %eax
+    mov $2, %edi
+    lea pl_no_memory(%rip), %rsi
+    mov $30, %edx
+    syscall
+    mov $60, %eax
+    mov $1, %edi
+    syscall
+'''
+
+ASM_ARITH = {'+': 'add', '-': 'sub', '*': 'imul'}
+
+ASM_SETCC = {
+    'eq': 'sete',
+    'ne': 'setne',
+    'lt': 'setl',
+    'le': 'setle',
+    'gt': 'setg',
+    'ge': 'setge',
+}
+
+# The jump taken when a comparison fails.
+ASM_JCC_NOT = {
+    'eq': 'jne',
+    'ne': 'je',
+    'lt': 'jge',
+    'le': 'jg',
+    'gt': 'jle',
+    'ge': 'jl',
+}
+
+def slot(var):
+    return f'{-8 * (var + 2)}(%rbp)'
+
+def asm_link(out, hops, reg):
+    # Loads the %rbp of the frame `hops` levels out into reg.
+    if hops == 0:
+        out.append(f'mov %rbp, {reg}')
+        return
+    out.append(f'mov -8(%rbp), {reg}')
+    for _ in range(hops - 1):
+        out.append(f'mov -8({reg}), {reg}')
+
+def asm_imm(out, val):
+    # An int constant as an operand: in %rcx, since most 64-bit values
+    # do not fit an instruction's immediate field.
+    val = (int(val) + (1 << 63)) % (1 << 64) - (1 << 63)
+    out.append(f'movabs ${val}, %rcx')
+    return '%rcx'
+
+def asm_binop(out, name, a1, rhs, dst, byte):
+    # rhs is an operand: a slot or a register.
+    out.append(f'mov {slot(a1)}, %rax')
+    if name in ASM_ARITH:
+        out.append(f'{ASM_ARITH[name]} {rhs}, %rax')
+    elif name in ('/', '%'):
+        # idiv traps on zero and on INT64_MIN / -1; the C backend
+        # reports the first and wraps the second, and so does this.
+        out.append(f'mov {rhs}, %rcx')
+        out.append('test %rcx, %rcx')
+        out.append('jz pl_div_error')
+        out.append('cmp $-1, %rcx')
+        out.append('jne 1f')
+        out.append('neg %rax' if name == '/' else 'xor %eax, %eax')
+        out.append('jmp 2f')
+        out.append('1:')
+        out.append('cqo')
+        out.append('idiv %rcx')
+        if name == '%':
+            out.append('mov %rdx, %rax')
+        out.append('2:')
+    elif name in ASM_SETCC:
+        out.append(f'cmp {rhs}, %rax')
+        out.append(f'{ASM_SETCC[name]} %al')
+        out.append('movzbl %al, %eax')
+    else:
+        out.append('test %rax, %rax')
+        out.append('setne %al')
+        out.append(f'cmpq $0, {rhs}')
+        out.append('setne %cl')
+        out.append(f'{name}b %cl, %al')
+        out.append('movzbl %al, %eax')
+    if byte:
+        out.append('movzbl %al, %eax')
+    out.append(f'mov %rax, {slot(dst)}')
+
+def asm_func(func: Func, idx, funcs):
+    size = max(func.max_stack + 1, func.nargs, 1)
+    frame = (8 * (size + 1) + 15) // 16 * 16
+    out = [
+        'push %rbp',
+        'mov %rsp, %rbp',
+        f'sub ${frame}, %rsp',
+        'mov %r10, -8(%rbp)',
+    ]
+    for i in range(size):
+        if i < func.nargs:
+            out.append(f'mov {16 + 8 * i}(%rbp), %rax')
+            out.append(f'mov %rax, {slot(i)}')
+        else:
+            out.append(f'movq $0, {slot(i)}')
+
+    pos2labels = dict()
+    for label, pos in enumerate(func.labels):
+        if pos is not None:
+            pos2labels.setdefault(pos, []).append(label)
+
+    def label_name(label):
+        return f'.Lf{idx}_{label}'
+
+    for pos in range(len(func.code) + 1):
+        for label in pos2labels.get(pos, []):
+            out.append(label_name(label) + ':')
+        if pos == len(func.code):
+            break
+        instr = func.code[pos]
+        op = instr[0]
+        if op == 'const':
+            _, val, dst = instr
+            if not isinstance(val, int):
+                raise ValueError(f"Constant {val!r} is not supported by the asm backend")
+            val = (int(val) + (1 << 63)) % (1 << 64) - (1 << 63)
+            out.append(f'movabs ${val}, %rax')
+            out.append(f'mov %rax, {slot(dst)}')
+        elif op == 'mov':
+            _, src, dst = instr
+            out.append(f'mov {slot(src)}, %rax')
+            out.append(f'mov %rax, {slot(dst)}')
+        elif op in ('binop', 'binop8'):
+            _, name, a1, a2, dst = instr
+            asm_binop(out, name, a1, slot(a2), dst, op == 'binop8')
+        elif op == 'binopi':
+            _, name, a1, imm, dst = instr
+            rhs = asm_imm(out, imm)
+            asm_binop(out, name, a1, rhs, dst, False)
+        elif op in ('unop', 'unop8'):
+            _, name, a1, dst = instr
+            out.append(f'mov {slot(a1)}, %rax')
+            if name == '-':
+                out.append('neg %rax')
+            else:
+                out.append('test %rax, %rax')
+                out.append('sete %al')
+                out.append('movzbl %al, %eax')
+            if op == 'unop8':
+                out.append('movzbl %al, %eax')
+            out.append(f'mov %rax, {slot(dst)}')
+        elif op == 'jmpf':
+            _, var, label = instr
+            out.append(f'cmpq $0, {slot(var)}')
+            out.append(f'je {label_name(label)}')
+        elif op in ('jmpf_cmp', 'jmpf_cmpi'):
+            _, name, a1, a2, label = instr
+            rhs = asm_imm(out, a2) if op == 'jmpf_cmpi' else slot(a2)
+            out.append(f'mov {slot(a1)}, %rax')
+            out.append(f'cmp {rhs}, %rax')
+            out.append(f'{ASM_JCC_NOT[name]} {label_name(label)}')
+        elif op == 'jmp':
+            out.append(f'jmp {label_name(instr[1])}')
+        elif op == 'call':
+            _, target, start, _, _ = instr
+            callee = funcs[target]
+            for i in reversed(range(callee.nargs)):
+                out.append(f'pushq {slot(start + i)}')
+            asm_link(out, func.level - (callee.level - 1), '%r10')
+            out.append(f'call func{target}')
+            if callee.nargs:
+                out.append(f'add ${8 * callee.nargs}, %rsp')
+            out.append(f'mov %rax, {slot(start)}')
+        elif op == 'ret':
+            if instr[1] >= 0:
+                out.append(f'mov {slot(instr[1])}, %rax')
+            else:
+                out.append('xor %eax, %eax')
+            out.append('leave')
+            out.append('ret')
+        elif op == 'alloc':
+            _, width, n, dst = instr
+            out.append(f'mov {slot(n)}, %rdi')
+            out.append(f'imul ${width}, %rdi')
+            out.append('call pl_alloc')
+            out.append(f'mov %rax, {slot(dst)}')
+        elif op == 'load':
+            _, width, ptr, dst = instr
+            out.append(f'mov {slot(ptr)}, %rax')
+            out.append('mov (%rax), %rax' if width == 8 else 'movzbl (%rax), %eax')
+            out.append(f'mov %rax, {slot(dst)}')
+        elif op == 'store':
+            _, width, ptr, src = instr
+            out.append(f'mov {slot(ptr)}, %rax')
+            out.append(f'mov {slot(src)}, %rcx')
+            out.append('mov %rcx, (%rax)' if width == 8 else 'mov %cl, (%rax)')
+        elif op == 'ptradd':
+            _, scale, ptr, index, dst = instr
+            out.append(f'mov {slot(index)}, %rax')
+            out.append(f'imul ${scale}, %rax')
+            out.append(f'add {slot(ptr)}, %rax')
+            out.append(f'mov %rax, {slot(dst)}')
+        elif op == 'get_env':
+            _, level, var, dst = instr
+            asm_link(out, func.level - level, '%rcx')
+            out.append(f'mov {-8 * (var + 2)}(%rcx), %rax')
+            out.append(f'mov %rax, {slot(dst)}')
+        elif op == 'set_env':
+            _, level, var, src = instr
+            asm_link(out, func.level - level, '%rcx')
+            out.append(f'mov {slot(src)}, %rax')
+            out.append(f'mov %rax, {-8 * (var + 2)}(%rcx)')
+        else:
+            raise ValueError(f"Unknown instruction {op}")
+
+    lines = [f'func{idx}:']
+    for line in out:
+        lines.append(line if line.endswith(':') else '    ' + line)
+    return '\n'.join(lines)
+
+def pl_compile_asm(root: Func):
+    out = [RUNTIME]
+    for idx, func in enumerate(root.funcs):
+        out.append(asm_func(func, idx, root.funcs))
+        out.append('')
+    return '\n'.join(out)
+
+def pl_build_asm(source, exe):
+    with tempfile.TemporaryDirectory() as tmp:
+        obj = os.path.join(tmp, 'prog.o')
+        subprocess.run(['as', '--64', '-o', obj, '-'], input=source, text=True, check=True)
+        subprocess.run(['ld', '-o', exe, obj], check=True)
@@ -0,0 +1,70 @@
+import contextlib
+import glob
+import io
+import multiprocessing
+import os
+import signal
+import time
+from server import Timeout, on_alarm, run_request
+
+# Runs many programs over a process pool. Workers are forked once and
+# keep their imports and the in-memory caches of server.py for the whole
+# batch; each file runs in a fresh global environment with its output
+# captured and a wall clock limit enforced with SIGALRM.
+
+def expand(patterns):
+    # Directories are searched for .pl_lang files, anything else is a
+    # glob; each file appears once, in the order first found.
+    files = dict()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '**', '*.pl_lang')
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            if os.path.isfile(path):
+                files.setdefault(os.path.abspath(path))
+    return list(files)
+
+def run_file(job):
+    path, engine, optimize, timeout = job
+    out = io.StringIO()
+    report = {'file': path}
+    signal.signal(signal.SIGALRM, on_alarm)
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(out):
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+            try:
+                result = run_request({'file': path, 'engine': engine, 'optimize': optimize})
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        if not isinstance(result, (int, float, str, bool, type(None))):
+            result = repr(result)
+        report['status'] = 'ok'
+        report['result'] = result
+    except Timeout:
+        report['status'] = 'timeout'
+    except Exception as e:
+        report['status'] = 'error'
+        report['error'] = str(e)
+    report['seconds'] = time.perf_counter() - start
+    report['output'] = out.getvalue()
+    return report
+
+def pl_batch(patterns, engine='interpret', optimize=False, workers=None, timeout=10.0):
+    files = expand(patterns)
+    jobs = [(path, engine, optimize, timeout) for path in files]
+    start = time.perf_counter()
+    with multiprocessing.Pool(workers or os.cpu_count() or 1) as pool:
+        reports = list(pool.imap_unordered(run_file, jobs))
+    order = {path: i for i, path in enumerate(files)}
+    reports.sort(key=lambda r: order[r['file']])
+    counts = {status: 0 for status in ('ok', 'error', 'timeout')}
+    for report in reports:
+        counts[report['status']] += 1
+    return {
+        'files': reports,
+        'total': len(reports),
+        **counts,
+        'seconds': time.perf_counter() - start,
+        'file_seconds': sum(r['seconds'] for r in reports),
+    }
@@ -0,0 +1,187 @@
+import hashlib
+import marshal
+import os
+from func import Func
+from nodes import NodeTable, pl_intern
+from parser import pl_parse_prog
+from stats import timed
+
+# Content-addressed cache of front end results, like __pycache__ for pl
+# programs. An entry is keyed by the SHA-256 of the source text, of what
+# was computed from it and of the front end's own source files, so any
+# change to the compiler invalidates every entry. Entries are marshalled
+# into one file each; reading one bumps its mtime, and once the directory
+# grows past CACHE_LIMIT bytes the least recently used entries go first.
+# Stores keep a running total of the bytes written in USAGE, so that
+# the directory is only listed once that total passes the limit; the
+# listing then puts the true total back. Processes that store at once
+# may lose each other's updates, which only delays an eviction.
+#
+# The compiler and optimizer are imported only on a miss, so a warm run
+# never loads them.
+
+CACHE_LIMIT = int(os.environ.get('PL_CACHE_SIZE', 64 << 20))
+
+USAGE = '.usage'
+
+# Every module this one imports, directly or not: the optimizer folds
+# constants with the VM's operators, for one.
+FRONT_END = ('parser.py', 'compiler.py', 'func.py', 'scope.py', 'utils.py',
+             'optimizer.py', 'vm.py', 'heap.py', 'nodes.py', 'stats.py',
+             'cache.py')
+
+_version = None
+
+def cache_dir():
+    path = os.environ.get('PL_CACHE_DIR')
+    if not path:
+        path = os.path.join(os.path.expanduser('~'), '.cache', 'pl_tools')
+    return path
+
+def front_end_version():
+    global _version
+    if _version is None:
+        h = hashlib.sha256()
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in FRONT_END:
+            with open(os.path.join(here, name), 'rb') as f:
+                h.update(f.read())
+        _version = h.hexdigest()
+    return _version
+
+def cache_key(kind, source):
+    h = hashlib.sha256()
+    h.update(front_end_version().encode())
+    h.update(kind.encode())
+    h.update(source.encode())
+    return h.hexdigest()
+
+def cache_load(key):
+    path = os.path.join(cache_dir(), key)
+    try:
+        with open(path, 'rb') as f:
+            value = marshal.load(f)
+        os.utime(path)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return value
+
+def cache_store(key, value):
+    path = cache_dir()
+    try:
+        os.makedirs(path, exist_ok=True)
+        data = marshal.dumps(value)
+        tmp = os.path.join(path, f'.{key}.{os.getpid()}')
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(path, key))
+        total = cache_usage(path)
+        if total is None or total + len(data) > CACHE_LIMIT:
+            total = cache_evict(path, CACHE_LIMIT)
+        else:
+            total += len(data)
+        with open(os.path.join(path, USAGE), 'w') as f:
+            f.write(str(total))
+    except (OSError, ValueError):
+        # Unwritable directories and IR too deep for marshal are simply
+        # not cached.
+        pass
+
+def cache_usage(path):
+    # The running total of USAGE, or None if it is missing or garbled.
+    try:
+        with open(os.path.join(path, USAGE)) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+def cache_evict(path, limit):
+    # Removes the least recently used entries until at most limit bytes
+    # are left, and returns how many are.
+    entries = []
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file() and not entry.name.startswith('.'):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+    entries.sort()
+    for _, size, name in entries:
+        if total <= limit:
+            break
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+        total -= size
+    return total
+
+def func_dump(root: Func):
+    index = {id(func): i for i, func in enumerate(root.funcs)}
+    return [(index.get(id(func.prev), -1), func.name, func.rtype, func.nargs,
+             func.nvar, func.max_stack, func.code, func.labels)
+            for func in root.funcs]
+
+def func_load(data):
+    root = Func(None)
+    for prev, name, rtype, nargs, nvar, max_stack, code, labels in data:
+        func = Func(root.funcs[prev] if prev >= 0 else root)
+        func.name = name
+        func.rtype = rtype
+        func.nargs = nargs
+        func.nvar = nvar
+        func.max_stack = max_stack
+        func.code = code
+        func.labels = labels
+        root.funcs.append(func)
+    return root
+
+def pl_load_prog(source, use_cache=True, stats=None, shared=True):
+    # pl_parse_prog, served from the cache when possible. The AST is
+    # stored as a node table, which is flat and hash-consed, and comes
+    # back with identical subtrees shared unless shared is False.
+    if stats:
+        stats.count('lines', source.count('\n') + 1)
+    key = cache_key('prog', source)
+    with timed(stats, 'cache'):
+        entry = cache_load(key) if use_cache else None
+        if entry is not None:
+            root, data = entry
+            table = NodeTable.load(data)
+            return table.to_list(root) if shared else table.to_tree(root)
+    with timed(stats, 'parse'):
+        ast = pl_parse_prog(source)
+    if use_cache:
+        with timed(stats, 'store'):
+            table, root = pl_intern(ast)
+            cache_store(key, (root, table.dump()))
+    return ast
+
+def pl_load_ir(source, optimize=False, use_cache=True, stats=None):
+    # The compiled Func tree and, with optimize, the optimizer's stats.
+    # Phase times and sizes go to stats, a PhaseTimes, if given.
+    key = cache_key('ir-O' if optimize else 'ir', source)
+    with timed(stats, 'cache'):
+        entry = cache_load(key) if use_cache else None
+    if entry is not None:
+        data, counts = entry
+        root = func_load(data)
+    else:
+        from compiler import pl_comp_main
+        from optimizer import pl_optimize
+        ast = pl_load_prog(source, use_cache, stats)
+        root = Func(None)
+        with timed(stats, 'compile'):
+            pl_comp_main(root, ['def', ['main', 'int'], [], ast])
+        counts = None
+        if optimize:
+            with timed(stats, 'optimize'):
+                counts = pl_optimize(root)
+        if use_cache:
+            with timed(stats, 'store'):
+                cache_store(key, (func_dump(root), counts))
+    if stats:
+        stats.count('lines', source.count('\n') + 1)
+        stats.count('functions', len(root.funcs))
+        stats.count('instructions', sum(len(func.code) for func in root.funcs))
+    return root, counts
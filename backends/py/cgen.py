@@ -0,0 +1,195 @@
+import os
+import subprocess
+from func import Func
+
+# Lowers the IR to C, one C function per Func. Slots are an int64_t array
+# on the C stack, and byte ops cast through uint8_t. Every frame carries
+# a static link to the frame of the enclosing function, which get_env and
+# set_env follow outwards. Arithmetic wraps like the machine does instead
+# of growing like Python ints. Pointers are plain addresses kept in
+# slots; allocated memory comes from calloc and is never freed.
+
+PRELUDE = '''\
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+
+struct frame {
+    struct frame *up;
+    int64_t *s;
+};
+
+static int64_t pl_div(int64_t a, int64_t b) {
+    if (b == 0) {
+        fprintf(stderr, "Runtime error: division by zero\\n");
+        exit(1);
+    }
+    return b == -1 ? (int64_t)(0 - (uint64_t)a) : a / b;
+}
+
+static int64_t pl_mod(int64_t a, int64_t b) {
+    if (b == 0) {
+        fprintf(stderr, "Runtime error: division by zero\\n");
+        exit(1);
+    }
+    return b == -1 ? 0 : a % b;
+}
+
+static int64_t pl_alloc(int64_t n, int64_t width) {
+    void *p = n < 0 ? NULL : calloc(n ? n : 1, width);
+    if (p == NULL) {
+        fprintf(stderr, "Runtime error: bad allocation of %lld elements\\n", (long long)n);
+        exit(1);
+    }
+    return (int64_t)(intptr_t)p;
+}
+'''
+
+MAIN = '''
+int main(void) {
+    printf("Result: %lld\\n", (long long)func0(NULL));
+    return 0;
+}
+'''
+
+C_BINOPS = {
+    '+': '(int64_t)((uint64_t){} + (uint64_t){})',
+    '-': '(int64_t)((uint64_t){} - (uint64_t){})',
+    '*': '(int64_t)((uint64_t){} * (uint64_t){})',
+    '/': 'pl_div({}, {})',
+    '%': 'pl_mod({}, {})',
+    'eq': '({} == {})',
+    'ne': '({} != {})',
+    'lt': '({} < {})',
+    'le': '({} <= {})',
+    'gt': '({} > {})',
+    'ge': '({} >= {})',
+    'and': '({} && {})',
+    'or': '({} || {})',
+}
+
+C_UNOPS = {
+    '-': '(int64_t)(0 - (uint64_t){})',
+    'not': '(!{})',
+}
+
+# The C type of a heap element, by width.
+C_ELEMS = {8: 'int64_t', 1: 'uint8_t'}
+
+def c_link(hops):
+    # The frame `hops` levels out from the current one.
+    if hops == 0:
+        return '&f'
+    return '->'.join(['up'] + ['up'] * (hops - 1))
+
+def c_const(val):
+    if not isinstance(val, int):
+        raise ValueError(f"Constant {val!r} is not supported by the C backend")
+    if val == -(1 << 63):
+        return '(-9223372036854775807 - 1)'
+    return f'{int(val)}LL'
+
+def c_signature(func: Func, idx):
+    params = ['struct frame *up']
+    params += [f'int64_t a{i}' for i in range(func.nargs)]
+    return f'static int64_t func{idx}({", ".join(params)})'
+
+def c_func(func: Func, idx, funcs):
+    size = max(func.max_stack + 1, func.nargs, 1)
+    out = [c_signature(func, idx) + ' {']
+    out.append(f'    int64_t s[{size}] = {{0}};')
+    # Only functions that pass their own frame on need one.
+    if any(instr[0] == 'call' and funcs[instr[1]].level > func.level
+           for instr in func.code):
+        out.append('    struct frame f = {up, s};')
+    for i in range(func.nargs):
+        out.append(f'    s[{i}] = a{i};')
+
+    pos2labels = dict()
+    for label, pos in enumerate(func.labels):
+        if pos is not None:
+            pos2labels.setdefault(pos, []).append(label)
+
+    for pos in range(len(func.code) + 1):
+        for label in pos2labels.get(pos, []):
+            out.append(f'L{label}: ;')
+        if pos == len(func.code):
+            break
+        instr = func.code[pos]
+        op = instr[0]
+        if op == 'const':
+            _, val, dst = instr
+            line = f's[{dst}] = {c_const(val)};'
+        elif op == 'mov':
+            _, src, dst = instr
+            line = f's[{dst}] = s[{src}];'
+        elif op in ('binop', 'binop8'):
+            _, name, a1, a2, dst = instr
+            expr = C_BINOPS[name].format(f's[{a1}]', f's[{a2}]')
+            if op == 'binop8':
+                expr = f'(uint8_t){expr}'
+            line = f's[{dst}] = {expr};'
+        elif op == 'binopi':
+            _, name, a1, imm, dst = instr
+            line = f"s[{dst}] = {C_BINOPS[name].format(f's[{a1}]', c_const(imm))};"
+        elif op in ('unop', 'unop8'):
+            _, name, a1, dst = instr
+            expr = C_UNOPS[name].format(f's[{a1}]')
+            if op == 'unop8':
+                expr = f'(uint8_t){expr}'
+            line = f's[{dst}] = {expr};'
+        elif op == 'jmpf':
+            _, var, label = instr
+            line = f'if (!s[{var}]) goto L{label};'
+        elif op in ('jmpf_cmp', 'jmpf_cmpi'):
+            _, name, a1, a2, label = instr
+            rhs = c_const(a2) if op == 'jmpf_cmpi' else f's[{a2}]'
+            line = f"if (!{C_BINOPS[name].format(f's[{a1}]', rhs)}) goto L{label};"
+        elif op == 'jmp':
+            line = f'goto L{instr[1]};'
+        elif op == 'call':
+            _, target, start, _, _ = instr
+            callee = funcs[target]
+            link = c_link(func.level - (callee.level - 1))
+            args = [link] + [f's[{start + i}]' for i in range(callee.nargs)]
+            line = f's[{start}] = func{target}({", ".join(args)});'
+        elif op == 'ret':
+            line = f'return s[{instr[1]}];' if instr[1] >= 0 else 'return 0;'
+        elif op == 'alloc':
+            _, width, n, dst = instr
+            line = f's[{dst}] = pl_alloc(s[{n}], {width});'
+        elif op == 'load':
+            _, width, ptr, dst = instr
+            line = f's[{dst}] = *({C_ELEMS[width]} *)(intptr_t)s[{ptr}];'
+        elif op == 'store':
+            _, width, ptr, src = instr
+            line = f'*({C_ELEMS[width]} *)(intptr_t)s[{ptr}] = ({C_ELEMS[width]})s[{src}];'
+        elif op == 'ptradd':
+            _, scale, ptr, index, dst = instr
+            line = f's[{dst}] = (int64_t)((uint64_t)s[{ptr}] + (uint64_t)s[{index}] * {c_const(scale)});'
+        elif op == 'get_env':
+            _, level, var, dst = instr
+            line = f's[{dst}] = {c_link(func.level - level)}->s[{var}];'
+        elif op == 'set_env':
+            _, level, var, src = instr
+            line = f'{c_link(func.level - level)}->s[{var}] = s[{src}];'
+        else:
+            raise ValueError(f"Unknown instruction {op}")
+        out.append('    ' + line)
+    out.append('}')
+    return '\n'.join(out)
+
+def pl_compile_c(root: Func):
+    out = [PRELUDE]
+    for idx, func in enumerate(root.funcs):
+        out.append(c_signature(func, idx) + ';')
+    for idx, func in enumerate(root.funcs):
+        out.append('')
+        out.append(c_func(func, idx, root.funcs))
+    out.append(MAIN)
+    return '\n'.join(out)
+
+def pl_build_c(source, exe):
+    cc = os.environ.get('CC', 'gcc')
+    subprocess.run([cc, '-O2', '-o', exe, '-x', 'c', '-'],
+                   input=source, text=True, check=True)
@@ -0,0 +1,46 @@
+import argparse
+import json
+import os
+import socket
+import sys
+
+# Runs a program on a `main.py --serve` server and prints what it prints,
+# followed by the result, the same way main.py does.
+
+def pl_request(path, req, out=sys.stdout):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        sock.connect(path)
+        sock.sendall((json.dumps(req) + '\n').encode())
+        with sock.makefile('r') as f:
+            for line in f:
+                msg = json.loads(line)
+                if 'out' in msg:
+                    out.write(msg['out'])
+                    out.flush()
+                else:
+                    return msg
+    return {'error': 'connection closed'}
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a program on a pl server')
+    parser.add_argument('socket', help='Socket of a running main.py --serve')
+    parser.add_argument('file', nargs='?', help='Program to run; read from stdin if omitted')
+    parser.add_argument('--engine', default='interpret', choices=('interpret', 'interpret-fast', 'run-ir'))
+    parser.add_argument('-O', '--optimize', action='store_true', help='With --engine run-ir, optimize the IR')
+    args = parser.parse_args()
+
+    req = {'engine': args.engine, 'optimize': args.optimize}
+    if args.file:
+        req['file'] = os.path.abspath(args.file)
+    else:
+        req['source'] = sys.stdin.read()
+    msg = pl_request(args.socket, req)
+    if 'error' in msg:
+        print(f"Runtime error: {msg['error']}")
+        sys.exit(1)
+    if msg['result'] is not None:
+        print("Result:", msg['result'])
+
+if __name__ == '__main__':
+    main()
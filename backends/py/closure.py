@@ -0,0 +1,510 @@
+import operator
+from exceptions import LoopBreak, LoopContinue, FuncReturn
+from interpreter import BINARY_OPS, UNOPS
+from fileio import FILE_OPS
+from rope import STRINGS, concat, flatten
+from memo import MISSING, memo_cache, memo_key
+
+# Compiles the AST once into nested Python closures. Names are resolved
+# ahead of time to (level, slot) pairs. Each function call gets a frame,
+# a fixed-size list, and the blocks, conditionals and loops of its body
+# get runs of slots in that frame, so entering them allocates nothing.
+# The environment is a display: a list of the current frame of every
+# function nesting level, the program's at level 0. A call sets the slot
+# of its own level and restores it on return; functions are not values,
+# so the frames below a call site are always those the callee was
+# defined in. The semantics are the same as pl_eval.
+
+# Marks a slot whose `var` or `def` has not run yet.
+UNBOUND = object()
+
+class ClosureScope:
+    def __init__(self, prev, names, func=False):
+        self.prev = prev
+        self.root = prev.root if prev else self
+        # The scope whose frame holds our slots: a function body, or the
+        # program.
+        self.owner = self if func or not prev else prev.owner
+        self.level = prev.level + func if prev else 0
+        if self.owner is self:
+            self.size = 0
+        start = self.owner.size
+        self.names = {key: start + i for i, key in enumerate(names)}
+        self.owner.size += len(self.names)
+        if prev:
+            self.root.depth = max(self.root.depth, self.level + 1)
+        else:
+            self.depth = 1
+        # The keys whose var or def has surely run, in this activation of
+        # the scope, by the point being compiled. Parameters always have.
+        self.bound = set(self.names) if func else set()
+        # Set once a reference may find one of our slots unbound at run
+        # time; entering the scope then has to clear them.
+        self.probed = False
+        # Set on the REPL's global scope, whose names come and go between
+        # inputs and so are never known to be bound.
+        self.late = False
+        self.func = func
+        # Called with a key no scope declares, to declare it somewhere
+        # and return its (level, slot). The REPL declares globals so.
+        self.fallback = prev.fallback if prev else None
+
+    def resolve(self, key):
+        # The (level, slot) of every declaration of the key a reference
+        # compiled here may reach at run time, innermost first, and
+        # whether the last one is sure to be bound by then. pl_eval runs
+        # a block in order, so a declaration is either already bound here
+        # or not bound yet and skipped, like the dict chain skips it.
+        # Only a function body, which runs later, cannot tell for the
+        # names its enclosing scopes declare after the def. A body is
+        # compiled where the def is, so what those scopes have bound
+        # while it compiles stays bound whenever it runs.
+        found = []
+        crossed = False
+        scope = self
+        while scope:
+            if key in scope.names:
+                slot = (scope.level, scope.names[key])
+                if scope.late:
+                    found.append(slot)
+                elif key in scope.bound:
+                    found.append(slot)
+                    return tuple(found), True
+                elif crossed:
+                    scope.probed = True
+                    found.append(slot)
+            crossed = crossed or scope.func
+            scope = scope.prev
+        if self.fallback and key not in self.root.names:
+            found.append(self.fallback(key))
+        return tuple(found), False
+
+    def declare(self, key):
+        # The (level, slot) a var or def of the key compiled here binds,
+        # and whether it may already be bound.
+        if key in self.names:
+            return (self.level, self.names[key]), self.late
+        if self.fallback:
+            return self.fallback(key), True
+        raise ValueError(f"Name {key} cannot be declared here")
+
+def scan_decls(node, out):
+    # Collects the keys that evaluating node declares in the current
+    # environment, stopping at nodes that open a scope of their own.
+    if not isinstance(node, list) or not node or not isinstance(node[0], str):
+        return
+    head, n = node[0], len(node)
+    if n == 3 and head in BINARY_OPS:
+        scan_decls(node[1], out)
+        scan_decls(node[2], out)
+    elif n == 2 and head in UNOPS:
+        scan_decls(node[1], out)
+    elif n in (3, 4) and head in ('?', 'if'):
+        return
+    elif head == 'print':
+        for kid in node[1:]:
+            scan_decls(kid, out)
+    elif head in ('do', 'then', 'else') and n > 1:
+        return
+    elif head == 'var':
+        if n == 3 and isinstance(node[1], str):
+            scan_decls(node[2], out)
+            out.setdefault(node[1])
+    elif head == 'set' and n == 3:
+        scan_decls(node[2], out)
+    elif head == 'def' and n == 4:
+        if isinstance(node[1], str):
+            out.setdefault((node[1], len(node[2])))
+    elif head == 'memo' and n == 2:
+        scan_decls(node[1], out)
+    elif head == 'call' and n >= 2:
+        for kid in node[2:]:
+            scan_decls(kid, out)
+    elif head == 'return' and n == 2:
+        scan_decls(node[1], out)
+    elif head in FILE_OPS and n == FILE_OPS[head][0] + 1:
+        for kid in node[1:]:
+            scan_decls(kid, out)
+
+def new_scope(cs, kids, names=(), func=False):
+    out = dict.fromkeys(names)
+    for kid in kids:
+        scan_decls(kid, out)
+    return ClosureScope(cs, out, func)
+
+def comp_clear(cs):
+    # What entering cs has to do: clear its slots if a reference may
+    # look at them before they are bound, or nothing.
+    if not (cs.probed and cs.names):
+        return None
+    level = cs.level
+    start = min(cs.names.values())
+    stop = start + len(cs.names)
+    blank = [UNBOUND] * len(cs.names)
+
+    def clear(env):
+        env[level][start:stop] = blank
+    return clear
+
+def comp_getvar(name, cs):
+    found, sure = cs.resolve(name)
+
+    if len(found) == 1:
+        (level, slot), = found
+        if sure:
+            return lambda env: env[level][slot]
+
+        def getvar(env):
+            val = env[level][slot]
+            if val is UNBOUND:
+                raise ValueError(f"Name {name} not found")
+            return val
+        return getvar
+
+    def getvar_chain(env):
+        for level, slot in found:
+            val = env[level][slot]
+            if val is not UNBOUND:
+                return val
+        raise ValueError(f"Name {name} not found")
+    return getvar_chain
+
+def lookup_frame(env, key, found):
+    for level, slot in found:
+        frame = env[level]
+        if frame[slot] is not UNBOUND:
+            return frame, slot
+    raise ValueError(f"Name {key} not found")
+
+def is_const(node):
+    return isinstance(node, list) and len(node) == 2 and node[0] == 'val'
+
+def comp_const(val):
+    return lambda env: val
+
+def comp_binop(node, cs):
+    op = BINARY_OPS[node[0]]
+    lhs = pl_compile_closure(node[1], cs)
+    rhs = pl_compile_closure(node[2], cs)
+
+    if is_const(node[2]) and not isinstance(node[2][1], str):
+        rval = node[2][1]
+
+        def binop_const(env):
+            lop = lhs(env)
+            if isinstance(lop, STRINGS):
+                if op is operator.add:
+                    return concat(lop, rval)
+                return str(op(str(lop), str(rval)))
+            return op(lop, rval)
+        return binop_const
+
+    def binop(env):
+        lop = lhs(env)
+        rop = rhs(env)
+        # Runtime type checking, same as pl_eval.
+        if isinstance(lop, STRINGS) or isinstance(rop, STRINGS):
+            if op is operator.add:
+                return concat(lop, rop)
+            return str(op(str(lop), str(rop)))
+        return op(lop, rop)
+    return binop
+
+def comp_unop(node, cs):
+    op = UNOPS[node[0]]
+    arg = pl_compile_closure(node[1], cs)
+    return lambda env: op(arg(env))
+
+def comp_cond(node, cs):
+    _, cond, yes, *no = node
+    no = no[0] if no else ['val', None]
+    inner = new_scope(cs, (cond, yes, no))
+    cond = pl_compile_closure(cond, inner)
+    # Only one branch runs, so neither binds anything for the other.
+    bound = set(inner.bound)
+    yes = pl_compile_closure(yes, inner)
+    inner.bound = bound
+    no = pl_compile_closure(no, inner)
+    clear = comp_clear(inner)
+
+    def ifelse(env):
+        if clear is not None:
+            clear(env)
+        if cond(env):
+            return yes(env)
+        else:
+            return no(env)
+    return ifelse
+
+def comp_print(node, cs):
+    args = [pl_compile_closure(kid, cs) for kid in node[1:]]
+    return lambda env: print(*(arg(env) for arg in args))
+
+def comp_scope(node, cs):
+    inner = new_scope(cs, node[1:])
+    *init, last = [pl_compile_closure(kid, inner) for kid in node[1:]]
+    clear = comp_clear(inner)
+
+    def scope(env):
+        if clear is not None:
+            clear(env)
+        for kid in init:
+            kid(env)
+        return last(env)
+    return scope
+
+def comp_newvar(node, cs):
+    _, name, val = node
+    if not isinstance(name, str):
+        return comp_fail("invalid variable name")
+    (level, slot), late = cs.declare(name)
+    if not late and name in cs.bound:
+        return comp_fail(f"Name {name} already defined")
+    val = pl_compile_closure(val, cs)
+    cs.bound.add(name)
+
+    if late:
+        def newvar_late(env):
+            frame = env[level]
+            if frame[slot] is not UNBOUND:
+                raise ValueError(f"Name {name} already defined")
+            frame[slot] = ret = val(env)
+            return ret
+        return newvar_late
+
+    def newvar(env):
+        env[level][slot] = ret = val(env)
+        return ret
+    return newvar
+
+def comp_setvar(node, cs):
+    _, name, val = node
+    found, sure = cs.resolve(name)
+    val = pl_compile_closure(val, cs)
+
+    if sure and len(found) == 1:
+        (level, slot), = found
+
+        def setvar(env):
+            env[level][slot] = ret = val(env)
+            return ret
+        return setvar
+
+    def setvar_chain(env):
+        frame, slot = lookup_frame(env, name, found)
+        frame[slot] = ret = val(env)
+        return ret
+    return setvar_chain
+
+def comp_loop(node, cs):
+    _, cond, body = node
+    inner = new_scope(cs, (cond, body))
+    cond = pl_compile_closure(cond, inner)
+    body = pl_compile_closure(body, inner)
+    # Every iteration is a new activation of the same slots.
+    clear = comp_clear(inner)
+
+    def loop(env):
+        ret = None
+        while True:
+            if clear is not None:
+                clear(env)
+            if not cond(env):
+                break
+            try:
+                ret = body(env)
+            except LoopBreak:
+                break
+            except LoopContinue:
+                continue
+        return ret
+    return loop
+
+def comp_func(node, cs, memoized=False):
+    _, name, args, body = node
+    for arg_name in args:
+        if not isinstance(arg_name, str):
+            return comp_fail("invalid argument name")
+    if len(args) != len(set(args)):
+        return comp_fail("duplicate argument name")
+    if not isinstance(name, str):
+        return comp_fail("invalid function name")
+    key = (name, len(args))
+    (level, slot), late = cs.declare(key)
+    if not late and key in cs.bound:
+        return comp_fail("function already defined")
+    # Bound before the body is compiled: the body only runs once the def
+    # has, so recursive calls need no check.
+    cs.bound.add(key)
+    inner = new_scope(cs, (body,), args, func=True)
+    body = pl_compile_closure(body, inner)
+    pad = [UNBOUND] * (inner.size - len(args))
+    flevel = inner.level
+
+    def func(env):
+        frame = env[level]
+        if late and frame[slot] is not UNBOUND:
+            raise ValueError("function already defined")
+        # Like pl_eval, every function made from a memo def has a cache
+        # of its own.
+        frame[slot] = (body, pad, flevel, memo_cache(key) if memoized else None)
+    return func
+
+def comp_call(node, cs):
+    _, name, *args = node
+    key = (name, len(args))
+    found, sure = cs.resolve(key)
+    args = [pl_compile_closure(kid, cs) for kid in args]
+
+    if not (sure and len(found) == 1):
+        def call_chain(env):
+            frame, slot = lookup_frame(env, key, found)
+            return run_func(env, frame[slot], [arg(env) for arg in args])
+        return call_chain
+
+    (level, slot), = found
+
+    def call(env):
+        fbody, pad, flevel, memo = func = env[level][slot]
+        frame = [arg(env) for arg in args]
+        if memo is not None:
+            return run_func(env, func, frame)
+        if pad:
+            frame += pad
+        saved = env[flevel]
+        env[flevel] = frame
+        try:
+            return fbody(env)
+        except FuncReturn as ret:
+            return ret.val
+        finally:
+            env[flevel] = saved
+    return call
+
+def run_func(env, func, frame):
+    # call() for a memo function, or one reached through a chain.
+    fbody, pad, flevel, memo = func
+    if memo is not None:
+        args_key = memo_key(frame)
+        val = memo.get(args_key)
+        if val is MISSING:
+            val = run_func(env, func[:3] + (None,), frame)
+            memo.put(args_key, val)
+        return val
+    if pad:
+        frame += pad
+    saved = env[flevel]
+    env[flevel] = frame
+    try:
+        return fbody(env)
+    except FuncReturn as ret:
+        return ret.val
+    finally:
+        env[flevel] = saved
+
+def comp_file(node, cs):
+    fn = FILE_OPS[node[0]][1]
+    args = [pl_compile_closure(kid, cs) for kid in node[1:]]
+    if len(args) == 1:
+        arg, = args
+        return lambda env: fn(flatten(arg(env)))
+    return lambda env: fn(*[flatten(arg(env)) for arg in args])
+
+def comp_fail(msg):
+    # Malformed nodes only fail when they are reached, like in pl_eval.
+    def fail(env):
+        raise ValueError(msg)
+    return fail
+
+def comp_raise(exc):
+    def throw(env):
+        raise exc()
+    return throw
+
+def comp_return(node, cs):
+    if len(node) == 1:
+        return comp_raise(lambda: FuncReturn(None))
+    val = pl_compile_closure(node[1], cs)
+
+    def ret(env):
+        raise FuncReturn(val(env))
+    return ret
+
+def pl_compile_closure(node, cs):
+    if not isinstance(node, list):
+        assert isinstance(node, str)
+        return comp_getvar(node, cs)
+
+    if len(node) == 0:
+        return comp_fail("Empty list")
+
+    if not isinstance(node[0], str):
+        return comp_fail("Invalid node")
+
+    # Same dispatch order as pl_eval, but taken once per node.
+    if len(node) == 3 and node[0] in BINARY_OPS:
+        return comp_binop(node, cs)
+
+    if len(node) == 2 and node[0] in UNOPS:
+        return comp_unop(node, cs)
+
+    if len(node) in (3, 4) and node[0] in ('?', 'if'):
+        return comp_cond(node, cs)
+
+    if node[0] == 'print':
+        return comp_print(node, cs)
+
+    if node[0] in ('do', 'then', 'else') and len(node) > 1:
+        return comp_scope(node, cs)
+
+    if node[0] == 'var':
+        return comp_newvar(node, cs)
+
+    if node[0] == 'set' and len(node) == 3:
+        return comp_setvar(node, cs)
+
+    if node[0] == 'loop' and len(node) == 3:
+        return comp_loop(node, cs)
+
+    if node[0] == 'def' and len(node) == 4:
+        return comp_func(node, cs)
+
+    if node[0] == 'memo' and len(node) == 2:
+        kid = node[1]
+        if not (isinstance(kid, list) and len(kid) == 4 and kid[0] == 'def'):
+            return comp_fail("memo expects a def")
+        return comp_func(kid, cs, True)
+
+    if node[0] == 'call' and len(node) >= 2:
+        return comp_call(node, cs)
+
+    if node[0] in FILE_OPS and len(node) == FILE_OPS[node[0]][0] + 1:
+        return comp_file(node, cs)
+
+    if node[0] == 'break' and len(node) == 1:
+        return comp_raise(LoopBreak)
+
+    if node[0] == 'continue' and len(node) == 1:
+        return comp_raise(LoopContinue)
+
+    if node[0] == 'return' and len(node) in (1, 2):
+        return comp_return(node, cs)
+
+    if len(node) == 2:
+        return comp_const(node[1])
+
+    return comp_fail("Invalid node")
+
+def pl_compile_prog(node):
+    # A whole program as a function of no arguments that runs it.
+    root = new_scope(None, (node,))
+    code = pl_compile_closure(node, root)
+
+    def run():
+        env = [None] * root.depth
+        env[0] = [UNBOUND] * root.size
+        return code(env)
+    return run
+
+def pl_eval_fast(node):
+    return pl_compile_prog(node)()
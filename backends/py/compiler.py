@@ -1,5 +1,16 @@
 from func import Func
-from utils import move_to, validate_type, scope_get_var
+from heap import WIDTHS
+from utils import move_to, validate_type
+
+COMPARISONS = {'eq', 'ne', 'lt', 'le', 'gt', 'ge'}
+
+BINOPS = {'%', '*', '/', '+', '-', 'and', 'or'} | COMPARISONS
+
+# The op that gives the same result with its operands swapped.
+SWAPPED = {
+    '+': '+', '*': '*', 'and': 'and', 'or': 'or', 'eq': 'eq', 'ne': 'ne',
+    'lt': 'gt', 'gt': 'lt', 'le': 'ge', 'ge': 'le',
+}
 
 def pl_comp_call(fenv: Func, node):
     _, name, *args = node
@@ -38,11 +49,7 @@ def pl_comp_cond(fenv: Func, node):
     l_false = fenv.new_label()
     fenv.scope_enter()
 
-    tp, var = pl_comp_expr(fenv, cond, allow_var=True)
-    if tp == ('void',):
-        raise ValueError("expected boolean condition")
-    
-    fenv.code.append(('jmpf', var, l_false))
+    pl_comp_branch(fenv, cond, l_false)
 
     t1, a1 = pl_comp_expr(fenv, yes)
     if a1 >= 0:
@@ -65,6 +72,21 @@ def pl_comp_cond(fenv: Func, node):
     else:
         return t1, fenv.tmp()
     
+def pl_comp_branch(fenv: Func, cond, label):
+    # Jumps to label unless cond holds. A comparison is fused into the
+    # branch instead of going through a 0/1 temporary.
+    if isinstance(cond, list) and len(cond) == 3 and cond[0] in COMPARISONS:
+        save = fenv.stack
+        op, _, _, a1, a2, imm = pl_comp_operands(fenv, cond)
+        fenv.stack = save
+        fenv.code.append(('jmpf_cmpi' if imm else 'jmpf_cmp', op, a1, a2, label))
+        return
+
+    tp, var = pl_comp_expr(fenv, cond, allow_var=True)
+    if tp == ('void',) or var < 0:
+        raise ValueError("expected boolean condition")
+    fenv.code.append(('jmpf', var, label))
+
 def pl_comp_loop(fenv: Func, node):
     _, cond, body = node
     fenv.scope.loop_start = fenv.new_label()
@@ -73,10 +95,7 @@ def pl_comp_loop(fenv: Func, node):
     fenv.scope_enter()
     fenv.set_label(fenv.scope.loop_start)
 
-    _, var = pl_comp_expr(fenv, cond, allow_var=True)
-    if var < 0:
-        raise ValueError("bad loop condition")
-    fenv.code.append(('jmpf', var, fenv.scope.loop_end))
+    pl_comp_branch(fenv, cond, fenv.scope.loop_end)
 
     _, _ = pl_comp_expr(fenv, body)
     fenv.code.append(('jmp', fenv.scope.loop_start))
@@ -94,56 +113,27 @@ def pl_comp_expr_tmp(fenv: Func, node, *, allow_var=False):
     
     if len(node) == 0:
         raise ValueError("Empty list")
-    
-    if len(node) == 2 and node[0] in ('val', 'val8', 'str'):
-        return pl_comp_const(fenv, node)
-    
-    binops = { 
-        '%', '*', '/', '+', '-', 
-        'eq', 'ne', 'lt', 'le', 'gt', 'ge', 
-        'and', 'or' 
-    }
-
-    if len(node) == 3 and node[0] in binops:
-        return pl_comp_binop(fenv, node)
-    
-    if len(node) == 2 and node[0] in {'-', 'not'}:
-        return pl_comp_unop(fenv, node)
 
-    if node[0] in ('do', 'then', 'else'):
-        return pl_comp_scope(fenv, node)
-    
-    if node[0] == 'var' and len(node) == 3:
-        if not allow_var:
-            raise ValueError("var is not allowed")
-        return pl_comp_newvar(fenv, node)
-    
-    if node[0] == 'set' and len(node) == 3:
-        return pl_comp_setvar(fenv, node)
-    
-    if len(node) in (3, 4) and node[0] in ('?', 'if'):
-        return pl_comp_cond(fenv, node)
-    
-    if node[0] == 'loop' and len(node) == 3:
-        return pl_comp_loop(fenv, node)
+    form = None
+    if isinstance(node[0], str):
+        form = FORMS.get((node[0], len(node))) or FORMS.get(node[0])
+    if form is None:
+        raise ValueError("Invalid node")
+    if form is pl_comp_newvar and not allow_var:
+        raise ValueError("var is not allowed")
+    return form(fenv, node)
+
+def pl_comp_break(fenv: Func, node):
+    if fenv.scope.loop_end < 0:
+        raise ValueError("break is outside loop")
+    fenv.code.append(('jmp', fenv.scope.loop_end))
+    return ('void',), -1
 
-    if node == ['break']:
-        if fenv.scope.loop_end < 0:
-            raise ValueError("break is outside loop")
-        fenv.code.append(('jmp', fenv.scope.loop_end))
-        return ('void',), -1
-    
-    if node == ['continue']:
-        if fenv.scope.loop_start < 0:
-            raise ValueError("continue is outside loop")
-        fenv.code.append(('jmp', fenv.scope.loop_start))
-        return ('void',), -1
-    
-    if node[0] == 'call' and len(node) >= 2:
-        return pl_comp_call(fenv, node)
-    
-    if node[0] == 'return' and len(node) in (1, 2):
-        return pl_comp_return(fenv, node)
+def pl_comp_continue(fenv: Func, node):
+    if fenv.scope.loop_start < 0:
+        raise ValueError("continue is outside loop")
+    fenv.code.append(('jmp', fenv.scope.loop_start))
+    return ('void',), -1
     
 def pl_comp_newvar(fenv: Func, node):
     _, name, kid = node
@@ -156,6 +146,9 @@ def pl_comp_newvar(fenv: Func, node):
 def pl_comp_const(fenv: Func, node):
     _, kid = node
     assert isinstance(kid, (int, str))
+    # Ints are 64-bit words here; strings only exist untyped.
+    if node[0] != 'str' and not isinstance(kid, int):
+        raise ValueError(f"{kid!r} is not an int")
     dst = fenv.tmp()
     fenv.code.append(('const', kid, dst))
     tp = dict(val='int', val8='byte', str='ptr byte')[node[0]]
@@ -201,10 +194,10 @@ def pl_comp_scope(fenv: Func, node):
             for kid in g if kid[0] == 'def' and len(kid) == 4
         ]
 
+        funcs = iter(funcs)
         for kid in g:
             if kid[0] == 'def' and len(kid) == 4:
-                target, *funcs = funcs
-                tp, var = pl_comp_func(target, kid)
+                tp, var = pl_comp_func(next(funcs), kid)
             else:
                 tp, var = pl_comp_expr(fenv, kid, allow_var=True)
     fenv.scope_leave()
@@ -213,33 +206,134 @@ def pl_comp_scope(fenv: Func, node):
         var = move_to(fenv, var, fenv.tmp())
     return tp, var
 
-def pl_comp_binop(fenv: Func, node):
+def is_imm(node):
+    return (isinstance(node, list) and len(node) == 2 and node[0] == 'val'
+            and isinstance(node[1], int))
+
+def pl_comp_operands(fenv: Func, node):
+    # Computes the operands of a binop and returns (op, type, a1, a2,
+    # imm). When imm is set, a2 is an int constant rather than a slot;
+    # a constant on the left of a commutative op or a comparison is
+    # moved to the right for that.
     op, lhs, rhs = node
+    if is_imm(lhs) and not is_imm(rhs) and op in SWAPPED:
+        op, lhs, rhs = SWAPPED[op], rhs, lhs
 
-    save = fenv.stack
     t1, a1 = pl_comp_expr_tmp(fenv, lhs)
-    t2, a2 = pl_comp_expr_tmp(fenv, rhs)
-    fenv.stack = save
+    imm = is_imm(rhs)
+    if imm:
+        t2, a2 = ('int',), rhs[1]
+    else:
+        t2, a2 = pl_comp_expr_tmp(fenv, rhs)
 
     if 'ptr' in (t1[0], t2[0]):
-        raise NotImplementedError("Pointers")
-    
-    if not (t1 == t2 and t1[0] in ('int', 'byte')):
+        pointer_type(op, t1, t2)
+    elif not (t1 == t2 and t1[0] in ('int', 'byte')):
         raise ValueError(f"Type mismatch: {t1} != {t2}")
+    return op, t1, t2, a1, a2, imm
+
+def pointer_type(op, t1, t2):
+    # The result of a binop on a pointer: like pointers compare and
+    # subtract to a distance, and an int moves a pointer either way.
+    if t1 == t2 and op in COMPARISONS | {'-'}:
+        return ('int',)
+    if op in ('+', '-') and t1[0] == 'ptr' and t2 == ('int',):
+        return t1
+    if op == '+' and t1 == ('int',) and t2[0] == 'ptr':
+        return t2
+    raise ValueError(f"Type mismatch: {t1} != {t2}")
+
+def pl_comp_ptrop(fenv: Func, op, t1, t2, a1, a2, imm):
+    # Pointer arithmetic counts elements; the IR counts bytes.
+    if t1[0] != 'ptr':
+        t1, t2, a1, a2 = t2, t1, a2, a1
+    width = WIDTHS[t1[1]]
+    dst = fenv.tmp()
+    if t1 == t2:
+        fenv.code.append(('binop', '-', a1, a2, dst))
+        if width > 1:
+            fenv.code.append(('binopi', '/', dst, width, dst))
+        return ('int',), dst
+    scale = width if op == '+' else -width
+    if imm:
+        fenv.code.append(('binopi', '+', a1, a2 * scale, dst))
+    else:
+        fenv.code.append(('ptradd', scale, a1, a2, dst))
+    return t1, dst
+
+def pl_comp_binop(fenv: Func, node):
+    save = fenv.stack
+    op, t1, t2, a1, a2, imm = pl_comp_operands(fenv, node)
+    fenv.stack = save
+
+    if 'ptr' in (t1[0], t2[0]) and op not in COMPARISONS:
+        return pl_comp_ptrop(fenv, op, t1, t2, a1, a2, imm)
 
     rtype = t1
-    if op in { 'eq', 'ge', 'gt', 'le', 'ne', 'lt' }:
+    if op in COMPARISONS:
         rtype = ('int',)
 
-    suffix = ''
-
-    if t1 == t2 and t1 == ('byte',):
-        suffix = '8'
+    name = 'binopi' if imm else 'binop'
+    if t1 == ('byte',):
+        name = 'binop8'
 
     dst = fenv.tmp()
-    fenv.code.append(('binop' + suffix, op, a1, a2, dst))
+    fenv.code.append((name, op, a1, a2, dst))
     return rtype, dst
 
+def pl_comp_alloc(fenv: Func, node):
+    _, elem, count = node
+    if elem not in WIDTHS:
+        raise ValueError(f"Cannot allocate {elem}")
+    save = fenv.stack
+    tp, var = pl_comp_expr_tmp(fenv, count)
+    fenv.stack = save
+    if tp != ('int',):
+        raise ValueError(f"Type mismatch: {tp} != ('int',)")
+    dst = fenv.tmp()
+    fenv.code.append(('alloc', WIDTHS[elem], var, dst))
+    return ('ptr', elem), dst
+
+def pl_comp_address(fenv: Func, ptr, index):
+    # The type of ptr and a slot holding the address of element index.
+    tp, var = pl_comp_expr_tmp(fenv, ptr)
+    if tp[0] != 'ptr':
+        raise ValueError(f"Not a pointer: {tp}")
+    if index is None:
+        return tp, var
+    t2, a2 = ('int',), None
+    if not is_imm(index):
+        t2, a2 = pl_comp_expr_tmp(fenv, index)
+    if t2 != ('int',):
+        raise ValueError(f"Type mismatch: {t2} != ('int',)")
+    dst = fenv.tmp()
+    if a2 is None:
+        fenv.code.append(('binopi', '+', var, index[1] * WIDTHS[tp[1]], dst))
+    else:
+        fenv.code.append(('ptradd', WIDTHS[tp[1]], var, a2, dst))
+    return tp, dst
+
+def pl_comp_load(fenv: Func, node):
+    _, ptr, *index = node
+    save = fenv.stack
+    tp, var = pl_comp_address(fenv, ptr, index[0] if index else None)
+    fenv.stack = save
+    dst = fenv.tmp()
+    fenv.code.append(('load', WIDTHS[tp[1]], var, dst))
+    return tp[1:], dst
+
+def pl_comp_store(fenv: Func, node):
+    _, ptr, *index, value = node
+    save = fenv.stack
+    tp, var = pl_comp_address(fenv, ptr, index[0] if index else None)
+    t2, a2 = pl_comp_expr_tmp(fenv, value)
+    fenv.stack = save
+    # An int stored through a byte pointer keeps its low 8 bits.
+    if t2 != tp[1:] and not (tp == ('ptr', 'byte') and t2 == ('int',)):
+        raise ValueError(f"Type mismatch: {tp[1:]} != {t2}")
+    fenv.code.append(('store', WIDTHS[tp[1]], var, a2))
+    return ('void',), -1
+
 def pl_comp_unop(fenv: Func, node):
     op, arg = node
     t1, a1 = pl_comp_expr(fenv, arg)
@@ -291,8 +385,9 @@ def pl_scan_func(fenv: Func, node):
     key = (name, arg_type_list)
     if key in fenv.scope.names:
         raise ValueError(f"Function {name} already defined")
-    fenv.scope.names[key] = (rtype, len(fenv.funcs))
+    fenv.declare(key, rtype, len(fenv.funcs))
     func = Func(fenv)
+    func.name = name
     func.rtype = rtype
     fenv.funcs.append(func)
     return func
@@ -308,6 +403,7 @@ def pl_comp_func(fenv: Func, node):
             raise ValueError(f"{arg_type} is not allowed")
         fenv.add_var(arg_name, arg_type)
     assert fenv.stack == len(args)
+    fenv.nargs = len(args)
 
     body_type, var = pl_comp_expr(fenv, body)
     if fenv.rtype != ('void',) and fenv.rtype != body_type:
@@ -315,9 +411,39 @@ def pl_comp_func(fenv: Func, node):
     if fenv.rtype == ('void',):
         var = -1
     fenv.code.append(('ret', var))
+    fenv.undeclare(fenv.scope)
     return ('void',), -1
 
 def pl_comp_main(fenv: Func, node):
     assert node[:3] == ['def', ['main', 'int'], []]
     func = pl_scan_func(fenv, node)
     return pl_comp_func(func, node)
+
+# The compiler of each form, by head and length, or by head alone for
+# forms of any length.
+FORMS = {
+    **{(kind, 2): pl_comp_const for kind in ('val', 'val8', 'str')},
+    **{(op, 3): pl_comp_binop for op in BINOPS},
+    ('-', 2): pl_comp_unop,
+    ('not', 2): pl_comp_unop,
+    'do': pl_comp_scope,
+    'then': pl_comp_scope,
+    'else': pl_comp_scope,
+    ('var', 3): pl_comp_newvar,
+    ('set', 3): pl_comp_setvar,
+    ('?', 3): pl_comp_cond,
+    ('?', 4): pl_comp_cond,
+    ('if', 3): pl_comp_cond,
+    ('if', 4): pl_comp_cond,
+    ('loop', 3): pl_comp_loop,
+    ('break', 1): pl_comp_break,
+    ('continue', 1): pl_comp_continue,
+    'call': pl_comp_call,
+    ('return', 1): pl_comp_return,
+    ('return', 2): pl_comp_return,
+    ('alloc', 3): pl_comp_alloc,
+    ('load', 2): pl_comp_load,
+    ('load', 3): pl_comp_load,
+    ('store', 3): pl_comp_store,
+    ('store', 4): pl_comp_store,
+}
@@ -0,0 +1,94 @@
+import codecs
+import mmap
+import os
+from collections import OrderedDict
+
+# File access for pl_eval and the closure engine. `file` reads a whole
+# file as text, through a small cache that is checked against the file's
+# mtime and size on every read. The other forms never hold more than one
+# line or chunk at a time, so they scan files of any size:
+#
+#   (mmap PATH)         a read-only memoryview of the file, backed by mmap
+#   (lines SRC)         an iterator over the lines of a path or a buffer,
+#                       each with its newline, so every line is true
+#   (chunks SRC SIZE)   an iterator over the text of SRC in pieces of at
+#                       most SIZE bytes, never splitting a character
+#   (next IT)           the next item of IT, or null once it is done
+#
+# so that a file is scanned with
+#
+#   (var line null)
+#   (loop (set line (next it)) ...)
+
+FILE_CACHE_LIMIT = int(os.environ.get('PL_FILE_CACHE_SIZE', 32 << 20))
+
+_files = OrderedDict()
+_cached = 0
+
+def read_file(path):
+    global _cached
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    hit = _files.get(path)
+    if hit and hit[0] == stamp:
+        _files.move_to_end(path)
+        return hit[1]
+    with open(path, 'r') as f:
+        text = f.read()
+    if hit:
+        _cached -= len(hit[1])
+        del _files[path]
+    if len(text) <= FILE_CACHE_LIMIT:
+        _files[path] = (stamp, text)
+        _cached += len(text)
+        while _cached > FILE_CACHE_LIMIT:
+            _, (_, old) = _files.popitem(last=False)
+            _cached -= len(old)
+    return text
+
+def map_file(path):
+    with open(path, 'rb') as f:
+        # mmap refuses empty files.
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b'')
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def as_buffer(src):
+    return map_file(src) if isinstance(src, str) else memoryview(src)
+
+def iter_lines(src):
+    buf = as_buffer(src)
+    # The object under the view does the searching; memoryview cannot.
+    find = buf.obj.find
+    start, end = 0, len(buf)
+    while start < end:
+        stop = find(b'\n', start)
+        stop = end if stop < 0 else stop + 1
+        yield str(buf[start:stop], 'utf-8')
+        start = stop
+
+def iter_chunks(src, size):
+    if not isinstance(size, int) or size <= 0:
+        raise ValueError(f"Bad chunk size {size!r}")
+    buf = as_buffer(src)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for start in range(0, len(buf), size):
+        text = decoder.decode(buf[start:start + size])
+        if text:
+            yield text
+    decoder.decode(b'', final=True)
+
+def next_item(it):
+    if not hasattr(it, '__next__'):
+        raise ValueError("next expects an iterator")
+    return next(it, None)
+
+# Form name: (number of arguments, implementation).
+FILE_OPS = {
+    'file': (1, read_file),
+    'mmap': (1, map_file),
+    'lines': (1, iter_lines),
+    'chunks': (2, iter_chunks),
+    'next': (1, next_item),
+}
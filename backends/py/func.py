@@ -4,12 +4,19 @@ class Func:
     def __init__(self, prev):
         self.prev = prev
         self.level = (prev.level + 1) if prev else 0
+        self.name = None
         self.rtype = None
         self.funcs = prev.funcs if prev else []
+        # Every name in sight, for the whole tree: name -> stack of
+        # (level, type, slot), innermost last. A scope takes off what it
+        # declared when it closes, so a lookup never walks a chain.
+        self.symbols = prev.symbols if prev else dict()
         self.scope = Scope(None)
         self.code = []
+        self.nargs = 0
         self.nvar = 0
         self.stack = 0
+        self.max_stack = 0
         self.labels = []
 
     def new_label(self):
@@ -24,28 +31,35 @@ class Func:
     def tmp(self):
         dst = self.stack
         self.stack += 1
+        self.max_stack = max(self.max_stack, self.stack)
         return dst
     
+    def declare(self, name, tp, var):
+        self.scope.names[name] = (tp, var)
+        self.symbols.setdefault(name, []).append((self.level, tp, var))
+
+    def undeclare(self, scope):
+        for name in scope.names:
+            self.symbols[name].pop()
+
     def add_var(self, name, tp):
         if name in self.scope.names:
             raise ValueError(f"Name {name} already defined")
-        self.scope.names[name] = (tp, self.nvar)
+        self.declare(name, tp, self.nvar)
         self.scope.nlocal += 1
 
         assert self.stack == self.nvar
         dst = self.stack
         self.stack += 1
         self.nvar += 1
+        self.max_stack = max(self.max_stack, self.stack)
         return dst
 
     def get_var(self, name):
-        from utils import scope_get_var
-        tp, var = scope_get_var(self.scope, name)
-        if var >= 0:
-            return self.level, tp, var
-        if not self.prev:
+        found = self.symbols.get(name)
+        if not found:
             raise ValueError(f"Variable {name} not defined")
-        return self.prev.get_var(name)
+        return found[-1]
     
     def scope_enter(self):
         self.scope = Scope(self.scope)
@@ -54,4 +68,5 @@ class Func:
     def scope_leave(self):
         self.stack = self.scope.save
         self.nvar -= self.scope.nlocal
+        self.undeclare(self.scope)
         self.scope = self.scope.prev 
\ No newline at end of file
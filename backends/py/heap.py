@@ -0,0 +1,38 @@
+# The memory behind pointers on the Python backends: one bytearray, read
+# and written in place through two memoryviews, one of bytes and one of
+# int64 words. A pointer is a byte offset into it. Blocks are 8-byte
+# aligned, so a `ptr int` always indexes `words` at offset >> 3, and
+# offset 0 is never handed out, so it can serve as null. Memory is zeroed
+# when it is allocated and is never freed. Loads and stores check that a
+# pointer is past null and below top, the end of the allocated memory.
+
+# Bytes per element, by element type; the IR carries these as the width
+# of alloc, load, store and ptradd.
+WIDTHS = {'int': 8, 'byte': 1}
+
+class Heap:
+    def __init__(self, size=1 << 16):
+        self.data = bytearray(max(size, 8))
+        self.top = 8
+        self.views()
+
+    def views(self):
+        self.bytes = memoryview(self.data)
+        self.words = self.bytes.cast('q')
+
+    def bad_pointer(self, ptr):
+        return ValueError(f"Bad pointer {ptr}: allocated memory is 8..{self.top}")
+
+    def alloc(self, n, width):
+        if n < 0:
+            raise ValueError(f"Bad allocation of {n} elements")
+        start = self.top
+        self.top = (start + n * width + 7) & ~7
+        if self.top > len(self.data):
+            # The views pin the buffer; they are released for the resize
+            # and made again, so callers must fetch them anew.
+            self.words.release()
+            self.bytes.release()
+            self.data.extend(bytes(max(len(self.data), self.top - len(self.data))))
+            self.views()
+        return start
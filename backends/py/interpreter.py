@@ -1,6 +1,62 @@
+import operator
 from exceptions import LoopBreak, LoopContinue, FuncReturn
 from parser import pl_parse_prog
+from memo import MISSING, memo_cache, memo_key
+from fileio import FILE_OPS
+from rope import STRINGS, concat, flatten
 
+BINARY_OPS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'lt': operator.lt,
+    'le': operator.le,
+    'gt': operator.gt,
+    'ge': operator.ge,
+    'and': operator.and_,
+    'or': operator.or_
+}
+
+UNOPS = {
+    'neg': operator.neg,
+    'not': operator.not_
+}
+
+class Signal:
+    __slots__ = ('val',)
+
+    def __init__(self, val=None):
+        self.val = val
+
+# Control flow that reaches a caller which checks for it is returned as
+# a value instead of raised. FuncReturn and friends are only used when
+# the signal has to cross an expression that does not check.
+BREAK = Signal()
+CONTINUE = Signal()
+
+def signal_escape(sig, ctl, in_call):
+    if sig is BREAK or sig is CONTINUE:
+        if ctl:
+            return sig
+        raise LoopBreak() if sig is BREAK else LoopContinue()
+    if in_call:
+        return sig.val
+    if ctl:
+        return sig
+    raise FuncReturn(sig.val)
+
+# Set by profiler.profiling() while a profile is being taken; None
+# otherwise, and then the hooks below cost one global lookup per node.
+PROFILER = None
+
+# pl_eval walks the AST as it is, with no pass over it first: it runs
+# forms as --stream reads them, and --profile counts the very nodes it
+# visits. So it looks names up through a chain of dict scopes, one per
+# block, conditional and loop iteration; loops reuse theirs. Resolving
+# names to slots ahead of time is closure.py's job (--interpret-fast).
 def name_lookup(env, key):
     while env:
         current, env = env
@@ -8,147 +64,178 @@ def name_lookup(env, key):
             return current
     raise ValueError(f"Name {key} not found")
 
-def pl_eval(env, node):
-    if not isinstance(node, list):
-        assert isinstance(node, str)
-        return name_lookup(env, node)[node]
-
-    if len(node) == 0:
-        raise ValueError("Empty list")
-    
-    import operator
-    binary_ops = {
-        '+': operator.add,
-        '-': operator.sub,
-        '*': operator.mul,
-        '/': operator.truediv,
-        'eq': operator.eq,
-        'ne': operator.ne,
-        'lt': operator.lt,
-        'le': operator.le,
-        'gt': operator.gt,
-        'ge': operator.ge,
-        'and': operator.and_,
-        'or': operator.or_
-    }
-    
-    if len(node) == 3 and node[0] in binary_ops:
-        op = binary_ops[node[0]]
-        lop = pl_eval(env, node[1])
-        rop = pl_eval(env, node[2])
-        # Runtime type checking. Fun stuff!
-        if isinstance(lop, str) or isinstance(rop, str):
-            return str(op(str(lop), str(rop)))
-        opret = op(lop, rop)
-        return opret
-    
-    unops = {
-        'neg': operator.neg,
-        'not': operator.not_
-    }
-
-    if len(node) == 2 and node[0] in unops:
-        op = unops[node[0]]
-        return op(pl_eval(env, node[1]))
-    
-    if len(node) in (3,4) and node[0] in ('?', 'if'):
-        _, cond, yes, *no = node
-        no = no[0] if no else ['val', None]
-        new_env = (dict(), env)
-        if pl_eval(new_env, cond):
-            return pl_eval(new_env, yes)
-        else:
-            return pl_eval(new_env, no)
-
-    if node[0] == 'print':
-        return print(*(pl_eval(env, val) for val in node[1:]))
-    
-    if node[0] in ('do', 'then', 'else') and len(node) > 1:
-        new_env = (dict(), env)
-        for val in node[1:]:
-            val = pl_eval(new_env, val)
-        return val
-    
-    if node[0] == 'var':
-        _, name, val = node
-        scope, _ = env
-        if name in scope:
-            raise ValueError(f"Name {name} already defined")
-        val = pl_eval(env, val)
-        scope[name] = val
-        return val
-    
-    if node[0] == 'set' and len(node) == 3:
-        _, name, val = node
-        scope = name_lookup(env, name)
-        val = pl_eval(env, val)
-        scope[name] = val
-        return val
-    
-    if node[0] == 'loop' and len(node) == 3:
-        _, cond, body = node
-        ret = None
+def pl_eval(env, node, ctl=False, in_call=False):
+    # Nodes in tail position (if branches, the last form of a block, a
+    # function body) are evaluated by looping instead of recursing, so
+    # tail calls run in constant Python stack. in_call is set once this
+    # invocation has entered a function body, or passed in when it starts
+    # in one; from then on its result is that function's result. ctl
+    # means the caller checks for signals.
+    try:
         while True:
-            new_env = (dict(), env)
-            if not pl_eval(new_env, cond):
-                break
-            try:
-                ret = pl_eval(new_env, body)
-            except LoopBreak:
-                break
-            except LoopContinue:
+            if not isinstance(node, list):
+                assert isinstance(node, str)
+                return name_lookup(env, node)[node]
+
+            if len(node) == 0:
+                raise ValueError("Empty list")
+
+            if PROFILER is not None:
+                PROFILER.hit(node)
+
+            if len(node) == 3 and node[0] in BINARY_OPS:
+                op = BINARY_OPS[node[0]]
+                lop = pl_eval(env, node[1])
+                rop = pl_eval(env, node[2])
+                # Runtime type checking. Fun stuff!
+                if isinstance(lop, STRINGS) or isinstance(rop, STRINGS):
+                    if op is operator.add:
+                        return concat(lop, rop)
+                    return str(op(str(lop), str(rop)))
+                opret = op(lop, rop)
+                return opret
+
+            if len(node) == 2 and node[0] in UNOPS:
+                op = UNOPS[node[0]]
+                return op(pl_eval(env, node[1]))
+
+            if len(node) in (3,4) and node[0] in ('?', 'if'):
+                _, cond, yes, *no = node
+                no = no[0] if no else ['val', None]
+                env = (dict(), env)
+                node = yes if pl_eval(env, cond) else no
                 continue
-        return ret
-    
-    if node[0] == 'def' and len(node) == 4:
-        _, name, args, body = node
-        for arg_name in args:
-            if not isinstance(arg_name, str):
-                raise ValueError("invalid argument name")
-        if len(args) != len(set(args)):
-            raise ValueError("duplicate argument name")
-        dct, _ = env
-        key = (name, len(args))
-        if key in dct:
-            raise ValueError("function already defined")
-        dct[key] = (args, body, env)
-        return 
-    
-    if node[0] == 'call' and len(node) >= 2:
-        _, name, *args = node
-        key = (name, len(args))
-        fargs, fbody, fenv = name_lookup(env, key)[key]
-        new_env = dict()
-        for arg_name, arg_val in zip(fargs, args):
-            new_env[arg_name] = pl_eval(env, arg_val)
-        try:
-            return pl_eval((new_env, fenv), fbody)
-        except FuncReturn as ret:
-            return ret.val
 
-    if node[0] == 'file' and len(node) == 2:
-        _, path = node
-        path = pl_eval(env, path)
-        import os
-        print(os.getcwd())
-        with open(path, 'r') as f:
-            return f.read()
-    
-    if node[0] == 'break' and len(node) == 1:
-        raise LoopBreak
-    
-    if node[0] == 'continue' and len(node) == 1:
-        raise LoopContinue
-    
-    if node[0] == 'return' and len(node) == 1:
-        raise FuncReturn(None)
-    
-    if node[0] == 'return' and len(node) == 2:
-        _, val = node
-        raise FuncReturn(pl_eval(env, val))
-    
-    if len(node) == 2:
-        return node[1]
-
-    raise ValueError("Invalid node")
+            if node[0] == 'print':
+                return print(*(pl_eval(env, val) for val in node[1:]))
+
+            if node[0] in ('do', 'then', 'else') and len(node) > 1:
+                env = (dict(), env)
+                for val in node[1:-1]:
+                    val = pl_eval(env, val, True)
+                    if isinstance(val, Signal):
+                        return signal_escape(val, ctl, in_call)
+                node = node[-1]
+                continue
 
+            if node[0] == 'var':
+                _, name, val = node
+                scope, _ = env
+                if name in scope:
+                    raise ValueError(f"Name {name} already defined")
+                val = pl_eval(env, val)
+                scope[name] = val
+                return val
+
+            if node[0] == 'set' and len(node) == 3:
+                _, name, val = node
+                scope = name_lookup(env, name)
+                val = pl_eval(env, val)
+                scope[name] = val
+                return val
+
+            if node[0] == 'loop' and len(node) == 3:
+                _, cond, body = node
+                ret = None
+                # Functions are not values, so nothing outlives an
+                # iteration's scope and every iteration can reuse it.
+                scope = dict()
+                new_env = (scope, env)
+                while True:
+                    if scope:
+                        scope.clear()
+                    if not pl_eval(new_env, cond):
+                        break
+                    try:
+                        val = pl_eval(new_env, body, True)
+                    except LoopBreak:
+                        break
+                    except LoopContinue:
+                        continue
+                    if isinstance(val, Signal):
+                        if val is BREAK:
+                            break
+                        if val is CONTINUE:
+                            continue
+                        return signal_escape(val, ctl, in_call)
+                    ret = val
+                return ret
+
+            if node[0] == 'def' and len(node) == 4:
+                _, name, args, body = node
+                for arg_name in args:
+                    if not isinstance(arg_name, str):
+                        raise ValueError("invalid argument name")
+                if len(args) != len(set(args)):
+                    raise ValueError("duplicate argument name")
+                dct, _ = env
+                key = (name, len(args))
+                if key in dct:
+                    raise ValueError("function already defined")
+                dct[key] = (args, body, env, None)
+                return
+
+            if node[0] == 'memo' and len(node) == 2:
+                _, kid = node
+                if not (isinstance(kid, list) and len(kid) == 4 and kid[0] == 'def'):
+                    raise ValueError("memo expects a def")
+                pl_eval(env, kid)
+                dct, _ = env
+                key = (kid[1], len(kid[2]))
+                dct[key] = dct[key][:3] + (memo_cache(key),)
+                return
+
+            if node[0] == 'call' and len(node) >= 2:
+                _, name, *args = node
+                key = (name, len(args))
+                fargs, fbody, fenv, memo = name_lookup(env, key)[key]
+                new_env = dict()
+                for arg_name, arg_val in zip(fargs, args):
+                    new_env[arg_name] = pl_eval(env, arg_val)
+                if memo is not None and not in_call:
+                    # A tail call reuses this frame and is not cached.
+                    args_key = memo_key(new_env.values())
+                    val = memo.get(args_key)
+                    if val is MISSING:
+                        if PROFILER is not None:
+                            PROFILER.enter(key, False)
+                        val = pl_eval((new_env, fenv), fbody, in_call=True)
+                        memo.put(args_key, val)
+                    return val
+                env = (new_env, fenv)
+                node = fbody
+                if PROFILER is not None:
+                    PROFILER.enter(key, in_call)
+                in_call = True
+                continue
+
+            if node[0] in FILE_OPS and len(node) == FILE_OPS[node[0]][0] + 1:
+                fn = FILE_OPS[node[0]][1]
+                return fn(*[flatten(pl_eval(env, kid)) for kid in node[1:]])
+
+            if node[0] == 'break' and len(node) == 1:
+                return signal_escape(BREAK, ctl, in_call)
+
+            if node[0] == 'continue' and len(node) == 1:
+                return signal_escape(CONTINUE, ctl, in_call)
+
+            if node[0] == 'return' and len(node) == 1:
+                return signal_escape(Signal(None), ctl, in_call)
+
+            if node[0] == 'return' and len(node) == 2:
+                if in_call:
+                    node = node[1]
+                    continue
+                return signal_escape(Signal(pl_eval(env, node[1])), ctl, in_call)
+
+            if len(node) == 2:
+                return node[1]
+
+            raise ValueError("Invalid node")
+    except FuncReturn as ret:
+        if in_call:
+            return ret.val
+        raise
+    finally:
+        if in_call and PROFILER is not None:
+            PROFILER.leave()
@@ -1,9 +1,19 @@
 import argparse
-from parser import pl_parse_prog, pl_parse_main
-from interpreter import pl_eval
-from compiler import pl_comp_main
-from func import Func
-from utils import ir_dump
+import contextlib
+import json
+import os
+import sys
+from cache import pl_load_prog, pl_load_ir
+from stats import PhaseTimes, timed
+import memo
+
+# Each mode imports the modules it runs on itself, so that starting up
+# only pays for what the mode uses.
+
+def write_profile(prof, path):
+    with open(path, 'w') as f:
+        prof.write_collapsed(f)
+    prof.write_report(sys.stderr)
 
 def main():
     parser = argparse.ArgumentParser(description='Programming Language Processor')
@@ -11,24 +21,63 @@ def main():
     parser.add_argument('--parse', action='store_true', help='Parse the program and show AST')
     parser.add_argument('--compile', action='store_true', help='Compile the program')
     parser.add_argument('--interpret', action='store_true', help='Interpret the program')
+    parser.add_argument('--stream', action='store_true', help='With --interpret, run each top-level form as soon as it is read')
+    parser.add_argument('--interpret-fast', action='store_true', help='Compile the program to closures and run it')
     parser.add_argument('--repl', action='store_true', help='Start REPL mode')
     parser.add_argument('--compile-c', action='store_true', help='Compile the program to C')
     parser.add_argument('--compile-asm', action='store_true', help='Compile the program to x86_64 assembly')
     parser.add_argument('--compile-ir', action='store_true', help='Compile the program to IR')
+    parser.add_argument('-O', '--optimize', action='store_true', help='Run the IR optimization passes')
+    parser.add_argument('--run-ir', action='store_true', help='Compile the program to IR and run it on the VM')
+    parser.add_argument('--compile-py', action='store_true', help='Translate the program to Python and run it')
+    parser.add_argument('-o', '--output', help='Write the generated Python, C or assembly source to this file')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the compilation cache')
+    parser.add_argument('--build', metavar='EXE', help='With --compile-c or --compile-asm, build a native executable')
+    parser.add_argument('--memo-size', type=int, default=memo.MEMO_SIZE, help='Cache up to N results per function wrapped in (memo ...); 0 disables memoization')
+    parser.add_argument('--memo-auto', action='store_true', help='With --interpret or --interpret-fast, also memoize every function proven pure; needs the whole program, so not with --stream')
+    parser.add_argument('--memo-stats', action='store_true', help='With --interpret, print memoization hits and misses to stderr')
+    parser.add_argument('--serve', metavar='SOCK', help='Serve programs on a Unix domain socket; see client.py')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='With --serve, the number of worker processes')
+    parser.add_argument('--batch', nargs='+', metavar='PATH', help='Run every .pl_lang file in these directories or globs over --workers processes and print a JSON summary')
+    parser.add_argument('--timeout', type=float, default=10.0, help='With --batch or --serve, the time limit per file or request in seconds; 0 means none')
+    parser.add_argument('--profile', metavar='PATH', help='With --interpret, write collapsed stacks to PATH and a summary to stderr')
+    parser.add_argument('--map', nargs=2, metavar=('FUNC', 'CSV'), help='Call the int or byte function FUNC once per row of CSV over NumPy arrays and print one result per line')
+    parser.add_argument('--stats', action='store_true', help='Print the time spent in each phase and the size of the program to stderr')
 
     args = parser.parse_args()
+    stats = PhaseTimes() if args.stats else None
+    try:
+        run(parser, args, stats)
+    finally:
+        if stats:
+            stats.write_report(sys.stderr)
 
+def run(parser, args, stats):
     # Handle REPL mode
     if args.repl:
-        print("REPL mode not implemented yet")
+        from repl import pl_repl
+        pl_repl()
         return
 
-    if args.compile_c:
-        print("C compilation not implemented yet")
+    if args.serve:
+        from server import pl_serve
+        memo.MEMO_SIZE = args.memo_size
+        pl_serve(args.serve, args.workers, args.timeout)
         return
 
-    if args.compile_asm:
-        print("x86_64 assembly compilation not implemented yet")
+    if args.batch:
+        from batch import pl_batch
+        memo.MEMO_SIZE = args.memo_size
+        engine = 'run-ir' if args.run_ir else 'interpret-fast' if args.interpret_fast else 'interpret'
+        summary = pl_batch(args.batch, engine, args.optimize, args.workers, args.timeout)
+        text = json.dumps(summary, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(text + '\n')
+        else:
+            print(text)
+        if summary['total'] != summary['ok']:
+            sys.exit(1)
         return
 
     # If no file is provided and not in REPL mode, show help
@@ -36,6 +85,39 @@ def main():
         parser.print_help()
         return
 
+    memo.MEMO_SIZE = args.memo_size
+    memoize = memo.pl_memoize if args.memo_auto and args.memo_size > 0 else (lambda node: node)
+    if args.memo_auto and args.stream:
+        parser.error('--memo-auto needs the whole program and cannot be used with --stream')
+
+    prof = None
+    if args.profile:
+        from profiler import Profiler, profiling
+        prof = Profiler()
+    profile = profiling(prof) if prof else contextlib.nullcontext()
+
+    # Stream mode never holds the whole program in memory
+    if args.file and args.interpret and args.stream:
+        from parser import pl_read_forms
+        from interpreter import pl_eval
+        try:
+            with open(args.file, 'r') as f, profile:
+                env = (dict(), None)
+                result = None
+                for node in pl_read_forms(f):
+                    result = pl_eval(env, node)
+                if result is not None:
+                    print("Result:", result)
+        except FileNotFoundError:
+            print(f"Error: File '{args.file}' not found")
+        except Exception as e:
+            print(f"Runtime error: {e}")
+        if prof:
+            write_profile(prof, args.profile)
+        if args.memo_stats:
+            memo.write_stats(sys.stderr)
+        return
+
     # Read the input file
     if args.file:
         try:
@@ -51,6 +133,7 @@ def main():
         # Parse mode
         if args.parse:
             try:
+                from parser import pl_parse_prog
                 ast = pl_parse_prog(program)
                 print("Parse result:")
                 import pprint
@@ -65,18 +148,107 @@ def main():
             return
 
 
+        use_cache = not args.no_cache
+
         if args.compile_ir:
-            node = pl_parse_main(program)
-            fenv = Func(None)
-            pl_comp_main(fenv, node)
-            print(ir_dump(fenv))
+            from utils import ir_dump
+            fenv, counts = pl_load_ir(program, args.optimize, use_cache, stats)
+            print(ir_dump(fenv, counts))
+            return
+
+        if args.map:
+            from vectorize import pl_map_csv
+            try:
+                name, path = args.map
+                with timed(stats, 'map'):
+                    if args.output:
+                        with open(args.output, 'w') as f:
+                            pl_map_csv(program, name, path, f, args.optimize, use_cache)
+                    else:
+                        pl_map_csv(program, name, path, sys.stdout, args.optimize, use_cache)
+            except Exception as e:
+                print(f"Runtime error: {e}")
+            return
+
+        if args.run_ir:
+            from vm import pl_run_ir
+            try:
+                fenv, _ = pl_load_ir(program, args.optimize, use_cache, stats)
+                with timed(stats, 'run'):
+                    result = pl_run_ir(fenv)
+                if result is not None:
+                    print("Result:", result)
+            except Exception as e:
+                print(f"Runtime error: {e}")
+                return
+
+        if args.compile_c or args.compile_asm:
+            try:
+                fenv, _ = pl_load_ir(program, args.optimize, use_cache, stats)
+                with timed(stats, 'codegen'):
+                    if args.compile_c:
+                        from cgen import pl_compile_c, pl_build_c
+                        source, build = pl_compile_c(fenv), pl_build_c
+                    else:
+                        from asmgen import pl_compile_asm, pl_build_asm
+                        source, build = pl_compile_asm(fenv), pl_build_asm
+                if args.output:
+                    with open(args.output, 'w') as f:
+                        f.write(source)
+                elif not args.build:
+                    print(source)
+                if args.build:
+                    with timed(stats, 'build'):
+                        build(source, args.build)
+            except Exception as e:
+                print(f"Compile error: {e}")
             return
 
+        if args.compile_py:
+            from parser import pl_parse_main
+            from pygen import pl_compile_py, pl_run_py
+            try:
+                with timed(stats, 'parse'):
+                    ast = pl_parse_main(program)
+                with timed(stats, 'codegen'):
+                    source = pl_compile_py(ast)
+                if args.output:
+                    with open(args.output, 'w') as f:
+                        f.write(source)
+                with timed(stats, 'run'):
+                    result = pl_run_py(source, args.output or args.file)
+                if result is not None:
+                    print("Result:", result)
+            except Exception as e:
+                print(f"Runtime error: {e}")
+                return
+
         # Interpret mode
         if args.interpret:
+            from interpreter import pl_eval
             try:
-                ast = pl_parse_prog(program)
-                result = pl_eval((dict(), None), ast)
+                # The profiler counts hits per node object, so shared
+                # subtrees must be separate objects.
+                ast = memoize(pl_load_prog(program, use_cache, stats, shared=prof is None))
+                with profile, timed(stats, 'run'):
+                    result = pl_eval((dict(), None), ast)
+                if result is not None:
+                    print("Result:", result)
+            except Exception as e:
+                print(f"Runtime error: {e}")
+                return
+            finally:
+                if prof:
+                    write_profile(prof, args.profile)
+                if args.memo_stats:
+                    memo.write_stats(sys.stderr)
+
+        if args.interpret_fast:
+            from closure import pl_eval_fast
+            try:
+                ast = memoize(pl_load_prog(program, use_cache, stats))
+                with timed(stats, 'run'):
+                    result = pl_eval_fast(ast)
                 if result is not None:
                     print("Result:", result)
             except Exception as e:
@@ -0,0 +1,185 @@
+from collections import OrderedDict
+from fileio import FILE_OPS
+
+# Memoization for pl_eval and the closure engine. A program opts a
+# function in by wrapping its def in (memo ...); each function made from
+# such a def gets its own LRU cache of MEMO_SIZE results, keyed by
+# argument tuple. In pl_eval only calls that open a new Python frame go
+# through the cache: tail calls reuse their caller's frame and are never
+# cached, so they still run in constant stack.
+#
+# pl_memoize() adds the wrapper to every def it can prove pure, for
+# --memo-auto. Both engines look names up when the code runs, so the
+# proof only holds for a whole program: a def that reads a variable of
+# an enclosing scope could see a later var or set, and a callee could be
+# rebound by a later def, so neither is pure.
+
+MEMO_SIZE = 1024
+
+# Counters per def key, shared by every cache made for that key.
+STATS = dict()
+
+MISSING = object()
+
+class MemoStats:
+    __slots__ = ('hits', 'misses', 'evictions')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+class LRUCache:
+    def __init__(self, size, stats):
+        self.size = size
+        self.stats = stats
+        self.data = OrderedDict()
+
+    def get(self, key):
+        # Arguments such as lists and memoryviews make the key
+        # unhashable; such calls always miss and are never stored.
+        try:
+            val = self.data[key]
+        except (KeyError, TypeError):
+            self.stats.misses += 1
+            return MISSING
+        self.data.move_to_end(key)
+        self.stats.hits += 1
+        return val
+
+    def put(self, key, val):
+        try:
+            self.data[key] = val
+        except TypeError:
+            return
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+            self.stats.evictions += 1
+
+def memo_cache(key):
+    if MEMO_SIZE <= 0:
+        return None
+    stats = STATS.get(key)
+    if stats is None:
+        stats = STATS[key] = MemoStats()
+    return LRUCache(MEMO_SIZE, stats)
+
+def memo_key(vals):
+    # 1, 1.0 and true are equal as dict keys but not as pl values.
+    return tuple((type(val), val) for val in vals)
+
+def is_def(node):
+    return (isinstance(node, list) and len(node) == 4 and node[0] == 'def'
+            and isinstance(node[1], str) and isinstance(node[2], list))
+
+class DefInfo:
+    # What a def's body does, as far as purity is concerned. Names are
+    # resolved through the scopes of the body in the order pl_eval makes
+    # them; one that is not found belongs to an enclosing scope.
+    def __init__(self, node):
+        self.node = node
+        self.key = (node[1], len(node[2]))
+        self.inner = set()
+        self.calls = set()
+        self.effects = False
+        self.free = False
+        self.walk(node[3], [set(node[2])], 0)
+
+    def bound(self, name, scopes):
+        return any(name in scope for scope in scopes)
+
+    def walk(self, node, scopes, loops):
+        if isinstance(node, str):
+            if not self.bound(node, scopes):
+                self.free = True
+            return
+        if not isinstance(node, list) or not node or not isinstance(node[0], str):
+            return
+        head = node[0]
+        if head == 'val':
+            return
+        if head == 'print' or head in FILE_OPS:
+            self.effects = True
+        elif head in ('break', 'continue') and not loops:
+            # Escapes into the caller's loop.
+            self.effects = True
+        elif head == 'var' and len(node) == 3:
+            self.walk(node[2], scopes, loops)
+            scopes[-1].add(node[1])
+            return
+        elif head == 'set' and len(node) == 3:
+            if not self.bound(node[1], scopes):
+                self.free = True
+            self.walk(node[2], scopes, loops)
+            return
+        elif is_def(node):
+            self.inner.add((node[1], len(node[2])))
+            self.walk(node[3], scopes + [set(node[2])], 0)
+            return
+        elif head == 'call' and len(node) >= 2:
+            self.calls.add((node[1], len(node) - 2))
+            for kid in node[2:]:
+                self.walk(kid, scopes, loops)
+            return
+        elif head in ('do', 'then', 'else', '?', 'if', 'loop'):
+            # Each of these evaluates its parts in a new scope.
+            loops += head == 'loop'
+            scopes = scopes + [set()]
+        for kid in node[1:]:
+            self.walk(kid, scopes, loops)
+
+def collect_defs(node, out):
+    if not isinstance(node, list) or not node:
+        return
+    if is_def(node):
+        out.append(DefInfo(node))
+    for kid in node:
+        collect_defs(kid, out)
+
+def pure_defs(node):
+    # The ids of the def nodes of the program node whose functions can be
+    # memoized: no print or file, no names from outside the def, and
+    # only pure callees. A key with more than one def is never pure, and
+    # neither is a call to it, since which def a call reaches depends on
+    # when it runs.
+    defs = []
+    collect_defs(node, defs)
+    by_key = dict()
+    for info in defs:
+        by_key.setdefault(info.key, []).append(info)
+
+    pure = {info.key for info in defs
+            if len(by_key[info.key]) == 1 and not (info.effects or info.free)}
+    changed = True
+    while changed:
+        changed = False
+        for key in list(pure):
+            info, = by_key[key]
+            # Inner defs were walked as part of this body; only their
+            # uniqueness is left to check.
+            if not all(callee in pure or (callee in info.inner and len(by_key[callee]) == 1)
+                       for callee in info.calls):
+                pure.discard(key)
+                changed = True
+    return {id(info.node) for info in defs if info.key in pure}
+
+def pl_memoize(node):
+    # A copy of the program with every pure def wrapped in (memo ...).
+    # node must be the whole program.
+    pure = pure_defs(node)
+
+    def wrap(node):
+        if not isinstance(node, list):
+            return node
+        if node and node[0] == 'memo':
+            return node
+        out = [wrap(kid) for kid in node]
+        if id(node) in pure:
+            return ['memo', out]
+        return out
+    return wrap(node)
+
+def write_stats(f):
+    f.write(f'{"function":30} {"hits":>10} {"misses":>10} {"evicted":>10}\n')
+    for (name, nargs), stats in sorted(STATS.items()):
+        f.write(f'{name + "/" + str(nargs):30} {stats.hits:10} {stats.misses:10} {stats.evictions:10}\n')
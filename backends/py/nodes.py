@@ -0,0 +1,164 @@
+import sys
+from array import array
+
+# A flat, hash-consed form of the AST. Every distinct subtree is stored
+# once, as a row of parallel arrays: an integer opcode, an argument and,
+# for lists, a run of child rows in `kids`. Identifiers are interned and
+# kept once in `names`, constants once in `consts`. Children always come
+# before their parents, so building, converting and serializing are all
+# plain loops over the rows, whatever the nesting depth.
+#
+# It is the form the cache stores ASTs in; no engine reads it, they all
+# run the list form to_list rebuilds. It lets programs of any depth be
+# cached and shares identical subtrees in memory, but loading it is
+# slower than unmarshalling nested lists (see ast-cache in benchmarks).
+#
+# ['val', x] is OP_VAL. A list headed by one of KEYWORDS gets that
+# keyword's opcode and stores only the remaining elements as kids; any
+# other list is OP_LIST with all of its elements as kids.
+
+OP_NAME, OP_VAL, OP_LIST = 0, 1, 2
+
+KEYWORDS = (
+    '+', '-', '*', '/', '%', 'eq', 'ne', 'lt', 'le', 'gt', 'ge', 'and', 'or',
+    'neg', 'not', '?', 'if', 'then', 'else', 'do', 'print', 'var', 'set',
+    'loop', 'def', 'call', 'file', 'break', 'continue', 'return', 'memo',
+    'mmap', 'lines', 'chunks', 'next',
+)
+
+OP_KEYWORD = 3
+KEYWORD_OPS = {kw: OP_KEYWORD + i for i, kw in enumerate(KEYWORDS)}
+
+class NodeTable:
+    def __init__(self):
+        self.ops = array('B')
+        self.args = array('i')
+        self.sizes = array('i')
+        self.kids = array('i')
+        self.names = []
+        self.consts = []
+        self.rows = dict()
+        self.name_index = dict()
+        self.const_index = dict()
+
+    def add_row(self, op, arg, kids=()):
+        key = (op, arg, *kids)
+        row = self.rows.get(key)
+        if row is None:
+            row = self.rows[key] = len(self.ops)
+            self.ops.append(op)
+            self.args.append(len(self.kids) if op >= OP_LIST else arg)
+            self.sizes.append(len(kids))
+            self.kids.extend(kids)
+        return row
+
+    def add_name(self, name):
+        idx = self.name_index.get(name)
+        if idx is None:
+            idx = self.name_index[name] = len(self.names)
+            self.names.append(sys.intern(name))
+        return self.add_row(OP_NAME, idx)
+
+    def add_const(self, val):
+        # 1, 1.0 and true are equal, and so are 0.0 and -0.0, but they
+        # must stay distinct constants.
+        key = (type(val), repr(val) if isinstance(val, float) else val)
+        idx = self.const_index.get(key)
+        if idx is None:
+            idx = self.const_index[key] = len(self.consts)
+            self.consts.append(val)
+        return self.add_row(OP_VAL, idx)
+
+    def add(self, node):
+        # The row of a list-form node, adding any rows that are missing.
+        # Post-order with an explicit stack, like the parser.
+        stack = [(node, None)]
+        done = []
+        while stack:
+            node, kids = stack.pop()
+            if isinstance(node, str):
+                done.append(self.add_name(node))
+            elif not isinstance(node, list):
+                raise ValueError(f"Unexpected node {node!r}")
+            elif len(node) == 2 and node[0] == 'val':
+                done.append(self.add_const(node[1]))
+            elif kids is None:
+                stack.append((node, len(done)))
+                stack.extend((kid, None) for kid in reversed(node))
+            else:
+                rows = done[kids:]
+                del done[kids:]
+                op = OP_LIST
+                if node and isinstance(node[0], str) and node[0] in KEYWORD_OPS:
+                    op = KEYWORD_OPS[node[0]]
+                    rows = rows[1:]
+                done.append(self.add_row(op, 0, rows))
+        return done[0]
+
+    def children(self, row):
+        start = self.args[row]
+        return self.kids[start:start + self.sizes[row]]
+
+    def to_list(self, root):
+        # The list form of a row. Shared rows become shared lists, so the
+        # result takes as little memory as the table allows.
+        out = []
+        for row in range(root + 1):
+            op = self.ops[row]
+            if op == OP_NAME:
+                out.append(self.names[self.args[row]])
+            elif op == OP_VAL:
+                out.append(['val', self.consts[self.args[row]]])
+            else:
+                node = [out[kid] for kid in self.children(row)]
+                if op != OP_LIST:
+                    node.insert(0, KEYWORDS[op - OP_KEYWORD])
+                out.append(node)
+        return out[root]
+
+    def to_tree(self, root):
+        # Like to_list, but every occurrence of a shared row becomes lists
+        # of its own, so that nodes are told apart by identity again, as
+        # the profiler's per-node counts need.
+        stack = [(root, False)]
+        done = []
+        while stack:
+            row, ready = stack.pop()
+            op = self.ops[row]
+            if op == OP_NAME:
+                done.append(self.names[self.args[row]])
+            elif op == OP_VAL:
+                done.append(['val', self.consts[self.args[row]]])
+            elif not ready:
+                stack.append((row, True))
+                stack.extend((kid, False) for kid in reversed(self.children(row)))
+            else:
+                start = len(done) - self.sizes[row]
+                node = done[start:]
+                del done[start:]
+                if op != OP_LIST:
+                    node.insert(0, KEYWORDS[op - OP_KEYWORD])
+                done.append(node)
+        return done[0]
+
+    def dump(self):
+        # A marshal-friendly tuple; flat, so nesting depth never matters.
+        return (self.ops.tobytes(), self.args.tobytes(), self.sizes.tobytes(),
+                self.kids.tobytes(), self.names, self.consts)
+
+    @classmethod
+    def load(cls, data):
+        # Loaded tables convert and read fine but do not hash-cons rows
+        # added later.
+        table = cls()
+        ops, args, sizes, kids, table.names, table.consts = data
+        table.ops.frombytes(ops)
+        table.args.frombytes(args)
+        table.sizes.frombytes(sizes)
+        table.kids.frombytes(kids)
+        return table
+
+def pl_intern(node):
+    # The table of a list-form AST and the row of its root.
+    table = NodeTable()
+    return table, table.add(node)
@@ -0,0 +1,584 @@
+import itertools
+from func import Func
+from vm import IR_BINOPS, IR_BINOPS8, IR_UNOPS, IR_UNOPS8, IR_COMPARE
+from compiler import SWAPPED
+
+# Optimization passes over Func.code. While the passes run, the code is
+# kept as a list with ('label', L) pseudo instructions in place, so
+# deleting or inserting instructions never invalidates label positions.
+
+PURE = {'const', 'mov', 'binop', 'binop8', 'binopi', 'unop', 'unop8', 'get_env', 'ptradd'}
+
+# Instructions that write their last operand.
+WRITES_LAST = PURE | {'load', 'alloc'}
+
+# Instructions that end a basic block, and those that may jump; the
+# label is always the last operand.
+JUMPS = ('jmp', 'jmpf', 'jmpf_cmp', 'jmpf_cmpi')
+BRANCHES = JUMPS + ('ret',)
+
+def with_labels(func: Func):
+    pos2labels = dict()
+    for label, pos in enumerate(func.labels):
+        if pos is not None:
+            pos2labels.setdefault(pos, []).append(label)
+    out = []
+    for pos in range(len(func.code) + 1):
+        for label in pos2labels.get(pos, []):
+            out.append(('label', label))
+        if pos < len(func.code):
+            out.append(func.code[pos])
+    return out
+
+def strip_labels(func: Func, code):
+    func.labels = [None] * len(func.labels)
+    func.code = []
+    for instr in code:
+        if instr[0] == 'label':
+            func.labels[instr[1]] = len(func.code)
+        else:
+            func.code.append(instr)
+
+def escaping_slots(root: Func):
+    # Slots of each function that nested functions reach via get_env or
+    # set_env. A call may read or overwrite any of them.
+    escapes = {id(func): set() for func in root.funcs}
+    for func in root.funcs:
+        for instr in func.code:
+            if instr[0] in ('get_env', 'set_env'):
+                owner = func.prev
+                while owner.level != instr[1]:
+                    owner = owner.prev
+                escapes[id(owner)].add(instr[2])
+    return escapes
+
+def instr_def(instr):
+    op = instr[0]
+    if op in WRITES_LAST:
+        return instr[-1]
+    if op == 'call':
+        return instr[2]
+    return None
+
+def instr_uses(instr, funcs, escapes):
+    op = instr[0]
+    if op == 'mov':
+        return (instr[1],)
+    if op in ('binop', 'binop8', 'jmpf_cmp', 'ptradd', 'store'):
+        return instr[2:4]
+    if op in ('unop', 'unop8', 'binopi', 'jmpf_cmpi', 'load', 'alloc'):
+        return (instr[2],)
+    if op in ('jmpf', 'ret'):
+        return (instr[1],) if instr[1] >= 0 else ()
+    if op == 'set_env':
+        return (instr[3],)
+    if op == 'call':
+        start = instr[2]
+        nargs = funcs[instr[1]].nargs
+        return tuple(range(start, start + nargs)) + tuple(escapes)
+    return ()
+
+def fold(instr, consts):
+    # Returns a const instruction for a pure op on known ints, or None.
+    op = instr[0]
+    if op in ('binop', 'binop8'):
+        _, name, a1, a2, dst = instr
+        if a1 not in consts or a2 not in consts:
+            return None
+        lhs, rhs = consts[a1], consts[a2]
+        if not (isinstance(lhs, int) and isinstance(rhs, int)):
+            return None
+        if name in ('/', '%') and rhs == 0:
+            return None
+        table = IR_BINOPS8 if op == 'binop8' else IR_BINOPS
+        return ('const', table[name](lhs, rhs), dst)
+    if op == 'binopi':
+        _, name, a1, imm, dst = instr
+        if not isinstance(consts.get(a1), int) or (name in ('/', '%') and imm == 0):
+            return None
+        return ('const', IR_BINOPS[name](consts[a1], imm), dst)
+    if op in ('unop', 'unop8'):
+        _, name, a1, dst = instr
+        if not isinstance(consts.get(a1), int):
+            return None
+        table = IR_UNOPS8 if op == 'unop8' else IR_UNOPS
+        return ('const', table[name](consts[a1]), dst)
+    if op == 'mov' and instr[1] in consts:
+        return ('const', consts[instr[1]], instr[2])
+    return None
+
+def rename_uses(instr, copies):
+    op = instr[0]
+    get = lambda var: copies.get(var, var)
+    if op == 'mov':
+        return ('mov', get(instr[1]), instr[2])
+    if op in ('binop', 'binop8', 'jmpf_cmp', 'ptradd'):
+        return instr[:2] + (get(instr[2]), get(instr[3]), instr[4])
+    if op == 'store':
+        return instr[:2] + (get(instr[2]), get(instr[3]))
+    if op in ('unop', 'unop8', 'binopi', 'jmpf_cmpi', 'load', 'alloc'):
+        return instr[:2] + (get(instr[2]),) + instr[3:]
+    if op in ('jmpf', 'ret') and instr[1] >= 0:
+        return (op, get(instr[1])) + instr[2:]
+    if op == 'set_env':
+        return instr[:3] + (get(instr[3]),)
+    return instr
+
+def specialize(instr, consts):
+    # Turns a known int operand of a binop or a compare-and-branch into
+    # an immediate; a known left operand is swapped to the right where
+    # the op allows it. A known pointer offset becomes a byte offset.
+    op = instr[0]
+    if op == 'ptradd' and isinstance(consts.get(instr[3]), int):
+        _, scale, ptr, index, dst = instr
+        return ('binopi', '+', ptr, consts[index] * scale, dst)
+    if op not in ('binop', 'jmpf_cmp'):
+        return instr
+    _, name, a1, a2, last = instr
+    imm = 'binopi' if op == 'binop' else 'jmpf_cmpi'
+    if isinstance(consts.get(a2), int):
+        return (imm, name, a1, consts[a2], last)
+    if isinstance(consts.get(a1), int) and name in SWAPPED:
+        return (imm, SWAPPED[name], a2, consts[a1], last)
+    return instr
+
+def propagate(code, escapes):
+    # Constant folding and copy propagation within basic blocks.
+    out = []
+    consts = dict()
+    copies = dict()
+
+    def kill(var):
+        consts.pop(var, None)
+        copies.pop(var, None)
+        for dst, src in list(copies.items()):
+            if src == var:
+                del copies[dst]
+
+    for instr in code:
+        op = instr[0]
+        if op == 'label':
+            consts.clear()
+            copies.clear()
+            out.append(instr)
+            continue
+
+        instr = rename_uses(instr, copies)
+        instr = fold(instr, consts) or instr
+        instr = specialize(instr, consts)
+        op = instr[0]
+
+        taken = None
+        if op == 'jmpf' and isinstance(consts.get(instr[1]), int):
+            taken = not consts[instr[1]]
+        elif op == 'jmpf_cmpi' and isinstance(consts.get(instr[2]), int):
+            taken = not IR_COMPARE[instr[1]](consts[instr[2]], instr[3])
+        if taken is not None:
+            if not taken:
+                continue
+            instr = ('jmp', instr[-1])
+            op = 'jmp'
+        if op == 'mov' and instr[1] == instr[2]:
+            continue
+
+        dst = instr_def(instr)
+        if dst is not None:
+            kill(dst)
+        if op == 'call':
+            for var in escapes:
+                kill(var)
+        if op == 'const':
+            consts[instr[2]] = instr[1]
+        elif op == 'mov':
+            copies[instr[2]] = instr[1]
+
+        out.append(instr)
+        if op in ('jmp', 'ret'):
+            consts.clear()
+            copies.clear()
+    return out
+
+def split_blocks(code):
+    blocks = [[]]
+    for instr in code:
+        if instr[0] == 'label' and blocks[-1]:
+            blocks.append([])
+        blocks[-1].append(instr)
+        if instr[0] in BRANCHES:
+            blocks.append([])
+    return [block for block in blocks if block]
+
+def block_succs(blocks):
+    label2block = dict()
+    for i, block in enumerate(blocks):
+        for instr in block:
+            if instr[0] != 'label':
+                break
+            label2block[instr[1]] = i
+
+    succs = []
+    for i, block in enumerate(blocks):
+        last = block[-1]
+        out = []
+        if last[0] in JUMPS:
+            out.append(label2block[last[-1]])
+        if last[0] not in ('jmp', 'ret') and i + 1 < len(blocks):
+            out.append(i + 1)
+        succs.append(out)
+    return succs
+
+def remove_unreachable(code):
+    blocks = split_blocks(code)
+    if not blocks:
+        return code
+    succs = block_succs(blocks)
+    seen = {0}
+    todo = [0]
+    while todo:
+        for nxt in succs[todo.pop()]:
+            if nxt not in seen:
+                seen.add(nxt)
+                todo.append(nxt)
+    return [instr for i, block in enumerate(blocks) if i in seen for instr in block]
+
+def remove_dead_stores(code, funcs, escapes):
+    blocks = split_blocks(code)
+    succs = block_succs(blocks)
+    uses = lambda instr: instr_uses(instr, funcs, escapes)
+
+    live_in = [set() for _ in blocks]
+    changed = True
+    while changed:
+        changed = False
+        for i in reversed(range(len(blocks))):
+            live = set().union(*(live_in[s] for s in succs[i]))
+            for instr in reversed(blocks[i]):
+                dst = instr_def(instr)
+                if dst is not None:
+                    live.discard(dst)
+                live.update(uses(instr))
+            if live != live_in[i]:
+                live_in[i] = live
+                changed = True
+
+    out = []
+    for i, block in enumerate(blocks):
+        live = set().union(*(live_in[s] for s in succs[i]))
+        kept = []
+        for instr in reversed(block):
+            dst = instr_def(instr)
+            if dst is not None and dst not in live and instr[0] in PURE:
+                if not (instr[0].startswith('binop') and instr[1] in ('/', '%')):
+                    continue
+            # `op ... t; mov t v` with t dead afterwards becomes `op ... v`.
+            # Liveness above the pair is the same either way.
+            last = kept[-1] if kept else None
+            if (last and last[0] == 'mov' and last[1] == dst
+                    and instr[0] in WRITES_LAST and dst not in last_live):
+                kept.pop()
+                instr = instr[:-1] + (last[2],)
+            last_live = set(live)
+            if dst is not None:
+                live.discard(dst)
+            live.update(uses(instr))
+            kept.append(instr)
+        out.extend(reversed(kept))
+    return out
+
+def thread_jumps(code):
+    # Where each label leads: the first real instruction after it.
+    target = dict()
+    for i, instr in enumerate(code):
+        if instr[0] == 'label':
+            j = i
+            while j < len(code) and code[j][0] == 'label':
+                j += 1
+            target[instr[1]] = code[j] if j < len(code) else None
+
+    def final(label):
+        seen = set()
+        while label not in seen:
+            seen.add(label)
+            nxt = target.get(label)
+            if not nxt or nxt[0] != 'jmp':
+                break
+            label = nxt[1]
+        return label
+
+    out = []
+    for i, instr in enumerate(code):
+        if instr[0] in JUMPS:
+            label = final(instr[-1])
+            instr = instr[:-1] + (label,)
+            # A jump to a return is just the return.
+            nxt = target.get(label)
+            if instr[0] == 'jmp' and nxt and nxt[0] == 'ret':
+                instr = nxt
+            # A jump to the next instruction does nothing.
+            j = i + 1
+            while j < len(code) and code[j][0] == 'label':
+                if code[j][1] == label:
+                    instr = None
+                    break
+                j += 1
+        if instr:
+            out.append(instr)
+    return out
+
+def remove_unused_labels(code):
+    used = {instr[-1] for instr in code if instr[0] in JUMPS}
+    return [instr for instr in code if instr[0] != 'label' or instr[1] in used]
+
+def rename_slots(instr, use, dst):
+    op = instr[0]
+    if op in ('const', 'get_env'):
+        return instr[:-1] + (dst(instr[-1]),)
+    if op == 'mov':
+        return ('mov', use(instr[1]), dst(instr[2]))
+    if op in ('binop', 'binop8'):
+        return instr[:2] + (use(instr[2]), use(instr[3]), dst(instr[4]))
+    if op in ('unop', 'unop8', 'load', 'alloc'):
+        return instr[:2] + (use(instr[2]), dst(instr[3]))
+    if op == 'ptradd':
+        return instr[:2] + (use(instr[2]), use(instr[3]), dst(instr[4]))
+    if op == 'store':
+        return instr[:2] + (use(instr[2]), use(instr[3]))
+    if op == 'binopi':
+        return instr[:2] + (use(instr[2]), instr[3], dst(instr[4]))
+    if op == 'jmpf_cmp':
+        return instr[:2] + (use(instr[2]), use(instr[3]), instr[4])
+    if op == 'jmpf_cmpi':
+        return instr[:2] + (use(instr[2]),) + instr[3:]
+    if op in ('jmpf', 'ret') and instr[1] >= 0:
+        return (op, use(instr[1])) + instr[2:]
+    if op == 'set_env':
+        return instr[:3] + (use(instr[3]),)
+    if op == 'call':
+        return instr[:2] + (dst(instr[2]),) + instr[3:]
+    return instr
+
+def frame_size(func: Func, code, funcs):
+    size = func.nargs
+    for instr in code:
+        dst = instr_def(instr)
+        if dst is not None:
+            size = max(size, dst + 1)
+        for var in instr_uses(instr, funcs, ()):
+            size = max(size, var + 1)
+    return size
+
+def compact_slots(func: Func, code, funcs, escapes):
+    # Re-allocates frame slots from liveness. Every definition of a slot
+    # together with the uses it reaches forms a web; webs that are never
+    # live at the same time may share a slot. Slots that nested functions
+    # reach are left alone, the arguments stay where the caller put them,
+    # and the argument block of a call stays contiguous: its webs are
+    # placed together as a group with fixed offsets from the block start.
+    # Returns the new code, or None if the slots cannot be improved.
+    blocks = split_blocks(code)
+    if not blocks:
+        return None
+    succs = block_succs(blocks)
+    preds = [[] for _ in blocks]
+    for i, out in enumerate(succs):
+        for nxt in out:
+            preds[nxt].append(i)
+
+    def operands(instr):
+        dst = instr_def(instr)
+        defs = () if dst is None or dst in escapes else (dst,)
+        uses = tuple(var for var in instr_uses(instr, funcs, ()) if var not in escapes)
+        return defs, uses
+
+    ops = [[operands(instr) for instr in block] for block in blocks]
+
+    # Reaching definitions. A definition is (block, index, slot); the
+    # values a slot holds on entry are defined at (-1, -1, slot).
+    slots = {var for block in ops for defs, uses in block for var in defs + uses}
+    entry = {var: frozenset([(-1, -1, var)]) for var in slots}
+    reach_out = [dict() for _ in blocks]
+    reach_in = [dict() for _ in blocks]
+    changed = True
+    while changed:
+        changed = False
+        for b in range(len(blocks)):
+            cur = dict(entry) if b == 0 else dict()
+            for p in preds[b]:
+                for var, defs in reach_out[p].items():
+                    cur[var] = cur.get(var, frozenset()) | defs
+            reach_in[b] = dict(cur)
+            for i, (defs, _) in enumerate(ops[b]):
+                for var in defs:
+                    cur[var] = frozenset([(b, i, var)])
+            if cur != reach_out[b]:
+                reach_out[b] = cur
+                changed = True
+
+    # Definitions that reach a common use belong to the same web.
+    parent = dict()
+
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    reached = [[None] * len(block) for block in blocks]
+    for b in range(len(blocks)):
+        cur = dict(reach_in[b])
+        for i, (defs, uses) in enumerate(ops[b]):
+            reached[b][i] = []
+            for var in uses:
+                first, *rest = cur[var]
+                for other in rest:
+                    parent[find(other)] = find(first)
+                reached[b][i].append(first)
+            for var in defs:
+                cur[var] = frozenset([(b, i, var)])
+
+    webs = [[(tuple(find((b, i, var)) for var in defs),
+              tuple(find(d) for d in reached[b][i]))
+             for i, (defs, _) in enumerate(ops[b])] for b in range(len(blocks))]
+
+    # Liveness and interference over webs.
+    live_in = [set() for _ in blocks]
+    changed = True
+    while changed:
+        changed = False
+        for b in reversed(range(len(blocks))):
+            live = set().union(*(live_in[s] for s in succs[b]))
+            for defs, uses in reversed(webs[b]):
+                live.difference_update(defs)
+                live.update(uses)
+            if live != live_in[b]:
+                live_in[b] = live
+                changed = True
+
+    adj = dict()
+    for b, block in enumerate(blocks):
+        live = set().union(*(live_in[s] for s in succs[b]))
+        for instr, (defs, uses) in zip(reversed(block), reversed(webs[b])):
+            for web in defs + uses:
+                adj.setdefault(web, set())
+            for web in defs:
+                for other in live:
+                    # A move does not make its source and target conflict.
+                    if other != web and not (instr[0] == 'mov' and uses == (other,)):
+                        adj[web].add(other)
+                        adj.setdefault(other, set()).add(web)
+            live.difference_update(defs)
+            live.update(uses)
+
+    # Groups of webs with fixed offsets from a common base. The group
+    # PINNED has base 0: it holds the arguments as they come in.
+    PINNED = 0
+    group = dict()
+    members = {PINNED: dict()}
+
+    gids = itertools.count(PINNED + 1)
+
+    def new_group():
+        gid = next(gids)
+        members[gid] = dict()
+        return gid
+
+    def join(web, gid, off):
+        if web not in group:
+            group[web] = (gid, off)
+            members[gid][web] = off
+            return True
+        other, other_off = group[web]
+        if other == gid:
+            return other_off == off
+        if other == PINNED:
+            gid, other, off, other_off = other, gid, other_off, off
+        delta = off - other_off
+        for web, off in members.pop(other).items():
+            group[web] = (gid, off + delta)
+            members[gid][web] = off + delta
+        return True
+
+    for var in range(func.nargs):
+        if var not in escapes:
+            join(find((-1, -1, var)), PINNED, var)
+    for b, block in enumerate(blocks):
+        for instr, (defs, uses) in zip(block, webs[b]):
+            if instr[0] != 'call':
+                continue
+            start, nargs = instr[2], funcs[instr[1]].nargs
+            if escapes.intersection(range(start, start + max(nargs, 1))):
+                return None
+            gid = new_group()
+            if not all(join(web, gid, k) for k, web in enumerate(uses)):
+                return None
+            if defs and not join(defs[0], gid, 0):
+                return None
+    for web in adj:
+        if web not in group:
+            join(web, new_group(), 0)
+
+    color = dict()
+
+    def fits(gid, base):
+        placed = dict()
+        for web, off in members[gid].items():
+            slot = base + off
+            if slot < 0 or slot in escapes:
+                return None
+            if any(color.get(n, placed.get(n)) == slot for n in adj.get(web, ())):
+                return None
+            placed[web] = slot
+        return placed
+
+    for gid in sorted(members, key=lambda gid: (gid != PINNED, -len(members[gid]))):
+        if not members[gid]:
+            continue
+        if gid == PINNED:
+            placed = fits(gid, 0)
+            if placed is None:
+                return None
+        else:
+            base = -min(members[gid].values())
+            while (placed := fits(gid, base)) is None:
+                base += 1
+        color.update(placed)
+
+    out = []
+    for b, block in enumerate(blocks):
+        for instr, (defs, uses) in zip(block, webs[b]):
+            slots = iter(color[web] for web in uses)
+            use = lambda var: var if var in escapes else next(slots)
+            dst = lambda var: var if var in escapes else color[defs[0]]
+            instr = rename_slots(instr, use, dst)
+            if not (instr[0] == 'mov' and instr[1] == instr[2]):
+                out.append(instr)
+
+    if frame_size(func, out, funcs) >= frame_size(func, code, funcs):
+        return None
+    return out
+
+def optimize_func(func: Func, funcs, escapes):
+    code = with_labels(func)
+    for _ in range(10):
+        before = code
+        code = thread_jumps(code)
+        code = remove_unused_labels(code)
+        code = remove_unreachable(code)
+        code = propagate(code, escapes)
+        code = remove_dead_stores(code, funcs, escapes)
+        if code == before:
+            break
+    code = compact_slots(func, code, funcs, escapes) or code
+    func.max_stack = frame_size(func, code, funcs)
+    strip_labels(func, code)
+
+def pl_optimize(root: Func):
+    # Returns (instructions before, after, slots before, after) per function.
+    escapes = escaping_slots(root)
+    stats = []
+    for func in root.funcs:
+        before = len(func.code), frame_size(func, func.code, root.funcs)
+        optimize_func(func, root.funcs, escapes[id(func)])
+        stats.append((before[0], len(func.code), before[1], func.max_stack))
+    return stats
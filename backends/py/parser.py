@@ -1,55 +1,101 @@
-def skip_space(s: str, idx: int):
-    while True:
-        save = idx
-        while idx < len(s) and s[idx].isspace():
-            idx += 1
-        if idx < len(s) and s[idx] == ';':
-            idx += 1
-            while idx < len(s) and s[idx] != '\n':
-                idx += 1
-        if idx == save:
-            break
-    return idx
+import json
+import re
+
+# One pass over the source: whitespace and comments, parentheses, and
+# atoms. String literals are matched whole so they may contain spaces
+# and parentheses, but not newlines; everything else up to a space or
+# paren is an atom.
+TOKEN = re.compile(r'(\s+|;[^\n]*)|(\()|(\))|("(?:[^"\\\n]|\\.)*"(?![^\s()])|[^\s()]+)')
+T_SPACE, T_OPEN, T_CLOSE, T_ATOM = 1, 2, 3, 4
+
+CHUNK_SIZE = 1 << 16
+
+NUMBER = re.compile(r'-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?')
+
+# The non-numeric literals json.loads accepts.
+CONSTANTS = {
+    'true': True,
+    'false': False,
+    'null': None,
+    'NaN': float('nan'),
+    'Infinity': float('inf'),
+    '-Infinity': float('-inf'),
+}
 
 def parse_atom(s: str):
-    import json
-    try:
-        return ['val', json.loads(s)]
-    except:
-        return s
-
-def parse_expr(s: str, idx: int):
-    idx = skip_space(s, idx)
-    if s[idx] == '(':
-        idx+=1
-        l = []
-        while True:
-            idx = skip_space(s, idx)
-            if idx >= len(s):
-                raise ValueError("Unclosed parenthesis")
-            if s[idx] == ')':
-                idx += 1
-                break
-            idx, v = parse_expr(s, idx)
-            l.append(v)
-        return idx, l
-    elif s[idx] == ')':
-        raise Exception("Unmatched parenthesis")
-    else:
-        start = idx
-        while idx < len(s) and not s[idx].isspace() and s[idx] not in '()':
-            idx += 1
-        return idx, parse_atom(s[start:idx])
+    # Any atom json.loads accepts is a constant, anything else a name.
+    # The common cases skip the json module.
+    if s[0] in '"[{':
+        try:
+            return ['val', json.loads(s)]
+        except ValueError:
+            return s
+    if s[0] in '-0123456789':
+        m = NUMBER.fullmatch(s)
+        if m:
+            return ['val', float(s) if m.group(1) or m.group(2) else int(s)]
+    if s in CONSTANTS:
+        return ['val', CONSTANTS[s]]
+    return s
+
+def parse_forms(chunks):
+    # Chunks must end on a line boundary; no token spans lines.
+    stack = []
+    opens = []
+    line = 1
+    for s in chunks:
+        scanned = line_start = 0
+        for m in TOKEN.finditer(s):
+            kind = m.lastindex
+            if kind == T_ATOM:
+                node = parse_atom(m.group())
+            elif kind == T_SPACE:
+                continue
+            else:
+                pos = m.start()
+                n = s.count('\n', scanned, pos)
+                if n:
+                    line += n
+                    line_start = s.rindex('\n', scanned, pos) + 1
+                scanned = pos
+                if kind == T_OPEN:
+                    stack.append([])
+                    opens.append((line, pos - line_start + 1))
+                    continue
+                if not stack:
+                    raise ValueError(f"Unmatched parenthesis at line {line}, column {pos - line_start + 1}")
+                node = stack.pop()
+                opens.pop()
+            if stack:
+                stack[-1].append(node)
+            else:
+                yield node
+        line += s.count('\n', scanned)
+    if stack:
+        line, col = opens[-1]
+        raise ValueError(f"Unclosed parenthesis at line {line}, column {col}")
+
+def read_chunks(f):
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        # Finish the line so no token is split between chunks.
+        yield chunk + f.readline()
+
+def pl_read_forms(f):
+    return parse_forms(read_chunks(f))
 
 def pl_parse(s: str):
-    idx, node = parse_expr(s, 0)
-    idx = skip_space(s, idx)
-    if idx < len(s):
+    nodes = list(parse_forms([s]))
+    if not nodes:
+        raise ValueError("Unexpected end of input")
+    if len(nodes) > 1:
         raise ValueError("Unexpected characters at the end of the input")
-    return node
+    return nodes[0]
 
 def pl_parse_prog(s: str):
-    return pl_parse('(do ' + s + ')')
+    return ['do', *parse_forms([s])]
 
 def pl_parse_main(s):
-    return pl_parse('(def (main int) () (do ' + s + '))') 
\ No newline at end of file
+    return ['def', ['main', 'int'], [], pl_parse_prog(s)]
@@ -0,0 +1,102 @@
+import contextlib
+import json
+import time
+from collections import Counter
+import interpreter
+
+# A profiler for pl_eval. While profiling() is active pl_eval reports
+# every list node it evaluates and every function it enters and leaves;
+# a tail call replaces the caller's frame, just as it does at run time.
+# Times are wall clock and include the profiler's own bookkeeping.
+
+ROOT = '<main>'
+
+def key_name(key):
+    if isinstance(key, tuple):
+        name, nargs = key
+        return f'{name}/{nargs}'
+    return key
+
+def node_text(node, width=60):
+    # A one-line rendering of an AST node, cut to width.
+    def text(node):
+        if not isinstance(node, list):
+            return str(node)
+        if len(node) == 2 and node[0] == 'val':
+            return json.dumps(node[1])
+        return '(' + ' '.join(map(text, node)) + ')'
+    out = text(node)
+    return out if len(out) <= width else out[:width - 3] + '...'
+
+class Profiler:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.calls = Counter()
+        self.inclusive = Counter()
+        self.exclusive = Counter()
+        self.stacks = Counter()
+        self.hits = Counter()
+        self.nodes = dict()
+        # One [name, start, time spent in callees] per active frame.
+        self.stack = []
+
+    def hit(self, node):
+        key = id(node)
+        self.hits[key] += 1
+        if key not in self.nodes:
+            self.nodes[key] = node
+
+    def enter(self, key, tail):
+        if tail:
+            self.leave()
+        name = key_name(key)
+        self.calls[name] += 1
+        self.stack.append([name, self.clock(), 0.0])
+
+    def leave(self):
+        now = self.clock()
+        name, start, inner = self.stack.pop()
+        total = now - start
+        # Recursive frames only count once towards inclusive time.
+        if all(frame[0] != name for frame in self.stack):
+            self.inclusive[name] += total
+        self.exclusive[name] += total - inner
+        path = ';'.join(frame[0] for frame in self.stack)
+        self.stacks[f'{path};{name}' if path else name] += total - inner
+        if self.stack:
+            self.stack[-1][2] += total
+
+    def finish(self):
+        while self.stack:
+            self.leave()
+
+    def write_collapsed(self, f):
+        # The collapsed stack format of flamegraph.pl and speedscope: a
+        # semicolon-separated stack and its exclusive time in microseconds.
+        for path, seconds in sorted(self.stacks.items()):
+            usec = round(seconds * 1e6)
+            if usec > 0:
+                f.write(f'{path} {usec}\n')
+
+    def write_report(self, f, top=20):
+        f.write(f'{"function":30} {"calls":>10} {"incl ms":>10} {"excl ms":>10}\n')
+        for name, _ in self.inclusive.most_common():
+            f.write(f'{name:30} {self.calls[name]:10} '
+                    f'{self.inclusive[name] * 1e3:10.2f} {self.exclusive[name] * 1e3:10.2f}\n')
+        f.write(f'\n{"hits":>10}  node\n')
+        # Constants are not worth a line of their own.
+        hits = [(key, count) for key, count in self.hits.most_common()
+                if self.nodes[key][0] != 'val']
+        for key, count in hits[:top]:
+            f.write(f'{count:10}  {node_text(self.nodes[key])}\n')
+
+@contextlib.contextmanager
+def profiling(prof):
+    # Profiles the pl_eval calls made inside the block as one <main> frame.
+    prof.enter(ROOT, False)
+    interpreter.PROFILER = prof
+    try:
+        yield prof
+    finally:
+        interpreter.PROFILER = None
+        prof.finish()
@@ -0,0 +1,479 @@
+import itertools
+import re
+from compiler import pl_comp_main
+from func import Func
+from heap import WIDTHS
+from scope import Scope
+from utils import validate_type
+
+# Translates the typed language to Python source: one `def` per function
+# and one Python local per variable, so CPython's own bytecode does the
+# work. Programs are checked with pl_comp_main first, so exactly the
+# programs the IR backends accept are accepted here, and the generated
+# code follows the IR semantics: integer division truncates, int ops
+# wrap at 64 bits and byte ops at 8, and comparisons give 0 or 1.
+# Pointers are byte offsets into a heap laid out like heap.Heap, checked
+# against the allocated memory on every load and store.
+
+PRELUDE = '''\
+def _div(a, b):
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+def _mod(a, b):
+    return a - b * _div(a, b)
+
+_heap = bytearray(1 << 16)
+_bytes = memoryview(_heap)
+_words = _bytes.cast('q')
+_top = 8
+
+def _alloc(n, width):
+    global _bytes, _words, _top
+    if n < 0:
+        raise ValueError(f"Bad allocation of {n} elements")
+    start = _top
+    _top = (start + n * width + 7) & ~7
+    if _top > len(_heap):
+        _words.release()
+        _bytes.release()
+        _heap.extend(bytes(max(len(_heap), _top - len(_heap))))
+        _bytes = memoryview(_heap)
+        _words = _bytes.cast('q')
+    return start
+
+def _at(ptr):
+    if 0 < ptr < _top:
+        return ptr
+    raise ValueError(f"Bad pointer {ptr}: allocated memory is 8..{_top}")
+'''
+
+MAIN = '''
+if __name__ == '__main__':
+    result = main()
+    if result is not None:
+        print("Result:", result)
+'''
+
+BINOPS = {
+    '+': '({} + {})',
+    '-': '({} - {})',
+    '*': '({} * {})',
+    '/': '_div({}, {})',
+    '%': '_mod({}, {})',
+    'eq': 'int({} == {})',
+    'ne': 'int({} != {})',
+    'lt': 'int({} < {})',
+    'le': 'int({} <= {})',
+    'gt': 'int({} > {})',
+    'ge': 'int({} >= {})',
+    'and': 'int(bool({}) & bool({}))',
+    'or': 'int(bool({}) | bool({}))',
+}
+
+# The same ops where only the truth of the result matters.
+TESTS = {
+    'eq': '{} == {}',
+    'ne': '{} != {}',
+    'lt': '{} < {}',
+    'le': '{} <= {}',
+    'gt': '{} > {}',
+    'ge': '{} >= {}',
+}
+
+# Ops that can leave the range of their type.
+WIDENING = {'+', '-', '*', '/', '%'}
+
+# Wraps an int expression to signed 64 bits, inline.
+WRAP64 = '((({}) + 0x8000000000000000 & 0xffffffffffffffff) - 0x8000000000000000)'
+
+NON_IDENT = re.compile(r'\W')
+
+class PyFunc:
+    def __init__(self, prev, rtype, indent=1):
+        self.prev = prev
+        self.rtype = rtype
+        self.counter = prev.counter if prev else itertools.count(1)
+        self.scope = Scope(prev.scope if prev else None)
+        self.locals = set()
+        self.temps = set()
+        self.nonlocals = set()
+        self.lines = []
+        self.indent = indent
+
+    def emit(self, line):
+        self.lines.append('    ' * self.indent + line)
+
+    def unique(self, name):
+        name = NON_IDENT.sub('_', name)
+        if not name.isidentifier():
+            name = 'v_' + name
+        return f'{name}_{next(self.counter)}'
+
+    def tmp(self):
+        dst = f'_t{next(self.counter)}'
+        self.temps.add(dst)
+        return dst
+
+    def add_var(self, name, tp):
+        pyname = self.unique(name)
+        self.scope.names[name] = (tp, pyname, self)
+        self.locals.add(pyname)
+        return pyname
+
+    def get_var(self, name):
+        scope = self.scope
+        while scope:
+            if name in scope.names:
+                return scope.names[name]
+            scope = scope.prev
+        raise ValueError(f"Variable {name} not defined")
+
+    def scope_enter(self):
+        self.scope = Scope(self.scope)
+
+    def scope_leave(self):
+        self.scope = self.scope.prev
+
+def is_simple(node):
+    # Nodes that turn into a single Python expression, with no statements.
+    if not isinstance(node, list):
+        return True
+    if len(node) == 2 and node[0] in ('val', 'val8', 'str'):
+        return True
+    if len(node) == 3 and node[0] in BINOPS:
+        return is_simple(node[1]) and is_simple(node[2])
+    if len(node) == 2 and node[0] in ('-', 'not'):
+        return is_simple(node[1])
+    if node[0] == 'call' or node[0] == 'alloc':
+        return all(is_simple(kid) for kid in node[2:])
+    if node[0] == 'load':
+        return all(is_simple(kid) for kid in node[1:])
+    return False
+
+def has_call(node):
+    if not isinstance(node, list) or not node:
+        return False
+    return node[0] == 'call' or any(has_call(kid) for kid in node[1:])
+
+def is_inert(expr):
+    return expr.isidentifier() or expr.lstrip('-').isdigit()
+
+def hoist(pyf: PyFunc, expr):
+    if expr in pyf.temps or expr.lstrip('-').isdigit():
+        return expr
+    dst = pyf.tmp()
+    pyf.emit(f'{dst} = {expr}')
+    return dst
+
+def discard(pyf: PyFunc, expr):
+    if not is_inert(expr):
+        pyf.emit(expr)
+
+def py_comp_block(pyf: PyFunc, node, *, test=False):
+    # Compiles node one level deeper, returning the lines separately.
+    lines, pyf.lines = pyf.lines, []
+    pyf.indent += 1
+    tp, var = py_comp_expr(pyf, node, test=test)
+    body, pyf.lines = pyf.lines, lines
+    pyf.indent -= 1
+    return tp, var, body
+
+def py_emit_block(pyf: PyFunc, body, last=None):
+    pyf.lines.extend(body)
+    pyf.indent += 1
+    if last:
+        pyf.emit(last)
+    elif not body:
+        pyf.emit('pass')
+    pyf.indent -= 1
+
+def py_comp_call(pyf: PyFunc, node):
+    _, name, *args = node
+    arg_types = []
+    arg_vals = []
+    for i, kid in enumerate(args):
+        tp, var = py_comp_expr(pyf, kid)
+        # Arguments are copied as they are computed.
+        if not all(is_simple(later) for later in args[i + 1:]):
+            var = hoist(pyf, var)
+        arg_types.append(tp)
+        arg_vals.append(var)
+
+    key = (name, tuple(arg_types))
+    rtype, fname, _ = pyf.get_var(key)
+    return rtype, f'{fname}({", ".join(arg_vals)})'
+
+def py_comp_return(pyf: PyFunc, node):
+    _, *kid = node
+    tp, var = ('void',), 'None'
+    if kid:
+        tp, var = py_comp_expr(pyf, kid[0])
+    pyf.emit(f'return {var}')
+    return tp, var
+
+def py_comp_cond(pyf: PyFunc, node):
+    _, cond, yes, *no = node
+    pyf.scope_enter()
+
+    _, var = py_comp_expr(pyf, cond, allow_var=True, test=True)
+    t1, a1, yes = py_comp_block(pyf, yes)
+    t2, a2, other = ('void',), 'None', []
+    if no:
+        t2, a2, other = py_comp_block(pyf, no[0])
+    pyf.scope_leave()
+
+    dst = None
+    if t1 == t2 and t1 != ('void',):
+        dst = pyf.tmp()
+    for i, (body, val) in enumerate(((yes, a1), (other, a2))):
+        if not dst and not is_inert(val):
+            body.append('    ' * (pyf.indent + 1) + val)
+        if i and not body and not dst:
+            break
+        pyf.emit(f'if {var}:' if i == 0 else 'else:')
+        py_emit_block(pyf, body, dst and f'{dst} = {val}')
+
+    if dst:
+        return t1, dst
+    return ('void',), 'None'
+
+def py_comp_loop(pyf: PyFunc, node):
+    _, cond, body = node
+    pyf.scope_enter()
+
+    _, var, head = py_comp_block(pyf, cond, test=True)
+    if head:
+        pyf.emit('while True:')
+        py_emit_block(pyf, head, f'if not {var}: break')
+    else:
+        pyf.emit(f'while {var}:')
+
+    _, var, body = py_comp_block(pyf, body)
+    if not is_inert(var):
+        body.append('    ' * (pyf.indent + 1) + var)
+    py_emit_block(pyf, body)
+
+    pyf.scope_leave()
+    return ('void',), 'None'
+
+def py_comp_getvar(pyf: PyFunc, node):
+    tp, var, _ = pyf.get_var(node)
+    return tp, var
+
+def py_comp_setvar(pyf: PyFunc, node):
+    _, name, kid = node
+    tp, dst, owner = pyf.get_var(name)
+    _, var = py_comp_expr(pyf, kid)
+    if owner is not pyf:
+        pyf.nonlocals.add(dst)
+    pyf.emit(f'{dst} = {var}')
+    return tp, dst
+
+def py_comp_newvar(pyf: PyFunc, node):
+    _, name, kid = node
+    tp, var = py_comp_expr(pyf, kid)
+    dst = pyf.add_var(name, tp)
+    pyf.emit(f'{dst} = {var}')
+    return tp, dst
+
+def py_comp_const(pyf: PyFunc, node):
+    kind, val = node
+    tp = dict(val=('int',), val8=('byte',), str=('ptr', 'byte'))[kind]
+    return tp, repr(val)
+
+def py_comp_binop(pyf: PyFunc, node, test):
+    op, lhs, rhs = node
+    t1, a1 = py_comp_expr(pyf, lhs)
+    # The IR reads a variable operand only when the op runs, but any
+    # other operand is computed before the right side is.
+    late = a1 in pyf.locals
+    if not late and (has_call(rhs) or not is_simple(rhs)):
+        a1 = hoist(pyf, a1)
+    t2, a2 = py_comp_expr(pyf, rhs)
+    if late and has_call(rhs):
+        a2 = hoist(pyf, a2)
+
+    if 'ptr' in (t1[0], t2[0]) and op in ('+', '-'):
+        return py_comp_ptrop(op, t1, a1, t2, a2)
+
+    rtype = t1
+    if op in ('eq', 'ge', 'gt', 'le', 'ne', 'lt'):
+        rtype = ('int',)
+    if test and op in TESTS:
+        return rtype, TESTS[op].format(a1, a2)
+    expr = BINOPS[op].format(a1, a2)
+    if t1 == ('byte',) and op in WIDENING:
+        expr = f'({expr} & 255)'
+    elif op in WIDENING:
+        expr = WRAP64.format(expr)
+    return rtype, expr
+
+def py_comp_ptrop(op, t1, a1, t2, a2):
+    # Pointer arithmetic counts elements; offsets count bytes.
+    if t1 == t2:
+        return ('int',), f'(({a1} - {a2}) // {WIDTHS[t1[1]]})'
+    if t1[0] == 'ptr':
+        return t1, f'({a1} {op} {a2} * {WIDTHS[t1[1]]})'
+    return t2, f'({a1} * {WIDTHS[t2[1]]} + {a2})'
+
+def py_comp_alloc(pyf: PyFunc, node):
+    _, elem, count = node
+    _, var = py_comp_expr(pyf, count)
+    return ('ptr', elem), f'_alloc({var}, {WIDTHS[elem]})'
+
+def py_comp_item(pyf: PyFunc, ptr, index):
+    # The element type, the address and a formatter for the heap item of
+    # element index of ptr.
+    if index:
+        ptr = ['+', ptr, index[0]]
+    tp, addr = py_comp_expr(pyf, ptr)
+    if tp[1] == 'int':
+        return tp[1:], addr, lambda addr: f'_words[_at({addr}) >> 3]'
+    return tp[1:], addr, lambda addr: f'_bytes[_at({addr})]'
+
+def py_comp_load(pyf: PyFunc, node):
+    _, ptr, *index = node
+    tp, addr, item = py_comp_item(pyf, ptr, index)
+    return tp, item(addr)
+
+def py_comp_store(pyf: PyFunc, node):
+    # The IR computes the address first, but reads a variable pointer
+    # only when it stores; Python computes the value first.
+    _, ptr, *index, value = node
+    tp, addr, item = py_comp_item(pyf, ptr, index)
+    if addr not in pyf.locals and (has_call(value) or not is_simple(value)):
+        addr = hoist(pyf, addr)
+    t2, var = py_comp_expr(pyf, value)
+    if t2 != tp:
+        var = f'{var} & 255' if is_inert(var) else f'({var}) & 255'
+    pyf.emit(f'{item(addr)} = {var}')
+    return ('void',), 'None'
+
+def py_comp_unop(pyf: PyFunc, node, test):
+    op, arg = node
+    t1, a1 = py_comp_expr(pyf, arg)
+    if op == 'not':
+        return ('int',), f'not {a1}' if test else f'int(not {a1})'
+    if t1 == ('byte',):
+        return t1, f'(-{a1} & 255)'
+    return t1, WRAP64.format(f'-{a1}')
+
+def py_comp_scope(pyf: PyFunc, node):
+    pyf.scope_enter()
+    tp, var = ('void',), 'None'
+
+    groups = [[]]
+    for kid in node[1:]:
+        groups[-1].append(kid)
+        if kid[0] == 'var':
+            groups.append([])
+
+    for g in groups:
+        # Functions are visible to the whole group, so they are all
+        # defined before anything in the group runs.
+        defs = [kid for kid in g if kid[0] == 'def' and len(kid) == 4]
+        funcs = [py_scan_func(pyf, kid) for kid in defs]
+        for kid, (target, name) in zip(defs, funcs):
+            py_comp_func(pyf, kid, target, name)
+
+        for kid in g:
+            discard(pyf, var)
+            if kid[0] == 'def' and len(kid) == 4:
+                tp, var = ('void',), 'None'
+            else:
+                tp, var = py_comp_expr(pyf, kid, allow_var=True)
+    pyf.scope_leave()
+    return tp, var
+
+def py_comp_expr(pyf: PyFunc, node, *, allow_var=False, test=False):
+    # With test, the result is only used for its truth value.
+    if not isinstance(node, list):
+        return py_comp_getvar(pyf, node)
+
+    if len(node) == 2 and node[0] in ('val', 'val8', 'str'):
+        return py_comp_const(pyf, node)
+
+    if len(node) == 3 and node[0] in BINOPS:
+        return py_comp_binop(pyf, node, test)
+
+    if len(node) == 2 and node[0] in ('-', 'not'):
+        return py_comp_unop(pyf, node, test)
+
+    if node[0] in ('do', 'then', 'else'):
+        return py_comp_scope(pyf, node)
+
+    if node[0] == 'var' and len(node) == 3:
+        return py_comp_newvar(pyf, node)
+
+    if node[0] == 'set' and len(node) == 3:
+        return py_comp_setvar(pyf, node)
+
+    if len(node) in (3, 4) and node[0] in ('?', 'if'):
+        return py_comp_cond(pyf, node)
+
+    if node[0] == 'loop' and len(node) == 3:
+        return py_comp_loop(pyf, node)
+
+    if node == ['break'] or node == ['continue']:
+        pyf.emit(node[0])
+        return ('void',), 'None'
+
+    if node[0] == 'call' and len(node) >= 2:
+        return py_comp_call(pyf, node)
+
+    if node[0] == 'return' and len(node) in (1, 2):
+        return py_comp_return(pyf, node)
+
+    if node[0] == 'alloc' and len(node) == 3:
+        return py_comp_alloc(pyf, node)
+
+    if node[0] == 'load' and len(node) in (2, 3):
+        return py_comp_load(pyf, node)
+
+    if node[0] == 'store' and len(node) in (3, 4):
+        return py_comp_store(pyf, node)
+
+    raise ValueError("Invalid node")
+
+def py_scan_func(pyf: PyFunc, node):
+    _, (name, *rtype), args, _ = node
+    rtype = validate_type(rtype)
+    arg_types = tuple(validate_type(arg_type) for _, *arg_type in args)
+    pyname = 'main' if pyf.prev is None else pyf.unique(name)
+    pyf.scope.names[(name, arg_types)] = (rtype, pyname, pyf)
+    return PyFunc(pyf, rtype, pyf.indent + 1), pyname
+
+def py_comp_func(pyf: PyFunc, node, target: PyFunc, name):
+    _, _, args, body = node
+    params = [target.add_var(arg_name, validate_type(arg_type))
+              for arg_name, *arg_type in args]
+
+    _, var = py_comp_expr(target, body)
+    if target.rtype == ('void',):
+        discard(target, var)
+    else:
+        target.emit(f'return {var}')
+
+    pyf.emit(f'def {name}({", ".join(params)}):')
+    if target.nonlocals:
+        pyf.indent += 1
+        pyf.emit(f'nonlocal {", ".join(sorted(target.nonlocals))}')
+        pyf.indent -= 1
+    pyf.lines.extend(target.lines)
+    pyf.emit('')
+
+def pl_compile_py(node):
+    # Type errors are reported exactly like the IR compiler does.
+    pl_comp_main(Func(None), node)
+
+    root = PyFunc(None, None, 0)
+    target, name = py_scan_func(root, node)
+    py_comp_func(root, node, target, name)
+    return '\n'.join([PRELUDE, *root.lines, MAIN])
+
+def pl_run_py(source, filename='<pl>'):
+    code = compile(source, filename, 'exec')
+    namespace = {'__name__': 'pl_program'}
+    exec(code, namespace)
+    return namespace['main']()
@@ -0,0 +1,120 @@
+import contextlib
+import sys
+from closure import ClosureScope, UNBOUND, pl_compile_closure
+from parser import parse_forms
+
+# An interactive session on the closure engine. All input shares one
+# global scope and one global frame, which grow as names appear; each
+# form is compiled and run on its own, so the cost of an input does not
+# depend on how much came before it. Calls and reads find their target
+# through a frame slot at run time, so redefining a function or a
+# variable at the top level rebinds the slot and every existing caller
+# sees the new one without being recompiled. Names that are used before
+# they are defined get their slot on first use.
+
+PROMPT = 'pl> '
+MORE = '... '
+
+class Session:
+    def __init__(self):
+        self.scope = ClosureScope(None, ())
+        self.scope.late = True
+        self.scope.fallback = self.declare
+        self.frame = []
+        self.env = [self.frame]
+
+    def declare(self, key):
+        slot = self.scope.names.get(key)
+        if slot is None:
+            slot = self.scope.names[key] = self.scope.size
+            self.scope.size += 1
+            self.frame.append(UNBOUND)
+        return (0, slot)
+
+    def grow(self):
+        self.frame.extend([UNBOUND] * (self.scope.size - len(self.frame)))
+        self.env.extend([None] * (self.scope.depth - len(self.env)))
+
+    def compile(self, node):
+        # Each input gets a frame of its own at level 1 for the slots of
+        # its blocks, so only globals stay in the global frame.
+        scope = ClosureScope(self.scope, (), func=True)
+        code = pl_compile_closure(node, scope)
+        self.grow()
+        size = scope.size
+
+        def run(env):
+            env[1] = [UNBOUND] * size
+            return code(env)
+        return run
+
+    def defines(self, node):
+        # The global key a top-level def or var binds, if any.
+        if not isinstance(node, list) or not node:
+            return None
+        if node[0] == 'memo' and len(node) == 2:
+            node = node[1]
+        if node[0] == 'def' and len(node) == 4 and isinstance(node[1], str):
+            return (node[1], len(node[2]))
+        if node[0] == 'var' and len(node) == 3 and isinstance(node[1], str):
+            return node[1]
+        return None
+
+    def run(self, node):
+        key = self.defines(node)
+        if key is None:
+            return self.compile(node)(self.env)
+        _, slot = self.declare(key)
+        if isinstance(key, str) and self.frame[slot] is not UNBOUND:
+            # Declaring a variable again assigns it, so the new value
+            # may be computed from the old one.
+            return self.compile(['set', *node[1:]])(self.env)
+        code = self.compile(node)
+        old, self.frame[slot] = self.frame[slot], UNBOUND
+        try:
+            return code(self.env)
+        except BaseException:
+            if self.frame[slot] is UNBOUND:
+                self.frame[slot] = old
+            raise
+
+    def eval(self, source):
+        return [self.run(node) for node in parse_forms([source])]
+
+def complete(source):
+    # Whether source holds whole forms; anything else is an error that
+    # more input will not fix.
+    try:
+        for _ in parse_forms([source]):
+            pass
+    except ValueError as e:
+        return not str(e).startswith('Unclosed')
+    return True
+
+def pl_repl(stdin=sys.stdin, stdout=sys.stdout):
+    session = Session()
+    interactive = stdin.isatty()
+    buf = ''
+    while True:
+        if interactive:
+            stdout.write(MORE if buf else PROMPT)
+            stdout.flush()
+        line = stdin.readline()
+        if not line:
+            break
+        buf += line
+        if not complete(buf):
+            continue
+        source, buf = buf, ''
+        try:
+            with contextlib.redirect_stdout(stdout):
+                for node in list(parse_forms([source])):
+                    result = session.run(node)
+                    if result is not None:
+                        print(result)
+        except KeyboardInterrupt:
+            print('Interrupted', file=stdout)
+        except Exception as e:
+            print(f'Error: {e}', file=stdout)
+    if buf.strip():
+        print('Error: unexpected end of input', file=stdout)
@@ -0,0 +1,57 @@
+# String values built with `+` in pl_eval and the closure engine. A Rope
+# is a run of parts that is joined only when its text is needed: when it
+# is printed, compared, used as a path or handed back to Python. Ropes
+# made by appending to one another share a single list of parts, each
+# covering a prefix of it, so `(set s (+ s x))` in a loop appends in
+# amortised O(1) and earlier values of s stay unchanged. Appending to a
+# rope that is no longer the longest one on its list copies its prefix.
+
+class Rope:
+    __slots__ = ('parts', 'n', 'size')
+
+    def __init__(self, parts, n, size):
+        self.parts = parts
+        self.n = n
+        self.size = size
+
+    def __str__(self):
+        if self.n != 1:
+            # Joined once; the rope keeps the result as its only part.
+            self.parts = [''.join(self.parts[:self.n])]
+            self.n = 1
+        return self.parts[0]
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return self.size > 0
+
+    def __eq__(self, other):
+        if isinstance(other, STRINGS):
+            return str(self) == str(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __repr__(self):
+        return repr(str(self))
+
+STRINGS = (str, Rope)
+
+def concat(lhs, rhs):
+    # lhs + rhs where either is a string; anything else is converted
+    # with str(), as before.
+    text = str(rhs)
+    if isinstance(lhs, Rope):
+        parts = lhs.parts
+        if lhs.n != len(parts):
+            parts = parts[:lhs.n]
+        parts.append(text)
+        return Rope(parts, len(parts), lhs.size + len(text))
+    lhs = str(lhs)
+    return Rope([lhs, text], 2, len(lhs) + len(text))
+
+def flatten(val):
+    return str(val) if isinstance(val, Rope) else val
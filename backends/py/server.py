@@ -0,0 +1,147 @@
+import contextlib
+import functools
+import json
+import os
+import signal
+import socket
+import sys
+from interpreter import pl_eval
+from closure import pl_eval_fast
+from vm import pl_run_ir
+from cache import pl_load_prog, pl_load_ir
+from rope import flatten
+
+# A warm interpreter on a Unix domain socket. The parent process binds
+# the socket and forks a pool of workers that all accept() on it; the
+# imports are paid for once, before the fork, while each worker fills
+# parse and IR caches of its own as requests come in. Each connection
+# carries one request, a JSON object on one line:
+#
+#   {"source": "...", "engine": "interpret"}
+#   {"file": "/abs/path.pl_lang", "engine": "run-ir", "optimize": true}
+#
+# and gets back JSON lines: {"out": text} for everything the program
+# prints, as it prints it, then {"result": value} or {"error": message}.
+# Every request runs in a fresh global environment, and one that runs
+# past the server's time limit gets an error instead of a result.
+
+ENGINES = ('interpret', 'interpret-fast', 'run-ir')
+
+class Timeout(Exception):
+    pass
+
+def on_alarm(signum, frame):
+    raise Timeout()
+
+@functools.lru_cache(maxsize=256)
+def load_prog(source):
+    return pl_load_prog(source)
+
+@functools.lru_cache(maxsize=256)
+def load_ir(source, optimize):
+    root, _ = pl_load_ir(source, optimize)
+    return root
+
+def run_request(req):
+    if 'source' in req:
+        source = req['source']
+    else:
+        with open(req['file']) as f:
+            source = f.read()
+    engine = req.get('engine', 'interpret')
+    if engine == 'interpret':
+        return flatten(pl_eval((dict(), None), load_prog(source)))
+    if engine == 'interpret-fast':
+        return flatten(pl_eval_fast(load_prog(source)))
+    if engine == 'run-ir':
+        return pl_run_ir(load_ir(source, bool(req.get('optimize'))))
+    raise ValueError(f"Unknown engine {engine}")
+
+class StreamOut:
+    # Sends whatever is written to it to the client straight away.
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, text):
+        if text:
+            send(self.conn, {'out': text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+def send(conn, msg):
+    conn.sendall((json.dumps(msg) + '\n').encode())
+
+def handle(conn, timeout):
+    with conn, conn.makefile('r') as f:
+        try:
+            req = json.loads(f.readline())
+            with contextlib.redirect_stdout(StreamOut(conn)):
+                # A timeout of 0 disarms the timer: no limit.
+                signal.setitimer(signal.ITIMER_REAL, timeout)
+                try:
+                    result = run_request(req)
+                finally:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+            if not isinstance(result, (int, float, str, bool, type(None))):
+                result = repr(result)
+            send(conn, {'result': result})
+        except BrokenPipeError:
+            pass
+        except Timeout:
+            with contextlib.suppress(OSError):
+                send(conn, {'error': f'Timed out after {timeout}s'})
+        except Exception as e:
+            try:
+                send(conn, {'error': str(e)})
+            except OSError:
+                pass
+
+def worker(sock, timeout):
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGALRM, on_alarm)
+    while True:
+        conn, _ = sock.accept()
+        handle(conn, timeout)
+
+def spawn(sock, timeout):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            worker(sock, timeout)
+        finally:
+            os._exit(1)
+    return pid
+
+def pl_serve(path, workers=os.cpu_count() or 1, timeout=10.0):
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(64)
+    pids = {spawn(sock, timeout) for _ in range(workers)}
+    print(f"Serving on {path} with {workers} workers", file=sys.stderr)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while True:
+            # A worker that dies is replaced.
+            pid, _ = os.wait()
+            pids.discard(pid)
+            pids.add(spawn(sock, timeout))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in pids:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+        for pid in pids:
+            with contextlib.suppress(ChildProcessError):
+                os.waitpid(pid, 0)
+        sock.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
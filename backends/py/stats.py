@@ -0,0 +1,34 @@
+import contextlib
+import time
+
+# Compile statistics for --stats: the wall clock time of each phase a
+# program goes through, in the order the phases first ran, and a few
+# sizes of the program. A phase that runs more than once adds up.
+
+class PhaseTimes:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.seconds = dict()
+        self.counts = dict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + self.clock() - start
+
+    def count(self, name, n):
+        self.counts[name] = n
+
+    def write_report(self, f):
+        for name, seconds in self.seconds.items():
+            f.write(f'{name:12} {seconds:10.4f}s\n')
+        f.write(f'{"total":12} {sum(self.seconds.values()):10.4f}s\n')
+        for name, n in self.counts.items():
+            f.write(f'{name:12} {n:10}\n')
+
+def timed(stats, name):
+    # stats.phase(name), or nothing when no stats are being kept.
+    return stats.phase(name) if stats else contextlib.nullcontext()
@@ -1,5 +1,71 @@
 from interpreter import pl_eval
-from parser import pl_parse_prog
+from closure import pl_eval_fast
+import contextlib
+import importlib.util
+import io
+import platform
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import parser
+from parser import pl_parse, pl_parse_prog, pl_parse_main, pl_read_forms
+from compiler import pl_comp_main
+from func import Func
+from vm import pl_run_ir
+from optimizer import pl_optimize
+from heap import Heap
+from pygen import pl_compile_py, pl_run_py
+from cgen import pl_compile_c, pl_build_c
+from asmgen import pl_compile_asm, pl_build_asm
+import cache
+from cache import pl_load_prog, pl_load_ir
+from nodes import NodeTable, pl_intern
+from client import pl_request
+from repl import Session, pl_repl
+from batch import pl_batch
+import interpreter
+from profiler import Profiler, profiling
+from stats import PhaseTimes
+import vectorize
+from vectorize import pl_map, pl_map_csv
+import memo
+from memo import pl_memoize
+import fileio
+from rope import Rope
+
+def test_parse():
+    assert pl_parse_prog('(print "Hello, (world)") ; done') == [
+        'do', ['print', ['val', 'Hello, (world)']]]
+    assert pl_parse('(f -1 2.5 null x-y)') == [
+        'f', ['val', -1], ['val', 2.5], ['val', None], 'x-y']
+    assert pl_parse('(f [1,"a"] {} {"k":[]} [x)') == [
+        'f', ['val', [1, 'a']], ['val', {}], ['val', {'k': []}], '[x']
+
+    depth = 100000
+    node = pl_parse('(' * depth + ')' * depth)
+    for _ in range(depth - 1):
+        node, = node
+    assert node == []
+
+    try:
+        pl_parse_prog('(do\n  (var a 1)\n  (print a)')
+        assert False
+    except ValueError as e:
+        assert str(e) == 'Unclosed parenthesis at line 1, column 1'
+
+def test_read_forms():
+    src = '(var s "a b")\n(def f (x)\n  (+ x 1))\n; comment\n(call f 2)\n' * 50
+    save = parser.CHUNK_SIZE
+    parser.CHUNK_SIZE = 7
+    try:
+        forms = list(pl_read_forms(io.StringIO(src)))
+    finally:
+        parser.CHUNK_SIZE = save
+    assert ['do', *forms] == pl_parse_prog(src)
 
 def test_eval():
     def f(s):
@@ -44,5 +110,788 @@ def test_eval():
         (call add "foo")
     '''))
 
+    # Tail calls run in constant stack.
+    assert f('''
+        (def fib (n acc)
+            (if (le n 0)
+                (then acc)
+                (else (return (call fib (- n 1) (+ acc n))))))
+        (call fib 100000 0)
+    ''') == 100000 * 100001 // 2
+
+    assert f('''
+        (def find (n) (do
+            (var i 0)
+            (loop 1 (do
+                (set i (+ i 1))
+                (if (ge (* i i) n) (return i))
+            ))
+        ))
+        (call find 50)
+    ''') == 8
+
+def test_eval_fast():
+    def f(s):
+        return pl_eval_fast(pl_parse_prog(s))
+
+    assert f('''
+        (def fib (n)
+            (if (le n 0)
+                (then 0)
+                (else (+ n (call fib (- n 1))))))
+        (call fib 5)
+    ''') == 5 + 4 + 3 + 2 + 1
+
+    assert f('''
+        (def fib (n) (do
+            (var r 0)
+            (loop (gt n 0) (do
+                (set r (+ r n))
+                (set n (- n 1))
+                (if (eq n 2) (break))
+            ))
+            (return r)
+        ))
+        (call fib 5)
+    ''') == 5 + 4 + 3
+
+    assert f('''
+        (def add (n) (do
+            (var r "1")
+            (return (+ r n))
+        ))
+        (call add 5)
+    ''') == "15"
+
+    # Names resolve to the innermost declaration that has already run.
+    assert f('''
+        (var x 1)
+        (var r 0)
+        (do
+            (def g () x)
+            (set r (call g))
+            (var x 10)
+            (+ r (call g)))
+    ''') == 11
+
+    # Each iteration starts with none of the body's names declared.
+    src = '''
+        (var x 1)
+        (var s 0)
+        (var i 0)
+        (loop (lt i 3) (do
+            (def g () x)
+            (set s (+ s (call g)))
+            (var x 100)
+            (set s (+ s (call g)))
+            (set i (+ i 1))))
+        s
+    '''
+    assert f(src) == pl_eval((dict(), None), pl_parse_prog(src)) == 303
+
+def test_run_ir():
+    def f(s):
+        fenv = Func(None)
+        pl_comp_main(fenv, pl_parse_main(s))
+        return pl_run_ir(fenv)
+
+    assert f('''
+        (def (fib int) ((n int))
+            (if (le n 0)
+                (then 0)
+                (else (+ n (call fib (- n 1))))))
+        (call fib 5)
+    ''') == 5 + 4 + 3 + 2 + 1
+
+    assert f('''
+        (var total 0)
+        (def (bump void) ((k int)) (do
+            (set total (+ total k))
+        ))
+        (var i 0)
+        (loop (lt i 5) (do
+            (call bump i)
+            (set i (+ i 1))
+        ))
+        total
+    ''') == 0 + 1 + 2 + 3 + 4
+
+    assert f('(/ (- 0 7) 2)') == -3
+    assert f('(if (lt 5 3) 1 2)') == 2
+
+    # Compares fuse into the branch and constant operands are immediates.
+    fenv = Func(None)
+    pl_comp_main(fenv, pl_parse_main('''
+        (var i 0)
+        (loop (gt 10 i) (set i (+ 1 i)))
+        i
+    '''))
+    assert [instr[0] for instr in fenv.funcs[0].code] == [
+        'const', 'jmpf_cmpi', 'binopi', 'jmp', 'ret']
+    assert pl_run_ir(fenv) == 10
+
+def test_optimize():
+    def f(s):
+        plain = Func(None)
+        pl_comp_main(plain, pl_parse_main(s))
+        fenv = Func(None)
+        pl_comp_main(fenv, pl_parse_main(s))
+        counts = pl_optimize(fenv)
+        for before, after, slots_before, slots_after in counts:
+            assert after <= before and slots_after <= slots_before
+        assert pl_run_ir(fenv) == pl_run_ir(plain)
+        return counts
+
+    f('''
+        (var s 0) (var i 0)
+        (loop (lt i 100) (do
+            (set i (+ i 1))
+            (if (eq (% i 3) 0) (continue))
+            (if (gt i 50) (break))
+            (set s (+ s (* i 2)))))
+        s
+    ''')
+
+    f('''
+        (def (outer int) ((a int)) (do
+            (var x (* a 2))
+            (def (inner int) ((b int)) (do (set x (+ x b)) (* x 3)))
+            (var y (call inner 5))
+            (+ x y)))
+        (call outer 7)
+    ''')
+
+    (before, after, _, _), = f('''
+        (var a (+ 2 3)) (var b (* a 4)) (var c (- b a))
+        (if (gt c 10) (set a (/ (- 0 c) 4)) (set a 0))
+        (+ a (% (- 0 17) 5))
+    ''')
+    assert after < before
+
+    # Values that are dead by the time the next one is made share a slot,
+    # while call arguments stay contiguous.
+    (_, _, slots_before, slots_after), _ = f('''
+        (def (add int) ((x int) (y int) (z int)) (+ x (* y z)))
+        (var a (call add 1 2 3))
+        (var b (call add a (+ a 1) 2))
+        (var c (call add b b a))
+        (call add c 1 (- 0 c))
+    ''')
+    assert slots_after < slots_before
+
+    # Known operands become immediates after propagation.
+    fenv = Func(None)
+    pl_comp_main(fenv, pl_parse_main('''
+        (def (f int) ((x int)) (do (var k 3) (set x (* x k)) (if (eq k x) 0 x)))
+        (call f 2)
+    '''))
+    pl_optimize(fenv)
+    code = fenv.funcs[1].code
+    assert not any(instr[0] in ('binop', 'jmpf_cmp') for instr in code)
+    assert pl_run_ir(fenv) == 6
+
+def test_compile_py():
+    def f(s):
+        fenv = Func(None)
+        pl_comp_main(fenv, pl_parse_main(s))
+        result = pl_run_py(pl_compile_py(pl_parse_main(s)))
+        assert result == pl_run_ir(fenv)
+        return result
+
+    assert f('''
+        (def (fib int) ((n int))
+            (if (le n 1) (then n) (else (+ (call fib (- n 1)) (call fib (- n 2))))))
+        (var total 0)
+        (def (bump void) ((k int)) (do (set total (+ total k))))
+        (var i 0)
+        (loop (lt i 10) (do (call bump i) (set i (+ i 1))))
+        (+ (call fib 15) total)
+    ''') == 610 + 45
+
+    # A variable operand is read when the op runs, after the right side.
+    assert f('''
+        (var x 1)
+        (def (g int) () (do (set x 10) 1))
+        (+ x (call g))
+    ''') == 11
+    assert f('(var x 1) (+ (+ x 0) (set x 5))') == 6
+
+    assert f('''
+        (var i 0) (var s 0)
+        (loop (lt (set i (+ i 1)) 10)
+            (if (eq (% i 2) 0) (continue) (set s (+ s i))))
+        (+ s (/ (- 0 9) 2))
+    ''') == 25 - 4
+
+def check_native(compile, build, s, optimize=False):
+    fenv = Func(None)
+    pl_comp_main(fenv, pl_parse_main(s))
+    if optimize:
+        pl_optimize(fenv)
+    expected = pl_run_ir(fenv)
+    with tempfile.TemporaryDirectory() as tmp:
+        exe = os.path.join(tmp, 'prog')
+        build(compile(fenv), exe)
+        out = subprocess.run([exe], capture_output=True, text=True).stdout
+    assert out == f'Result: {expected}\n'
+
+NATIVE_SRC = '''
+        (def (fib int) ((n int))
+            (if (le n 1) (then n) (else (+ (call fib (- n 1)) (call fib (- n 2))))))
+        (var total 0)
+        (def (bump void) ((k int)) (do
+            (def (add void) () (set total (+ total k)))
+            (call add)))
+        (var i 0)
+        (loop (lt i 10) (do (call bump i) (set i (+ i 1))))
+        (+ (call fib 15) (+ total (% (- 0 7) 2)))
+'''
+
+def test_compile_c():
+    if not shutil.which(os.environ.get('CC', 'gcc')):
+        return
+    check_native(pl_compile_c, pl_build_c, NATIVE_SRC)
+    check_native(pl_compile_c, pl_build_c, NATIVE_SRC, optimize=True)
+
+def test_compile_asm():
+    if platform.system() != 'Linux' or platform.machine() != 'x86_64':
+        return
+    if not (shutil.which('as') and shutil.which('ld')):
+        return
+    check_native(pl_compile_asm, pl_build_asm, NATIVE_SRC)
+    check_native(pl_compile_asm, pl_build_asm, NATIVE_SRC, optimize=True)
+    check_native(pl_compile_asm, pl_build_asm, POINTER_SRC, optimize=True)
+    check_native(pl_compile_asm, pl_build_asm, WRAP_SRC)
+
+POINTER_SRC = '''
+        (def (sum int) ((p ptr int) (n int)) (do
+            (var s 0)
+            (var end (+ p n))
+            (loop (lt p end) (do (set s (+ s (load p))) (set p (+ p 1))))
+            s))
+        (var n 200000)
+        (var a (alloc int n))
+        (var i 0)
+        (loop (lt i n) (do (store a i (* i 3)) (set i (+ i 1))))
+        (var b (alloc byte 4))
+        (store b 1 258)
+        (store (+ b 2) (load b 1))
+        (+ (call sum a n)
+           (+ (eq (load (- (+ b 3) 1)) (load b 1)) (- (+ a 5) (+ 2 a))))
+'''
+
+WRAP_SRC = '''
+        (var x 1)
+        (var i 0)
+        (loop (lt i 63) (do (set x (* x 2)) (set i (+ i 1))))
+        (var a (alloc int 4))
+        (store a 0 (* x 3))
+        (store a 1 (- x 1))
+        (store a 2 (- 0 x))
+        (store a 3 (/ x (- 0 1)))
+        (+ (load a 0) (+ (load a 1) (+ (load a 2) (load a 3))))
+'''
+
+def test_pointers():
+    fenv = Func(None)
+    pl_comp_main(fenv, pl_parse_main(POINTER_SRC))
+    heap = Heap(64)
+    expected = 3 * 200000 * 199999 // 2 + 1 + 3
+    assert pl_run_ir(fenv, heap) == expected
+    assert heap.words[1 + 7] == 21 and heap.bytes[8 + 200000 * 8 + 2] == 2
+    assert pl_run_py(pl_compile_py(pl_parse_main(POINTER_SRC))) == expected
+
+    pl_optimize(fenv)
+    assert pl_run_ir(fenv) == expected
+    if shutil.which(os.environ.get('CC', 'gcc')):
+        check_native(pl_compile_c, pl_build_c, POINTER_SRC)
+
+    # Int arithmetic wraps at 64 bits on every backend, so results that
+    # overflow can be stored.
+    fenv = Func(None)
+    pl_comp_main(fenv, pl_parse_main(WRAP_SRC))
+    # min + max + min + min
+    expected = -1
+    assert pl_run_ir(fenv) == expected
+    assert pl_run_py(pl_compile_py(pl_parse_main(WRAP_SRC))) == expected
+    pl_optimize(fenv)
+    assert pl_run_ir(fenv) == expected
+    if shutil.which(os.environ.get('CC', 'gcc')):
+        check_native(pl_compile_c, pl_build_c, WRAP_SRC)
+
+    # Null, negative and past-the-end pointers fail instead of wrapping
+    # around the heap.
+    for s in ('(load (- (alloc int 2) 1))', '(load (- (alloc int 2) 2))',
+              '(load (+ (alloc int 2) 2))', '(do (store (- (alloc byte 1) 9) 1) 0)',
+              '(do (var p (alloc byte 3)) (store p 8 1) 0)'):
+        fenv = Func(None)
+        pl_comp_main(fenv, pl_parse_main(s))
+        for run in (lambda: pl_run_ir(fenv), lambda: pl_run_py(pl_compile_py(pl_parse_main(s)))):
+            try:
+                run()
+                assert False, s
+            except ValueError as e:
+                assert str(e).startswith('Bad pointer'), e
+
+    for s in ('(+ (alloc int 1) (alloc int 1))', '(load 1)', '(+ "a" 1)',
+              '(store (alloc byte 1) (alloc byte 1))', '(- (alloc int 1) (alloc byte 1))'):
+        try:
+            pl_comp_main(Func(None), pl_parse_main(s))
+            assert False, s
+        except ValueError:
+            pass
+
+@contextlib.contextmanager
+def temp_cache_dir():
+    # Points the compilation cache, ours and that of any child process,
+    # at a fresh directory, so tests never touch ~/.cache.
+    save = os.environ.get('PL_CACHE_DIR')
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['PL_CACHE_DIR'] = tmp
+        try:
+            yield tmp
+        finally:
+            if save is None:
+                del os.environ['PL_CACHE_DIR']
+            else:
+                os.environ['PL_CACHE_DIR'] = save
+
+def test_cache():
+    src = '''
+        (def (fib int) ((n int))
+            (if (le n 1) (then n) (else (+ (call fib (- n 1)) (call fib (- n 2))))))
+        (call fib 10)
+    '''
+    with temp_cache_dir() as tmp:
+        assert pl_load_prog(src) == pl_parse_prog(src)
+        assert pl_load_prog(src) == pl_parse_prog(src)
+        for optimize in (False, True):
+            cold, stats = pl_load_ir(src, optimize)
+            warm, warm_stats = pl_load_ir(src, optimize)
+            assert warm_stats == stats
+            assert [f.code for f in warm.funcs] == [f.code for f in cold.funcs]
+            assert pl_run_ir(warm) == pl_run_ir(cold) == 55
+        entries = lambda: sorted(n for n in os.listdir(tmp) if n != cache.USAGE)
+        assert len(entries()) == 3
+        # Stores keep count of the bytes written and only list the
+        # directory to evict once the count passes the limit.
+        sizes = {n: os.path.getsize(os.path.join(tmp, n)) for n in entries()}
+        assert cache.cache_usage(tmp) == sum(sizes.values())
+        limit = cache.CACHE_LIMIT
+        cache.CACHE_LIMIT = sum(sizes.values()) + 1
+        try:
+            pl_load_prog('(+ 1 2)')
+        finally:
+            cache.CACHE_LIMIT = limit
+        assert len(entries()) == 3
+        assert cache.cache_usage(tmp) <= sum(sizes.values()) + 1
+
+        assert cache.cache_evict(tmp, 0) == 0
+        assert entries() == []
+
+    # The cache version covers every module the front end imports.
+    here = os.path.dirname(os.path.abspath(cache.__file__))
+    seen, todo = set(), ['cache.py']
+    while todo:
+        name = todo.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        with open(os.path.join(here, name)) as f:
+            for line in f:
+                words = line.split()
+                if words[:1] in (['import'], ['from']) and os.path.exists(os.path.join(here, words[1] + '.py')):
+                    todo.append(words[1] + '.py')
+    assert seen <= set(cache.FRONT_END), seen - set(cache.FRONT_END)
+
+def test_nodes():
+    src = '''
+        (def (f int) ((x int)) (+ (* x 2) (* x 2)))
+        (print "a" 1 1.0 true -0.0 0.0 null)
+        (+ (call f 1) (call f 1))
+    '''
+    ast = pl_parse_prog(src)
+    table, root = pl_intern(ast)
+    back = table.to_list(root)
+    assert back == ast
+    assert repr(back) == repr(ast)
+    # Identical subtrees are stored and rebuilt once.
+    add = back[1][3]
+    assert add[1] is add[2]
+    assert back[3][1] is back[3][2]
+    assert table.names.count('x') == 1
+
+    loaded = NodeTable.load(table.dump())
+    assert loaded.to_list(root) == ast
+    tree = loaded.to_tree(root)
+    assert tree == ast
+    assert tree[3][1] is not tree[3][2]
+
+    depth = 100000
+    node = pl_parse('(' * depth + ')' * depth)
+    table, root = pl_intern(node)
+    assert len(table.ops) == depth
+    node = table.to_list(root)
+    for _ in range(depth - 1):
+        node, = node
+    assert node == []
+
+def test_serve():
+    if not hasattr(socket, 'AF_UNIX'):
+        return
+    here = os.path.dirname(os.path.abspath(__file__))
+    with temp_cache_dir() as tmp:
+        path = os.path.join(tmp, 'pl.sock')
+        proc = subprocess.Popen([sys.executable, os.path.join(here, 'main.py'),
+                                 '--serve', path, '--workers', '2', '--timeout', '0.5'],
+                                stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(100):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.05)
+            out = io.StringIO()
+            assert pl_request(path, {'source': '(print "hi") (var x 2) (* x 21)'}, out) == {'result': 42}
+            assert out.getvalue() == 'hi\n'
+            # Each request gets its own globals.
+            assert pl_request(path, {'source': '(var x 1) x'}) == {'result': 1}
+            assert pl_request(path, {'source': '(var x 1) x'}) == {'result': 1}
+            assert 'error' in pl_request(path, {'source': '(call nope)'})
+            src = '(def (sq int) ((n int)) (* n n)) (call sq 9)'
+            assert pl_request(path, {'source': src, 'engine': 'run-ir', 'optimize': True}) == {'result': 81}
+            # A request that never ends times out and frees its worker.
+            for _ in range(3):
+                assert pl_request(path, {'source': '(loop 1 0)'}) == {'error': 'Timed out after 0.5s'}
+            assert pl_request(path, {'source': '(+ 1 2)'}) == {'result': 3}
+        finally:
+            proc.terminate()
+            proc.wait()
+        assert not os.path.exists(path)
+
+def test_repl():
+    session = Session()
+    # Calls bind late, so a function can be used before it is defined
+    # and its callers follow a redefinition.
+    assert session.eval('(def f (n) (call g n))') == [None]
+    try:
+        session.eval('(call f 2)')
+        assert False
+    except ValueError:
+        pass
+    assert session.eval('(def g (n) (* n 10)) (call f 2)') == [None, 20]
+    assert session.eval('(def g (n) (+ n 1)) (call f 2)') == [None, 3]
+    assert session.eval('(var x 5) (var x (+ x 1)) (call g x)') == [5, 6, 7]
+    size = len(session.frame)
+    session.eval('(do (var y 1) y)')
+    assert len(session.frame) == size
+
+    out = io.StringIO()
+    pl_repl(io.StringIO('(def h (a b)\n  (+ a b))\n(call h 1 2)\n(print "hi"))\n(print "hi")\n(call h 1)\n'), out)
+    assert out.getvalue().splitlines() == [
+        '3', 'Error: Unmatched parenthesis at line 1, column 13', 'hi',
+        "Error: Name ('h', 1) not found"]
+
+def test_batch():
+    with temp_cache_dir(), tempfile.TemporaryDirectory() as tmp:
+        progs = {
+            'a.pl_lang': '(print "a") (+ 1 2)',
+            'sub/b.pl_lang': '(call nope)',
+            'sub/c.pl_lang': '(var i 0) (loop 1 (set i (+ i 1)))',
+            'skip.txt': '1',
+        }
+        for name, src in progs.items():
+            os.makedirs(os.path.dirname(os.path.join(tmp, name)), exist_ok=True)
+            with open(os.path.join(tmp, name), 'w') as f:
+                f.write(src)
+        summary = pl_batch([tmp, os.path.join(tmp, '*.pl_lang')], workers=2, timeout=0.5)
+        assert (summary['total'], summary['ok'], summary['error'], summary['timeout']) == (3, 1, 1, 1)
+        a, b, c = summary['files']
+        assert a['file'].endswith('a.pl_lang') and a['result'] == 3 and a['output'] == 'a\n'
+        assert b['status'] == 'error' and 'nope' in b['error']
+        assert c['status'] == 'timeout'
+
+def test_fileio():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'log.txt')
+        with open(path, 'w') as f:
+            f.write('a\n\nbb\n' + 'é' * 5)
+        src = f'''
+            (var it (lines "{path}"))
+            (var line null)
+            (var n 0)
+            (loop (set line (next it)) (set n (+ n 1)))
+            (var c (chunks (mmap "{path}") 3))
+            (var k 0)
+            (loop (set line (next c)) (set k (+ k 1)))
+            (+ n (+ (* k 10) (+ (next it) (file "{path}"))))
+        '''
+        expected = '460Nonea\n\nbb\n' + 'é' * 5
+        for run in (lambda: pl_eval((dict(), None), pl_parse_prog(src)),
+                    lambda: pl_eval_fast(pl_parse_prog(src))):
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                assert run() == expected
+            assert out.getvalue() == ''
+
+        # Repeated reads come from the cache until the file changes.
+        assert fileio.read_file(path) is fileio.read_file(path)
+        with open(path, 'w') as f:
+            f.write('new')
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        assert fileio.read_file(path) == 'new'
+        assert bytes(fileio.map_file(path)) == b'new'
+
+def test_rope():
+    src = '''
+        (var a (+ "x" 1))
+        (var b (+ a "1"))
+        (var c (+ a "2"))
+        (set b (+ b (+ 2.5 c)))
+        (var s "")
+        (var i 0)
+        (loop (lt i 5) (do (set s (+ s i)) (set i (+ i 1))))
+        (print (eq s "01234") (if (+ "" "") 1 2))
+        (+ b (+ "|" s))
+    '''
+    for run in (lambda: pl_eval((dict(), None), pl_parse_prog(src)),
+                lambda: pl_eval_fast(pl_parse_prog(src))):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            result = run()
+        assert isinstance(result, Rope)
+        assert str(result) == 'x11' + '2.5x12' + '|01234'
+        assert out.getvalue() == 'True 2\n'
+
+    # Appending keeps one shared list of parts.
+    s = Rope([''], 1, 0)
+    for i in range(1000):
+        s = pl_eval(({'s': s}, None), ['+', 's', ['val', 'ab']])
+    assert len(s.parts) == 1001 and len(s) == 2000
+
+def test_scale():
+    # Many functions, each calling the one before it, with shadowed names.
+    n = 3000
+    defs = ['(def (f0 int) ((x int)) x)']
+    for i in range(1, n):
+        defs.append(f'(def (f{i} int) ((x int)) (do (var y (+ x 1)) '
+                    f'(do (var x (* y 2)) (set y x)) (call f{i - 1} (- y x))))')
+    src = '\n'.join(defs) + f'\n(call f{n - 1} 5)'
+    stats = PhaseTimes()
+    fenv, _ = pl_load_ir(src, False, False, stats)
+    assert pl_run_ir(fenv) == 5 + 2 * (n - 1)
+    assert list(stats.seconds) == ['cache', 'parse', 'compile']
+    assert stats.counts['lines'] == n + 1
+    assert stats.counts['functions'] == n + 1
+    out = io.StringIO()
+    stats.write_report(out)
+    assert out.getvalue().splitlines()[3].split()[0] == 'total'
+
+    # Names leave with their scope, functions included.
+    for src in ('(do (var x 1)) x',
+                '(def (f int) () (do (def (g int) () 1) 2)) (call g)'):
+        try:
+            pl_load_ir(src, False, False)
+        except ValueError as e:
+            assert 'not defined' in str(e), e
+        else:
+            assert False, src
+
+def test_map():
+    if not importlib.util.find_spec('numpy'):
+        return
+    import numpy as np
+    src = '''
+        (def (sign int) ((x int) (y int)) (do
+            (if (eq y 0) (then (return 0)))
+            (var q (/ x y))
+            (? (lt q 0) (- q (% x y)) (+ q 100))))
+        (def (mix byte) ((a byte) (b byte)) (? (lt a b) (- a b) (* a b)))
+        (def (sum int) ((n int)) (do
+            (var s 0)
+            (loop (gt n 0) (do (set s (+ s n)) (set n (- n 1))))
+            s))
+        (def (sq int) ((x int)) (* x x))
+        (def (pow int) ((x int) (n int)) (do
+            (var r 1)
+            (loop (gt n 0) (do (set r (* r x)) (set n (- n 1))))
+            r))
+        (call sum 3)
+    '''
+    x = np.arange(-30, 30)
+    for optimize in (False, True):
+        root, _ = pl_load_ir(src, optimize, False)
+        for name, args in (('sign', (x, x[::-1] // 4)), ('mix', (x + 30, 7)),
+                           ('sum', (x % 6,)), ('sq', (x << 40,))):
+            idx = vectorize.find_func(root, name, len(args))
+            args = np.broadcast_arrays(*[np.asarray(a, np.int64) for a in args])
+            want = vectorize.vm_map(np, root, idx, args, x.shape)
+            assert np.array_equal(pl_map(src, name, *args, optimize=optimize, use_cache=False), want)
+
+    # Loops run on the VM, which wraps at 64 bits like NumPy.
+    big = np.array([3, -7, 1 << 40, (1 << 62) + 1], np.int64)
+    assert np.array_equal(pl_map(src, 'pow', big, 5, use_cache=False), big ** 5)
+
+    # Loops run on the VM.
+    root, _ = pl_load_ir(src, False, False)
+    try:
+        vectorize.vec_exec(np, root.funcs[vectorize.find_func(root, 'sum', 1)], [x], x.shape)
+    except vectorize.NotVectorizable:
+        pass
+    else:
+        assert False
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'in.csv')
+        with open(path, 'w') as f:
+            f.write('# a,b\n3,5\n5,3\n')
+        out = io.StringIO()
+        pl_map_csv(src, 'mix', path, out, use_cache=False)
+        assert out.getvalue() == '254\n15\n'
+
+def test_profile():
+    src = '''
+        (def fact (n) (if (le n 1) (then 1) (else (* n (call fact (- n 1))))))
+        (def count (n) (if (le n 0) (then 0) (else (call count (- n 1)))))
+        (+ (call fact 5) (call count 7))
+    '''
+    ast = pl_parse_prog(src)
+    prof = Profiler()
+    with profiling(prof):
+        assert pl_eval((dict(), None), ast) == 120
+    assert interpreter.PROFILER is None
+    assert prof.calls == {'<main>': 1, 'fact/1': 5, 'count/1': 8}
+    assert prof.hits[id(ast)] == 1
+    # Tail calls reuse the frame, real recursion nests.
+    assert '<main>;fact/1;fact/1;fact/1;fact/1;fact/1' in prof.stacks
+    assert not any('count/1;count/1' in path for path in prof.stacks)
+    out = io.StringIO()
+    prof.write_collapsed(out)
+    for line in out.getvalue().splitlines():
+        path, usec = line.rsplit(' ', 1)
+        assert path in prof.stacks and int(usec) > 0
+
+    # A program loaded from the cache for profiling has no shared
+    # subtrees, so each occurrence gets hits of its own.
+    src = '(def sq (n) (* n n)) (+ (call sq 3) (call sq 3))'
+    with temp_cache_dir():
+        pl_load_prog(src)
+        ast = pl_load_prog(src, shared=False)
+    add = ast[2]
+    assert add == ['+', ['call', 'sq', ['val', 3]], ['call', 'sq', ['val', 3]]]
+    assert add[1] is not add[2]
+    prof = Profiler()
+    with profiling(prof):
+        assert pl_eval((dict(), None), ast) == 18
+    assert prof.hits[id(add[1])] == prof.hits[id(add[2])] == 1
+    assert prof.inclusive['<main>'] >= prof.inclusive['fact/1']
+
+def test_memo():
+    src = '''
+        (def fib (n) (if (le n 1) (then n) (else (+ (call fib (- n 1)) (call fib (- n 2))))))
+        (var calls 0)
+        (def noisy (n) (do (set calls (+ calls 1)) n))
+        (def reader (n) (+ n calls))
+        (def user (n) (call reader n))
+        (def half (n) (/ n 2))
+        (memo (def count (n) (do (set calls (+ calls 1)) n)))
+        (+ (call fib 60) (+ (call user 1) (+ (call noisy 2) (+ (call count 5) (call count 5)))))
+    '''
+    ast = pl_memoize(pl_parse_prog(src))
+    wrapped = {kid[1][1] for kid in ast if isinstance(kid, list) and kid[0] == 'memo'}
+    assert wrapped == {'fib', 'half', 'count'}
+    memo.STATS.clear()
+    assert pl_eval((dict(), None), ast) == 1548008755920 + 1 + 2 + 5 + 5
+    assert memo.STATS[('fib', 1)].misses == 61
+    assert memo.STATS[('count', 1)].hits == 1
+    assert pl_eval_fast(pl_memoize(pl_parse_prog('(def sq (n) (* n n)) (call sq 7)'))) == 49
+
+    # Equal keys of different types are cached apart.
+    ast = pl_memoize(pl_parse_prog('(def half (n) (/ n 2)) (+ (call half 1) (call half 1.0))'))
+    assert pl_eval((dict(), None), ast) == 1.0
+
+    # Unhashable arguments are never cached and always miss.
+    ast = pl_parse_prog('(memo (def f (x) 1)) (+ (call f [1,2]) (call f {"a":[]}))')
+    for run in (lambda ast: pl_eval((dict(), None), ast), pl_eval_fast):
+        memo.STATS.clear()
+        assert run(ast) == 2
+        assert memo.STATS[('f', 1)].misses == 2
+
+    # Each closure gets its own cache, and a small one evicts.
+    src = '''
+        (def outer (k) (do (def inner (x) (+ x k)) (call inner 1)))
+        (+ (call outer 1) (call outer 2))
+    '''
+    assert pl_eval((dict(), None), pl_memoize(pl_parse_prog(src))) == 5
+    src = '''
+        (def outer (k) (do (memo (def inner (x) (+ x k))) (call inner 1)))
+        (+ (call outer 1) (call outer 2))
+    '''
+    for run in (lambda ast: pl_eval((dict(), None), ast), pl_eval_fast):
+        assert run(pl_parse_prog(src)) == 5
+    save = memo.MEMO_SIZE
+    memo.MEMO_SIZE = 2
+    try:
+        memo.STATS.clear()
+        assert pl_eval((dict(), None), pl_memoize(pl_parse_prog(
+            '(def sq (n) (* n n)) (+ (call sq 1) (+ (call sq 2) (+ (call sq 3) (call sq 1))))'))) == 15
+        assert memo.STATS[('sq', 1)].evictions == 2
+        assert memo.STATS[('sq', 1)].hits == 0
+    finally:
+        memo.MEMO_SIZE = save
+
+    # The closure engine honours (memo ...) too.
+    memo.STATS.clear()
+    assert pl_eval_fast(pl_parse_prog(
+        '(memo (def fib (n) (if (le n 1) (then n) (else (+ (call fib (- n 1)) (call fib (- n 2)))))))'
+        '(call fib 60)')) == 1548008755920
+    assert memo.STATS[('fib', 1)].misses == 61
+
+    # Names are looked up when the code runs, so reading an outer
+    # variable, or calling a key that has a second def, is not pure.
+    for src, want in (
+            ('(var x 1) (do (def g () x) (var a (call g)) (var x 10) (+ a (call g)))', 11),
+            ('(var x 1) (def g () x) (var a (call g)) (set x 10) (+ a (call g))', 11),
+            ('(def h () 1) (do (def g () (call h)) (var a (call g)) (def h () 2) (+ a (call g)))', 3),
+            ('(def g (n) (do (do (var x 1)) x)) (var x 5) (var a (call g 0)) (set x 7) (+ a (call g 0))', 12)):
+        ast = pl_memoize(pl_parse_prog(src))
+        assert 'memo' not in str(ast), src
+        assert pl_eval((dict(), None), ast) == want
+        assert pl_eval_fast(ast) == want
+
+    # Streamed forms are never analysed one at a time, and --memo-auto
+    # refuses to.
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'prog.pl_lang')
+        with open(path, 'w') as f:
+            f.write('(var c 0) (def f () c) (print (call f)) (set c 5) (print (call f))')
+        main = [sys.executable, os.path.join(here, 'main.py'), '--no-cache', path]
+        for flags in (['--interpret'], ['--interpret', '--stream'], ['--interpret', '--memo-auto']):
+            out = subprocess.run(main + flags, capture_output=True, text=True).stdout
+            assert out == '0\n5\n', (flags, out)
+        proc = subprocess.run(main + ['--interpret', '--stream', '--memo-auto'], capture_output=True)
+        assert proc.returncode != 0
+
 if __name__ == '__main__':
-    test_eval() 
\ No newline at end of file
+    test_parse()
+    test_read_forms()
+    test_eval()
+    test_eval_fast()
+    test_run_ir() 
+    test_optimize()
+    test_compile_py()
+    test_compile_c()
+    test_compile_asm()
+    test_pointers()
+    test_cache()
+    test_nodes()
+    test_serve()
+    test_repl()
+    test_batch()
+    test_fileio()
+    test_rope()
+    test_scale()
+    test_map()
+    test_profile()
+    test_memo()
@@ -1,27 +1,39 @@
 from func import Func
 
+# Instructions whose last operand is the slot they write.
+RETARGETABLE = {
+    'const', 'mov', 'binop', 'binop8', 'binopi', 'unop', 'unop8', 'get_env',
+    'alloc', 'load', 'ptradd',
+}
+
 def move_to(fenv: Func, var, dst):
-    if dst != var:
+    if dst == var:
+        return dst
+    # `op ... t; mov t dst` is `op ... dst` when t is a temporary that the
+    # previous instruction wrote and no jump lands in between.
+    last = fenv.code[-1] if fenv.code else None
+    if (last and last[0] in RETARGETABLE and last[-1] == var and var >= fenv.nvar
+            and len(fenv.code) not in fenv.labels):
+        fenv.code[-1] = last[:-1] + (dst,)
+    else:
         fenv.code.append(('mov', var, dst))
     return dst
 
-def scope_get_var(scope, name):
-    while scope:
-        if name in scope.names:
-            return scope.names[name]
-        scope = scope.prev
-    return None, -1
-
 def validate_type(tp):
     tp = tuple(tp)
-    if tp not in {('void',), ('int',), ('byte',)}:
+    if tp not in {('void',), ('int',), ('byte',), ('ptr', 'int'), ('ptr', 'byte')}:
         raise ValueError(f'unknown type of {tp}')
     return tp 
 
-def ir_dump(root: Func):
+def ir_dump(root: Func, counts=None):
     out = []
     for i, func in enumerate(root.funcs):
-        out.append(f'func{i}:')
+        if counts:
+            before, after, slots_before, slots_after = counts[i]
+            out.append(f'func{i}:    ; {before} -> {after} instructions, '
+                       f'{slots_before} -> {slots_after} slots')
+        else:
+            out.append(f'func{i}:')
         pos2labels = dict()
         for label, pos in enumerate(func.labels):
             pos2labels.setdefault(pos, []).append(label)
@@ -0,0 +1,214 @@
+from cache import pl_load_ir
+from func import Func
+from heap import Heap
+from vm import vm_load, vm_exec
+
+# Calls one top-level function of a program over whole NumPy arrays of
+# arguments, for --map and pl_map. A function whose IR only computes and
+# branches forwards runs once for all elements: every slot holds an
+# array, and every instruction runs under a mask of the elements that
+# reach it. jmpf splits the mask in two and a label joins the masks that
+# meet there, so `if` and `?` become np.where selects, and ret fills the
+# elements it ends. Ints are int64 and wrap at 64 bits like the C and asm
+# backends. A function that loops, calls, touches memory or reaches
+# outside its frame runs on the VM instead, one element at a time.
+#
+# NumPy is only imported when a function is mapped; it is listed in
+# requirements.txt.
+
+# The instructions run over arrays; jumps must go forwards.
+VECTOR_OPS = {'const', 'mov', 'binop', 'binop8', 'binopi', 'unop', 'unop8',
+              'jmpf', 'jmpf_cmp', 'jmpf_cmpi', 'jmp', 'ret'}
+
+class NotVectorizable(Exception):
+    pass
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("Mapping functions needs NumPy: pip install -r "
+                          "backends/py/requirements.txt") from None
+    return numpy
+
+def vec_div(np, a, b):
+    # Integer division truncates toward zero, like ir_div.
+    q = np.abs(a) // np.abs(b)
+    return np.where((a < 0) == (b < 0), q, -q)
+
+def vec_tables(np):
+    as_int = lambda fn: (lambda a, b: fn(a, b).astype(np.int64))
+    compare = {
+        'eq': np.equal, 'ne': np.not_equal, 'lt': np.less,
+        'le': np.less_equal, 'gt': np.greater, 'ge': np.greater_equal,
+    }
+    binops = {
+        '+': np.add,
+        '-': np.subtract,
+        '*': np.multiply,
+        '/': lambda a, b: vec_div(np, a, b),
+        '%': lambda a, b: a - b * vec_div(np, a, b),
+        'and': lambda a, b: ((a != 0) & (b != 0)).astype(np.int64),
+        'or': lambda a, b: ((a != 0) | (b != 0)).astype(np.int64),
+        **{op: as_int(fn) for op, fn in compare.items()},
+    }
+    unops = {
+        '-': np.negative,
+        'not': lambda a: (a == 0).astype(np.int64),
+    }
+    return binops, unops, compare
+
+def vec_exec(np, func: Func, args, shape):
+    # The results of func over the arrays args, all of the given shape.
+    # Masks are True for every element, False for none, or bool arrays.
+    binops, unops, compare = vec_tables(np)
+    code = func.code
+    frame = list(args) + [np.int64(0)] * max(func.max_stack + 1 - func.nargs, 0)
+    result = np.zeros(shape, np.int64)
+    joins = dict()
+
+    def lanes(mask):
+        if mask is True or mask is False:
+            return mask
+        if np.ndim(mask) == 0:
+            return bool(mask)
+        if mask.all():
+            return True
+        return mask if mask.any() else False
+
+    def both(m1, m2):
+        if m1 is False or m2 is False:
+            return False
+        return lanes(m2 if m1 is True else m1 if m2 is True else m1 & m2)
+
+    def either(m1, m2):
+        if m1 is True or m2 is True:
+            return True
+        return m2 if m1 is False else m1 if m2 is False else lanes(m1 | m2)
+
+    def jump(pc, label, mask):
+        target = func.labels[label]
+        if target <= pc:
+            raise NotVectorizable("loop")
+        if mask is not False:
+            joins[target] = either(joins.get(target, False), mask)
+
+    def put(dst, val, mask):
+        frame[dst] = val if mask is True else np.where(mask, val, frame[dst])
+
+    def apply(name, a, b, mask):
+        if name in ('/', '%'):
+            zero = b == 0
+            if np.any(zero if mask is True else zero & mask):
+                raise ZeroDivisionError("integer division or modulo by zero")
+            b = np.where(zero, 1, b)
+        return binops[name](a, b)
+
+    mask = True
+    for pc, instr in enumerate(code):
+        mask = either(mask, joins.pop(pc, False))
+        if mask is False:
+            continue
+        op = instr[0]
+        if op not in VECTOR_OPS:
+            raise NotVectorizable(op)
+        if op == 'const':
+            _, val, dst = instr
+            if not isinstance(val, int):
+                raise NotVectorizable("constant")
+            put(dst, np.int64(val), mask)
+        elif op == 'mov':
+            _, src, dst = instr
+            put(dst, frame[src], mask)
+        elif op in ('binop', 'binop8'):
+            _, name, a1, a2, dst = instr
+            val = apply(name, frame[a1], frame[a2], mask)
+            put(dst, val & 0xff if op == 'binop8' else val, mask)
+        elif op == 'binopi':
+            _, name, a1, imm, dst = instr
+            put(dst, apply(name, frame[a1], np.int64(imm), mask), mask)
+        elif op in ('unop', 'unop8'):
+            _, name, a1, dst = instr
+            val = unops[name](frame[a1])
+            put(dst, val & 0xff if op == 'unop8' else val, mask)
+        elif op == 'jmpf':
+            _, var, label = instr
+            test = frame[var] != 0
+            jump(pc, label, both(mask, ~test))
+            mask = both(mask, test)
+        elif op in ('jmpf_cmp', 'jmpf_cmpi'):
+            _, name, a1, a2, label = instr
+            rhs = np.int64(a2) if op == 'jmpf_cmpi' else frame[a2]
+            test = compare[name](frame[a1], rhs)
+            jump(pc, label, both(mask, ~test))
+            mask = both(mask, test)
+        elif op == 'jmp':
+            jump(pc, instr[1], mask)
+            mask = False
+        else:
+            if instr[1] < 0:
+                raise NotVectorizable("void")
+            result = np.where(mask, frame[instr[1]], result)
+            mask = False
+    return result
+
+def reaches_program(root: Func, idx):
+    # Whether func idx or a function it calls uses the variables of the
+    # program itself, which only exist while the program runs.
+    main = root.funcs[0]
+    seen, todo = {idx}, [idx]
+    while todo:
+        for instr in root.funcs[todo.pop()].code:
+            if instr[0] in ('get_env', 'set_env') and instr[1] == main.level:
+                return True
+            if instr[0] == 'call' and instr[1] not in seen:
+                seen.add(instr[1])
+                todo.append(instr[1])
+    return False
+
+def vm_map(np, root: Func, idx, args, shape):
+    if reaches_program(root, idx):
+        raise ValueError(f"{root.funcs[idx].name} uses variables of the program")
+    progs = [vm_load(func) for func in root.funcs]
+    display = [None] * (max(func.level for func in root.funcs) + 1)
+    heap = Heap()
+    cols = [a.ravel().tolist() for a in args]
+    rows = zip(*cols) if cols else [()]
+    out = [vm_exec(progs, idx, row, display, heap) for row in rows]
+    return np.array(out, np.int64).reshape(shape)
+
+def find_func(root: Func, name, nargs):
+    # Only functions defined at the top of the program can be called.
+    main = root.funcs[0]
+    found = [i for i, func in enumerate(root.funcs)
+             if func.prev is main and func.name == name]
+    if not found:
+        raise ValueError(f"Function {name} not defined")
+    found = [i for i in found if root.funcs[i].nargs == nargs]
+    if len(found) != 1:
+        raise ValueError(f"Function {name} has no single overload of {nargs} arguments")
+    if root.funcs[found[0]].rtype not in (('int',), ('byte',)):
+        raise ValueError(f"Function {name} does not return int or byte")
+    return found[0]
+
+def pl_map(source, name, *args, optimize=False, use_cache=True):
+    # An int64 array of `name` called on each element of args, which are
+    # arrays or scalars broadcast against each other.
+    np = import_numpy()
+    root, _ = pl_load_ir(source, optimize, use_cache)
+    idx = find_func(root, name, len(args))
+    args = np.broadcast_arrays(*[np.asarray(a, np.int64) for a in args])
+    shape = args[0].shape if args else ()
+    try:
+        with np.errstate(over='ignore'):
+            return vec_exec(np, root.funcs[idx], args, shape)
+    except NotVectorizable:
+        return vm_map(np, root, idx, args, shape)
+
+def pl_map_csv(source, name, path, out, optimize=False, use_cache=True):
+    # --map: one call per row of integers in the CSV file at path, one
+    # result per line to out. Lines starting with # are skipped.
+    np = import_numpy()
+    rows = np.loadtxt(path, dtype=np.int64, delimiter=',', ndmin=2)
+    result = pl_map(source, name, *rows.T, optimize=optimize, use_cache=use_cache)
+    np.savetxt(out, result, fmt='%d')
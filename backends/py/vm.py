@@ -0,0 +1,222 @@
+import operator
+from func import Func
+from heap import Heap
+
+def ir_div(a, b):
+    # Integer division truncates toward zero, like C.
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+def ir_mod(a, b):
+    return a - b * ir_div(a, b)
+
+INT_MIN, INT_MAX = -1 << 63, (1 << 63) - 1
+
+def wrap64(x):
+    # Word results wrap to signed 64 bits, like the C and asm backends.
+    return ((x - INT_MIN) & 0xffffffffffffffff) + INT_MIN
+
+# The word ops whose result can leave the int64 range. The VM runs them
+# unwrapped and only wraps results that are out of range.
+IR_ARITH = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': ir_div,
+    '%': ir_mod,
+}
+
+IR_BINOPS = {
+    **{op: (lambda fn: lambda a, b: wrap64(fn(a, b)))(fn) for op, fn in IR_ARITH.items()},
+    'eq': lambda a, b: int(a == b),
+    'ne': lambda a, b: int(a != b),
+    'lt': lambda a, b: int(a < b),
+    'le': lambda a, b: int(a <= b),
+    'gt': lambda a, b: int(a > b),
+    'ge': lambda a, b: int(a >= b),
+    'and': lambda a, b: int(bool(a) and bool(b)),
+    'or': lambda a, b: int(bool(a) or bool(b)),
+}
+
+# What jmpf_cmp tests; the branch needs no 0/1 value.
+IR_COMPARE = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'lt': operator.lt,
+    'le': operator.le,
+    'gt': operator.gt,
+    'ge': operator.ge,
+}
+
+IR_UNOPS = {
+    '-': lambda a: wrap64(-a),
+    'not': lambda a: int(not a),
+}
+
+def _wrap8(fn):
+    return lambda *args: fn(*args) & 0xff
+
+IR_BINOPS8 = {op: _wrap8(fn) for op, fn in IR_BINOPS.items()}
+IR_UNOPS8 = {op: _wrap8(fn) for op, fn in IR_UNOPS.items()}
+
+# Opcodes of the decoded instruction stream, roughly ordered by frequency.
+(OP_ARITH, OP_ARITHI, OP_BINOP, OP_BINOPI, OP_JMPF_CMP, OP_JMPF_CMPI, OP_MOV,
+ OP_CONST, OP_JMPF, OP_JMP, OP_UNOP, OP_LOAD, OP_LOAD8, OP_STORE, OP_STORE8,
+ OP_PTRADD, OP_CALL, OP_RET, OP_GET_ENV, OP_SET_ENV, OP_ALLOC) = range(21)
+
+def vm_load(func: Func):
+    labels = func.labels
+    code = []
+    for instr in func.code:
+        op = instr[0]
+        if op == 'binop' and instr[1] in IR_ARITH:
+            _, name, a1, a2, dst = instr
+            code.append((OP_ARITH, IR_ARITH[name], a1, a2, dst))
+        elif op in ('binop', 'binop8'):
+            table = IR_BINOPS8 if op == 'binop8' else IR_BINOPS
+            _, name, a1, a2, dst = instr
+            code.append((OP_BINOP, table[name], a1, a2, dst))
+        elif op == 'binopi' and instr[1] in IR_ARITH:
+            _, name, a1, imm, dst = instr
+            code.append((OP_ARITHI, IR_ARITH[name], a1, imm, dst))
+        elif op == 'binopi':
+            _, name, a1, imm, dst = instr
+            code.append((OP_BINOPI, IR_BINOPS[name], a1, imm, dst))
+        elif op == 'jmpf_cmp':
+            _, name, a1, a2, label = instr
+            code.append((OP_JMPF_CMP, IR_COMPARE[name], a1, a2, labels[label]))
+        elif op == 'jmpf_cmpi':
+            _, name, a1, imm, label = instr
+            code.append((OP_JMPF_CMPI, IR_COMPARE[name], a1, imm, labels[label]))
+        elif op in ('unop', 'unop8'):
+            table = IR_UNOPS8 if op == 'unop8' else IR_UNOPS
+            _, name, a1, dst = instr
+            code.append((OP_UNOP, table[name], a1, dst))
+        elif op == 'mov':
+            code.append((OP_MOV, instr[1], instr[2]))
+        elif op == 'const':
+            code.append((OP_CONST, instr[1], instr[2]))
+        elif op == 'jmpf':
+            code.append((OP_JMPF, instr[1], labels[instr[2]]))
+        elif op == 'jmp':
+            code.append((OP_JMP, labels[instr[1]]))
+        elif op == 'call':
+            _, idx, start, _, _ = instr
+            code.append((OP_CALL, idx, start))
+        elif op == 'ret':
+            code.append((OP_RET, instr[1]))
+        elif op == 'load':
+            _, width, ptr, dst = instr
+            code.append((OP_LOAD if width == 8 else OP_LOAD8, ptr, dst))
+        elif op == 'store':
+            _, width, ptr, src = instr
+            code.append((OP_STORE if width == 8 else OP_STORE8, ptr, src))
+        elif op == 'ptradd':
+            code.append((OP_PTRADD, *instr[1:]))
+        elif op == 'alloc':
+            code.append((OP_ALLOC, *instr[1:]))
+        elif op == 'get_env':
+            code.append((OP_GET_ENV, instr[1], instr[2], instr[3]))
+        elif op == 'set_env':
+            code.append((OP_SET_ENV, instr[1], instr[2], instr[3]))
+        else:
+            raise ValueError(f"Unknown instruction {op}")
+
+    # The extra slot covers the result slot of a conditional whose
+    # branches do not agree on a type: it is written but never allocated.
+    size = max(func.max_stack + 1, func.nargs)
+    return code, func.level, func.nargs, [0] * (size - func.nargs)
+
+def vm_exec(progs, idx, args, display, heap):
+    # The heap views and end are kept in locals and fetched again after
+    # an alloc, which may replace them. Pointers must point into memory
+    # that has been allocated; 0 is null.
+    words, data, top = heap.words, heap.bytes, heap.top
+    lo, hi = INT_MIN, INT_MAX
+    code, level, nargs, pad = progs[idx]
+    frame = list(args) + pad
+    saved = display[level]
+    display[level] = frame
+    calls = []
+    pc = 0
+    while True:
+        instr = code[pc]
+        op = instr[0]
+        pc += 1
+        if op == OP_ARITH:
+            val = instr[1](frame[instr[2]], frame[instr[3]])
+            frame[instr[4]] = val if lo <= val <= hi else wrap64(val)
+        elif op == OP_ARITHI:
+            val = instr[1](frame[instr[2]], instr[3])
+            frame[instr[4]] = val if lo <= val <= hi else wrap64(val)
+        elif op == OP_BINOP:
+            frame[instr[4]] = instr[1](frame[instr[2]], frame[instr[3]])
+        elif op == OP_BINOPI:
+            frame[instr[4]] = instr[1](frame[instr[2]], instr[3])
+        elif op == OP_JMPF_CMP:
+            if not instr[1](frame[instr[2]], frame[instr[3]]):
+                pc = instr[4]
+        elif op == OP_JMPF_CMPI:
+            if not instr[1](frame[instr[2]], instr[3]):
+                pc = instr[4]
+        elif op == OP_MOV:
+            frame[instr[2]] = frame[instr[1]]
+        elif op == OP_CONST:
+            frame[instr[2]] = instr[1]
+        elif op == OP_JMPF:
+            if not frame[instr[1]]:
+                pc = instr[2]
+        elif op == OP_JMP:
+            pc = instr[1]
+        elif op == OP_UNOP:
+            frame[instr[3]] = instr[1](frame[instr[2]])
+        elif op == OP_LOAD:
+            ptr = frame[instr[1]]
+            if not 0 < ptr < top:
+                raise heap.bad_pointer(ptr)
+            frame[instr[2]] = words[ptr >> 3]
+        elif op == OP_LOAD8:
+            ptr = frame[instr[1]]
+            if not 0 < ptr < top:
+                raise heap.bad_pointer(ptr)
+            frame[instr[2]] = data[ptr]
+        elif op == OP_STORE:
+            ptr = frame[instr[1]]
+            if not 0 < ptr < top:
+                raise heap.bad_pointer(ptr)
+            words[ptr >> 3] = frame[instr[2]]
+        elif op == OP_STORE8:
+            ptr = frame[instr[1]]
+            if not 0 < ptr < top:
+                raise heap.bad_pointer(ptr)
+            data[ptr] = frame[instr[2]] & 0xff
+        elif op == OP_PTRADD:
+            frame[instr[4]] = frame[instr[2]] + frame[instr[3]] * instr[1]
+        elif op == OP_CALL:
+            start = instr[2]
+            calls.append((code, pc, frame, start, level, saved))
+            code, level, nargs, pad = progs[instr[1]]
+            frame = frame[start:start + nargs] + pad
+            saved = display[level]
+            display[level] = frame
+            pc = 0
+        elif op == OP_RET:
+            val = frame[instr[1]] if instr[1] >= 0 else None
+            display[level] = saved
+            if not calls:
+                return val
+            code, pc, frame, start, level, saved = calls.pop()
+            frame[start] = val
+        elif op == OP_GET_ENV:
+            frame[instr[3]] = display[instr[1]][instr[2]]
+        elif op == OP_SET_ENV:
+            display[instr[1]][instr[2]] = frame[instr[3]]
+        else:
+            frame[instr[3]] = heap.alloc(frame[instr[2]], instr[1])
+            words, data, top = heap.words, heap.bytes, heap.top
+
+def pl_run_ir(root: Func, heap=None):
+    # Pass a Heap to look at the program's memory afterwards.
+    progs = [vm_load(func) for func in root.funcs]
+    display = [None] * (max(func.level for func in root.funcs) + 1)
+    return vm_exec(progs, 0, [], display, Heap() if heap is None else heap)
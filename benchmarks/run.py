@@ -0,0 +1,247 @@
+import argparse
+import json
+import marshal
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, os.path.join(ROOT, 'backends', 'py'))
+
+from parser import pl_parse_prog
+from nodes import NodeTable, pl_intern
+from interpreter import pl_eval
+from closure import pl_compile_prog
+from compiler import pl_comp_main
+from func import Func
+from optimizer import pl_optimize
+from vm import pl_run_ir
+
+# Times every program in the corpus on every engine, with parsing,
+# compiling and executing measured separately. Each phase runs --repeat
+# times and the fastest run is kept. The corpus is written in the typed
+# dialect the IR compiler takes; pl_eval and the closure engine run it
+# with the annotations erased, which is their compile phase. The C
+# interpreter in backends/c only understands a small subset of the
+# language, so only its parser is timed, as a whole process. The
+# ast-cache row is the size of a program's AST cache entry, a node
+# table, and the time to load it, next to marshalling the nested lists.
+
+C_INTERP = os.path.join(ROOT, 'backends', 'c', 'lisp_parser')
+
+# Phases faster than this are noise and never count as regressions.
+MIN_TIME = 1e-3
+
+PHASES = ('parse', 'compile', 'execute', 'load')
+
+def large_source(n=3000):
+    # Many small functions and one call: almost all of the cost is in
+    # the front end.
+    lines = [f'(def (f{i} int) ((x int)) (+ (* x {i % 7}) {i}))' for i in range(n)]
+    lines.append(f'(call f{n - 1} 1)')
+    return '\n'.join(lines) + '\n'
+
+def load_corpus():
+    corpus = dict()
+    for name in sorted(os.listdir(HERE)):
+        base, ext = os.path.splitext(name)
+        if ext == '.pl_lang':
+            with open(os.path.join(HERE, name)) as f:
+                corpus[base] = f.read()
+    corpus['large_parse'] = large_source()
+    return corpus
+
+def erase_types(node):
+    # The untyped dialect of a typed program.
+    if not isinstance(node, list):
+        return node
+    if len(node) == 4 and node[0] == 'def' and isinstance(node[1], list):
+        _, (name, *_), args, body = node
+        args = [arg[0] if isinstance(arg, list) else arg for arg in args]
+        return ['def', name, args, erase_types(body)]
+    return [erase_types(kid) for kid in node]
+
+def eval_compile(ast):
+    return erase_types(ast)
+
+def eval_execute(prog):
+    return pl_eval((dict(), None), prog)
+
+def closure_compile(ast):
+    return pl_compile_prog(erase_types(ast))
+
+def closure_execute(prog):
+    return prog()
+
+def ir_compile(ast, optimize=False):
+    root = Func(None)
+    pl_comp_main(root, ['def', ['main', 'int'], [], ast])
+    if optimize:
+        pl_optimize(root)
+    return root
+
+ENGINES = {
+    'eval': (eval_compile, eval_execute),
+    'closure': (closure_compile, closure_execute),
+    'ir': (ir_compile, pl_run_ir),
+    'ir-O': (lambda ast: ir_compile(ast, True), pl_run_ir),
+}
+
+def best_of(repeat, fn, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        val = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, val
+
+def bench_python(source, engine, repeat):
+    compile, execute = ENGINES[engine]
+    out = dict()
+    try:
+        out['parse'], ast = best_of(repeat, pl_parse_prog, source)
+        out['compile'], prog = best_of(repeat, compile, ast)
+        out['execute'], result = best_of(repeat, execute, prog)
+    except Exception as e:
+        out['error'] = f'{type(e).__name__}: {e}'
+        return out
+    out['result'] = result if isinstance(result, (int, float, type(None))) else repr(result)
+    return out
+
+def bench_c(path, repeat):
+    def run():
+        proc = subprocess.run([C_INTERP, '--parse', path], capture_output=True)
+        if proc.returncode != 0:
+            raise RuntimeError(proc.stderr.decode().strip())
+    try:
+        elapsed, _ = best_of(repeat, run)
+    except Exception as e:
+        return {'error': f'{type(e).__name__}: {e}'}
+    return {'parse': elapsed}
+
+def bench_cache(source, repeat):
+    ast = pl_parse_prog(source)
+    table, root = pl_intern(ast)
+    data = marshal.dumps((root, table.dump()))
+
+    def load():
+        root, dump = marshal.loads(data)
+        return NodeTable.load(dump).to_list(root)
+    out = {'bytes': len(data)}
+    out['load'], _ = best_of(repeat, load)
+    try:
+        lists = marshal.dumps(ast)
+    except ValueError:
+        # Too deep for marshal, which is why the table is cached.
+        return out
+    out['lists_bytes'] = len(lists)
+    out['lists_load'], _ = best_of(repeat, marshal.loads, lists)
+    return out
+
+def run_benchmarks(names, engines, repeat):
+    corpus = load_corpus()
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in names or corpus:
+            if name not in corpus:
+                raise SystemExit(f"Unknown benchmark {name}")
+            source = corpus[name]
+            row = dict()
+            for engine in engines:
+                if engine == 'c-interp':
+                    path = os.path.join(tmp, name + '.pl_lang')
+                    with open(path, 'w') as f:
+                        f.write(source)
+                    row[engine] = bench_c(path, repeat)
+                elif engine == 'ast-cache':
+                    row[engine] = bench_cache(source, repeat)
+                else:
+                    row[engine] = bench_python(source, engine, repeat)
+                print(f'{name:12} {engine:9} ' + format_row(row[engine]), file=sys.stderr)
+            results[name] = row
+    return results
+
+def format_row(row):
+    if 'error' in row:
+        return 'skipped: ' + row['error']
+    out = '  '.join(f'{phase} {row[phase] * 1e3:9.2f}ms' for phase in PHASES if phase in row)
+    if 'bytes' in row:
+        out += f'  {row["bytes"]:9} bytes'
+    if 'lists_bytes' in row:
+        out += f'  (lists: load {row["lists_load"] * 1e3:.2f}ms, {row["lists_bytes"]} bytes)'
+    return out
+
+def check_results(results):
+    # Every engine that ran a program must agree on its result.
+    problems = []
+    for name, row in results.items():
+        seen = {engine: r['result'] for engine, r in row.items() if 'result' in r}
+        if len(set(map(repr, seen.values()))) > 1:
+            problems.append(f'{name}: engines disagree: {seen}')
+    return problems
+
+def compare(results, baseline, threshold):
+    problems = []
+    for name, row in results.items():
+        for engine, cur in row.items():
+            base = baseline.get(name, {}).get(engine, {})
+            for phase in PHASES:
+                if phase not in cur or phase not in base:
+                    continue
+                if base[phase] < MIN_TIME:
+                    continue
+                ratio = cur[phase] / base[phase]
+                if ratio > 1 + threshold:
+                    problems.append(f'{name} {engine} {phase}: {base[phase] * 1e3:.2f}ms -> '
+                                    f'{cur[phase] * 1e3:.2f}ms ({ratio:.2f}x)')
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pl execution engines')
+    parser.add_argument('names', nargs='*', help='Benchmarks to run (default: all)')
+    parser.add_argument('--engine', action='append', choices=[*ENGINES, 'c-interp', 'ast-cache'],
+                        help='Engine to run, may be repeated (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per phase; the fastest is kept')
+    parser.add_argument('--baseline', help='Compare against the results stored in this JSON file')
+    parser.add_argument('--update-baseline', action='store_true', help='Write the results to --baseline instead')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed slowdown over the baseline, as a fraction (default: 0.25)')
+    parser.add_argument('-o', '--output', help='Write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    engines = args.engine or [*ENGINES, 'ast-cache']
+    if not args.engine and os.path.exists(C_INTERP):
+        engines.append('c-interp')
+    results = run_benchmarks(args.names, engines, args.repeat)
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    problems = check_results(results)
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            f.write(text + '\n')
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        problems += compare(results, baseline, args.threshold)
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    if problems:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()